@@ -0,0 +1,305 @@
+"""压测脚本：在模拟服务商上运行网页接口或批量引擎，报告延迟分位数、吞吐和内存
+
+    python benchmarks/load_test.py web --sessions 50 --turns 3
+    python benchmarks/load_test.py web --sessions 50 --url http://localhost:5000
+    python benchmarks/load_test.py batch --topics 200 --concurrency 32 --turns 2
+    python benchmarks/load_test.py summary --session-store sqlite
+
+src 和 webapp 中有同名模块，两种模式需分别运行。
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from mock_provider import add_mock_arguments, options_from_args, start_mock_provider
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def latency_report(samples):
+    def ms(value):
+        return round(value * 1000, 1) if value is not None else None
+    return {
+        "count": len(samples),
+        "p50_ms": ms(percentile(samples, 50)),
+        "p95_ms": ms(percentile(samples, 95)),
+        "p99_ms": ms(percentile(samples, 99)),
+        "max_ms": ms(max(samples) if samples else None)
+    }
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # Linux 下单位为KB，macOS 下为字节
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def prepare_config(source, api_base, rps, turns):
+    """复制配置，把所有模型指向模拟服务商并放宽限流，以便测量引擎自身的开销"""
+    with open(source, encoding='utf-8') as f:
+        config = yaml.safe_load(f)
+    for model_config in config['model_configs'].values():
+        model_config.pop('failover', None)
+        model_config.update(api_base=api_base, api_key="sk-bench", rps=rps, burst=rps, tpm=None)
+    config['system']['max_turns'] = turns
+    return config
+
+
+class InProcessClient:
+    """通过 Flask 测试客户端在进程内调用接口"""
+
+    def __init__(self, flask_app):
+        self.app = flask_app
+
+    def post(self, path, payload):
+        response = self.app.test_client().post(path, json=payload)
+        if response.mimetype == 'text/event-stream':
+            return response.status_code, parse_sse_end(response.get_data(as_text=True))
+        return response.status_code, response.get_json()
+
+
+class HttpClient:
+    """通过HTTP调用已部署的服务，每个线程一个连接池"""
+
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip('/')
+        self._requests = requests
+        self._local = threading.local()
+
+    def post(self, path, payload):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        response = session.post(self.url + path, json=payload, timeout=300)
+        if response.headers.get('Content-Type', '').startswith('text/event-stream'):
+            return response.status_code, parse_sse_end(response.text)
+        return response.status_code, response.json()
+
+
+def parse_sse_end(text):
+    """从SSE响应中取出 end 或 error 事件的数据"""
+    result = {}
+    for block in text.split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        if lines.get('event') in ('end', 'error'):
+            result = json.loads(lines['data'])
+    return result
+
+
+def load_webapp(config):
+    """在临时目录中写入配置并导入网页应用"""
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    with open(os.path.join(workdir, "config.yaml"), 'w', encoding='utf-8') as f:
+        yaml.safe_dump(config, f, allow_unicode=True)
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.join(ROOT, "webapp"))
+    import app
+    return app.app
+
+
+def run_session(client, index, turns, stream, stats):
+    start = time.perf_counter()
+    status, data = client.post('/start', {"topic": f"压测话题 {index}", "max_turns": turns})
+    stats['start'].append(time.perf_counter() - start)
+    if status != 200:
+        stats['errors'].append(data)
+        return
+
+    session_id = data['session_id']
+    while True:
+        start = time.perf_counter()
+        status, data = client.post('/next', {"session_id": session_id, "stream": stream})
+        elapsed = time.perf_counter() - start
+        if status != 200 or 'error' in data:
+            stats['errors'].append(data)
+            return
+        if data.get('done'):
+            return
+        stats['next'].append(elapsed)
+        if data.get('fallback'):
+            stats['fallbacks'].append(session_id)
+
+
+def measure_session_memory(client, count):
+    """创建 count 个会话并各生成一条发言，返回平均每个会话保留的内存（KB）"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for index in range(count):
+        status, data = client.post('/start', {"topic": f"内存测试话题 {index}", "max_turns": 1})
+        if status == 200:
+            client.post('/next', {"session_id": data['session_id']})
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return round((after - before) / count / 1024, 2)
+
+
+def run_web(args, api_base):
+    if args.url:
+        client = HttpClient(args.url)
+    else:
+        config = prepare_config(os.path.join(ROOT, "webapp", "config.yaml"), api_base, args.rps, args.turns)
+        client = InProcessClient(load_webapp(config))
+
+    stats = {'start': [], 'next': [], 'errors': [], 'fallbacks': []}
+    wall = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+        for index in range(args.sessions):
+            pool.submit(run_session, client, index, args.turns, args.stream, stats)
+    wall = time.perf_counter() - wall
+
+    report = {
+        "mode": "web",
+        "sessions": args.sessions,
+        "turns": args.turns,
+        "stream": args.stream,
+        "wall_seconds": round(wall, 3),
+        "start": latency_report(stats['start']),
+        "next": latency_report(stats['next']),
+        "responses_per_second": round(len(stats['next']) / wall, 2),
+        "errors": len(stats['errors']),
+        "fallbacks": len(stats['fallbacks'])
+    }
+    if not args.url and args.memory_sessions:
+        report["memory_per_session_kb"] = measure_session_memory(client, args.memory_sessions)
+    return report
+
+
+def run_summary_check(args, api_base):
+    """检查后台滚动摘要写回会话存储：每条发言后读取已保存会话的 summarized_upto
+
+    摘要在请求保存会话之后才完成，未写回存储时 summarized_upto 停留在初始值，上下文无限增长。
+    """
+    keep_entries = 2
+    config = prepare_config(os.path.join(ROOT, "webapp", "config.yaml"), api_base, args.rps, args.turns)
+    config['system']['session_store'] = {"backend": args.session_store, "path": "sessions.db"}
+    config['system']['rolling_summary'] = {"enabled": True, "keep_entries": keep_entries}
+    config['system']['pipelining'] = {"enabled": False}
+    client = InProcessClient(load_webapp(config))
+    store = sys.modules['app'].session_store
+
+    status, data = client.post('/start', {"topic": "摘要检查话题", "max_turns": args.turns})
+    if status != 200:
+        return {"mode": "summary", "session_store": args.session_store, "error": data, "passed": False}
+    session_id = data['session_id']
+
+    progress = []
+    passed = True
+    while True:
+        status, data = client.post('/next', {"session_id": session_id})
+        if status != 200 or data.get('done'):
+            break
+        record = store.get(session_id)
+        expected = len(record['state'].history) - keep_entries
+        # 摘要在后台线程中完成，等待写回
+        deadline = time.monotonic() + 2.0
+        while record['state'].summarized_upto < expected and time.monotonic() < deadline:
+            time.sleep(0.02)
+            record = store.get(session_id)
+        progress.append(record['state'].summarized_upto)
+        passed = passed and record['state'].summarized_upto >= expected
+
+    return {
+        "mode": "summary",
+        "session_store": args.session_store,
+        "summarized_upto": progress,
+        "passed": passed and status == 200
+    }
+
+
+def run_batch(args, api_base):
+    config = prepare_config(os.path.join(ROOT, "src", "config.yaml"), api_base, args.rps, args.turns)
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    config_path = os.path.join(workdir, "config.yaml")
+    topics_path = os.path.join(workdir, "topics.jsonl")
+    output_path = os.path.join(workdir, "results.jsonl")
+    with open(config_path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(config, f, allow_unicode=True)
+    with open(topics_path, 'w', encoding='utf-8') as f:
+        for index in range(args.topics):
+            f.write(json.dumps({"id": index, "topic": f"压测话题 {index}"}, ensure_ascii=False) + "\n")
+
+    sys.path.insert(0, os.path.join(ROOT, "src"))
+    from batch_runner import BatchRunner
+
+    runner = BatchRunner(config_path, concurrency=args.concurrency, max_turns=args.turns)
+    wall = time.perf_counter()
+    succeeded, failed, _ = runner.run(topics_path, output_path)
+    wall = time.perf_counter() - wall
+
+    with open(output_path, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    calls = sum(len(record.get('history', [])) - 1 for record in records)
+    return {
+        "mode": "batch",
+        "topics": args.topics,
+        "concurrency": args.concurrency,
+        "turns": args.turns,
+        "wall_seconds": round(wall, 3),
+        "topic": latency_report([record['elapsed'] for record in records if 'elapsed' in record]),
+        "topics_per_second": round(succeeded / wall, 2),
+        "calls_per_second": round(calls / wall, 2),
+        "errors": failed
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='多模型对话系统压测')
+    parser.add_argument('mode', choices=['web', 'batch', 'summary'])
+    parser.add_argument('--turns', type=int, default=2, help='每个讨论的轮次')
+    parser.add_argument('--rps', type=float, default=10000, help='压测配置中每个服务商的限流')
+    parser.add_argument('--sessions', type=int, default=20, help='web模式并发会话数')
+    parser.add_argument('--stream', action='store_true', help='web模式使用流式接口')
+    parser.add_argument('--url', help='web模式压测已部署的服务（需自行把服务商指向模拟服务商）')
+    parser.add_argument('--memory-sessions', type=int, default=200, help='测量内存时创建的会话数，0表示不测量')
+    parser.add_argument('--topics', type=int, default=100, help='batch模式话题数')
+    parser.add_argument('--concurrency', type=int, default=16, help='batch模式并发讨论数')
+    parser.add_argument('--session-store', choices=['memory', 'sqlite'], default='sqlite',
+                        help='summary模式检查的会话存储')
+    parser.add_argument('--json', help='把报告写入JSON文件，便于与基线比较')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    server, api_base = start_mock_provider(options=options_from_args(args))
+    try:
+        runners = {'web': run_web, 'batch': run_batch, 'summary': run_summary_check}
+        report = runners[args.mode](args, api_base)
+    finally:
+        server.shutdown()
+    report["peak_rss_mb"] = peak_rss_mb()
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if report.get('passed') is False:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""本地模拟服务商：兼容 OpenAI Chat Completions 接口，用于离线压测
+
+延迟按对数正态分布抽样，输出按 token 速率生成，可配置错误率和流式输出。
+只依赖标准库，可单独运行，也可由压测脚本在进程内启动。
+
+    python benchmarks/mock_provider.py --port 8999 --latency 0.3 --token-rate 80
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockOptions:
+    """模拟服务商的行为参数"""
+
+    def __init__(self, latency=0.3, latency_sigma=0.5, token_rate=80.0, completion_tokens=60,
+                 error_rate=0.0, seed=None):
+        self.latency = latency                      # 首个token前的延迟中位数（秒）
+        self.latency_sigma = latency_sigma          # 对数正态分布的sigma，0表示固定延迟
+        self.token_rate = token_rate                # 每秒输出token数，0表示瞬时输出
+        self.completion_tokens = completion_tokens  # 每次输出的token数
+        self.error_rate = error_rate                # 返回500错误的概率
+        self.first_request_at = None                # 收到第一个请求的时间（time.time()）
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            if self.first_request_at is None:
+                self.first_request_at = time.time()
+
+    def sample_latency(self):
+        with self._lock:
+            if self.latency_sigma <= 0:
+                return self.latency
+            return self.latency * math.exp(self._random.gauss(0, self.latency_sigma))
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    options = MockOptions()
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (ConnectionResetError, BrokenPipeError):
+            # 压测取消请求（如对冲、超时）时客户端提前断开连接，不打印异常
+            pass
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b"{}")
+        options = self.options
+        options.record_request()
+
+        time.sleep(options.sample_latency())
+        if options.should_fail():
+            self._send_json(500, {"error": {"message": "mock provider error", "type": "server_error"}})
+            return
+
+        messages = body.get('messages', [])
+        prompt_tokens = sum(len(message.get('content', '')) for message in messages) // 2 + 1
+        completion_tokens = min(body.get('max_tokens') or options.completion_tokens,
+                                options.completion_tokens)
+        words = [f"w{i}" for i in range(completion_tokens)]
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+
+        if body.get('stream'):
+            self._send_stream(body, words)
+            return
+
+        if options.token_rate > 0:
+            time.sleep(completion_tokens / options.token_rate)
+        self._send_json(200, {
+            "id": "mock-completion",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get('model', 'mock'),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": " ".join(words)},
+                "finish_reason": "stop"
+            }],
+            "usage": usage
+        })
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, body, words):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        interval = 1.0 / self.options.token_rate if self.options.token_rate > 0 else 0
+        for word in words:
+            chunk = {
+                "object": "chat.completion.chunk",
+                "model": body.get('model', 'mock'),
+                "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]
+            }
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+            if interval:
+                time.sleep(interval)
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+def start_mock_provider(host="127.0.0.1", port=0, options=None):
+    """在后台线程中启动模拟服务商，返回 (server, api_base)；port 为0时自动分配端口"""
+    handler = type("Handler", (MockProviderHandler,), {"options": options or MockOptions()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def add_mock_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.3, help='首个token前的延迟中位数（秒）')
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help='延迟对数正态分布的sigma')
+    parser.add_argument('--token-rate', type=float, default=80.0, help='每秒输出token数')
+    parser.add_argument('--completion-tokens', type=int, default=60, help='每次输出的token数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回500错误的概率')
+    parser.add_argument('--seed', type=int, help='随机种子')
+
+
+def options_from_args(args):
+    return MockOptions(args.latency, args.latency_sigma, args.token_rate,
+                       args.completion_tokens, args.error_rate, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OpenAI兼容的本地模拟服务商')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8999)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    handler = type("Handler", (MockProviderHandler,), {"options": options_from_args(args)})
+    server = ThreadingHTTPServer((args.host, args.port), handler)
+    server.daemon_threads = True
+    print(f"[INFO] 模拟服务商已启动: http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("[INFO] 模拟服务商已停止")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""启动耗时：命令行版本的导入耗时和发出第一个请求前的耗时
+
+    python benchmarks/startup_time.py --runs 5
+    python benchmarks/startup_time.py --json startup.json --max-ms 800
+
+导入耗时来自 python -X importtime，同时列出 main 直接导入的模块中最慢的几个，
+以及导入阶段已加载的服务商SDK；首个请求耗时从启动 main.py --topic 开始计时，
+到模拟服务商收到第一个请求为止。--max-ms 用于在回归时返回非零退出码。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from load_test import prepare_config
+from mock_provider import MockOptions, start_mock_provider
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, "src")
+
+# 不应在导入阶段加载的服务商SDK及其依赖
+SDK_MODULES = ("openai", "qianfan", "requests", "aiohttp")
+
+
+def parse_importtime(stderr):
+    """解析 -X importtime 的输出，返回 [(模块名, 自身耗时us, 累计耗时us, 层级)]"""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return entries
+
+
+def measure_import():
+    """导入 main 一次，返回 (累计耗时ms, main 直接导入的模块, 已加载的SDK)"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                            cwd=SRC, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    entries = parse_importtime(result.stderr)
+    # 输出按导入完成的顺序排列，main 的子模块位于 main 之前、上一个顶层模块之后
+    end = next(index for index, entry in enumerate(entries) if entry[0] == "main" and entry[3] == 0)
+    begin = end
+    while begin > 0 and entries[begin - 1][3] > 0:
+        begin -= 1
+    tree = entries[begin:end]
+    children = [(name, cumulative) for name, _, cumulative, depth in tree if depth == 1]
+    sdks = sorted({name.split(".")[0] for name, _, _, _ in tree if name.split(".")[0] in SDK_MODULES})
+    total_us = entries[end][2]
+    return total_us / 1000, children, sdks
+
+
+def measure_first_prompt(config_dir, options):
+    """运行一次 main.py --topic，返回 (首个请求耗时ms, 进程总耗时ms)"""
+    options.first_request_at = None
+    start = time.time()
+    result = subprocess.run([sys.executable, os.path.join(SRC, "main.py"), "--topic", "启动耗时测试",
+                             "--max-turns", "1"],
+                            cwd=config_dir, input="q\n", capture_output=True, text=True)
+    wall = time.time() - start
+    if result.returncode != 0 or options.first_request_at is None:
+        raise RuntimeError(f"main.py 未发出请求: {result.stdout[-500:]}{result.stderr[-500:]}")
+    return (options.first_request_at - start) * 1000, wall * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='命令行启动耗时')
+    parser.add_argument('--runs', type=int, default=5, help='重复次数，报告中位数')
+    parser.add_argument('--top', type=int, default=8, help='列出 main 直接导入的最慢模块数')
+    parser.add_argument('--json', help='把报告写入JSON文件，便于与基线比较')
+    parser.add_argument('--max-ms', type=float, help='首个请求耗时的中位数超过该值时返回非零退出码')
+    args = parser.parse_args()
+
+    options = MockOptions(latency=0, latency_sigma=0, token_rate=0, completion_tokens=5)
+    server, api_base = start_mock_provider(options=options)
+    config_dir = tempfile.mkdtemp(prefix="bench-")
+    with open(os.path.join(config_dir, "config.yaml"), 'w', encoding='utf-8') as f:
+        yaml.safe_dump(prepare_config(os.path.join(SRC, "config.yaml"), api_base, 10000, 1), f,
+                       allow_unicode=True)
+
+    imports, first_prompts, walls = [], [], []
+    try:
+        for _ in range(args.runs):
+            total_ms, children, sdks = measure_import()
+            imports.append(total_ms)
+            first_prompt_ms, wall_ms = measure_first_prompt(config_dir, options)
+            first_prompts.append(first_prompt_ms)
+            walls.append(wall_ms)
+    finally:
+        server.shutdown()
+
+    children.sort(key=lambda item: item[1], reverse=True)
+    report = {
+        "runs": args.runs,
+        "import_ms": round(statistics.median(imports), 1),
+        "first_prompt_ms": round(statistics.median(first_prompts), 1),
+        "process_ms": round(statistics.median(walls), 1),
+        "slowest_imports": [{"module": name, "cumulative_ms": round(us / 1000, 1)}
+                            for name, us in children[:args.top]],
+        "sdks_loaded_at_import": sdks
+    }
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.max_ms is not None and report["first_prompt_ms"] > args.max_ms:
+        print(f"首个请求耗时 {report['first_prompt_ms']}ms 超过阈值 {args.max_ms}ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
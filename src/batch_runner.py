@@ -0,0 +1,127 @@
+import csv
+import json
+import os
+import time
+import logging
+from dataclasses import asdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dialogue_engine import DialogueEngine, load_config, build_models
+from transcript_store import create_transcript_store
+
+logger = logging.getLogger("BatchRunner")
+
+
+def load_topics(path):
+    """读取话题文件，返回 [(话题ID, 话题)] 列表
+
+    JSONL 每行为字符串或包含 topic（可选 id）字段的对象；
+    CSV 需包含 topic 列，可选 id 列。未提供ID时使用行号。
+    """
+    topics = []
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.lower().endswith('.csv'):
+            for line_no, row in enumerate(csv.DictReader(f), 1):
+                topics.append((str(row.get('id') or line_no), row['topic']))
+        else:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if isinstance(item, str):
+                    item = {"topic": item}
+                topics.append((str(item.get('id', line_no)), item['topic']))
+    return topics
+
+
+def load_checkpoint(path):
+    """返回已完成的话题ID集合"""
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding='utf-8') as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+class BatchRunner:
+    """并发运行多个话题的讨论，结果逐条写入JSONL，并记录检查点以便中断后继续
+
+    所有讨论共享同一组适配器，因此各服务商的限流额度在整个批次内共享。
+    """
+
+    def __init__(self, config_path="config.yaml", concurrency=8, max_turns=None):
+        self.config = load_config(config_path)
+        if max_turns is not None:
+            self.config['system']['max_turns'] = max_turns
+        self.models = build_models(self.config)
+        self.transcript = create_transcript_store(self.config['system'])
+        self.concurrency = concurrency
+
+    def run_topic(self, topic):
+        """运行单个话题的讨论，返回引擎"""
+        engine = DialogueEngine(config=self.config, models=self.models, transcript=self.transcript)
+        engine.start_discussion(topic, echo=False)
+        return engine
+
+    def run(self, input_path, output_path, checkpoint_path=None):
+        """运行整个批次，返回 (成功数, 失败数, 跳过数)"""
+        checkpoint_path = checkpoint_path or output_path + ".ckpt"
+        topics = load_topics(input_path)
+        completed = load_checkpoint(checkpoint_path)
+        pending = [(topic_id, topic) for topic_id, topic in topics if topic_id not in completed]
+        skipped = len(topics) - len(pending)
+        if skipped:
+            logger.info(f"根据检查点跳过已完成的话题: {skipped} 个")
+
+        succeeded = failed = 0
+        start = time.time()
+        with open(output_path, 'a', encoding='utf-8') as output, \
+                open(checkpoint_path, 'a', encoding='utf-8') as checkpoint, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = [pool.submit(self._run_one, topic_id, topic) for topic_id, topic in pending]
+
+            try:
+                for future in as_completed(futures):
+                    record = future.result()
+                    if 'error' in record:
+                        # 失败的话题不写检查点，下次运行时重试
+                        failed += 1
+                        logger.error(f"话题 {record['id']} 失败: {record['error']}")
+                    else:
+                        succeeded += 1
+
+                    output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    output.flush()
+                    # 结果写入后再记录检查点，中断时最多重复一条结果而不会丢失
+                    if 'error' not in record:
+                        checkpoint.write(record['id'] + "\n")
+                        checkpoint.flush()
+
+                    done = succeeded + failed
+                    logger.info(f"进度 {done}/{len(pending)}，"
+                                f"吞吐 {done / max(time.time() - start, 1e-6):.2f} 话题/秒")
+            except KeyboardInterrupt:
+                # 中断时取消尚未开始的话题，已完成的结果和检查点均已落盘
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+
+        if self.transcript is not None:
+            self.transcript.flush()
+        return succeeded, failed, skipped
+
+    def _run_one(self, topic_id, topic):
+        start = time.time()
+        try:
+            engine = self.run_topic(topic)
+        except Exception as e:
+            return {"id": topic_id, "topic": topic, "error": str(e)}
+        if engine.failures:
+            # 模型调用失败的发言不能作为结果，话题不写检查点
+            return {"id": topic_id, "topic": topic, "transcript_id": engine.transcript_id,
+                    "error": f"{len(engine.failures)} 次模型调用失败: {engine.failures[0]}"}
+        return {
+            "id": topic_id,
+            "topic": topic,
+            "transcript_id": engine.transcript_id,
+            "converged_at": engine.converged_at,
+            "history": [asdict(turn) for turn in engine.history],
+            "elapsed": round(time.time() - start, 3)
+        }
@@ -0,0 +1,205 @@
+import re
+import time
+import threading
+from bisect import bisect_left
+from dataclasses import dataclass
+
+# 中日韩字符大致按1个token计，其余字符按约4个字符1个token计
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+# 每条消息的角色/分隔符开销
+MESSAGE_OVERHEAD = 4
+
+# 用户（话题发起者）的发言者名称
+USER_SPEAKER = "用户"
+
+# 滚动摘要或上下文摘要作为用户消息发送时的前缀
+SUMMARY_PREFIX = "此前讨论摘要:\n"
+
+
+def estimate_tokens(text):
+    """本地估算文本的token数"""
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def first_sentence(text):
+    """取文本的第一句"""
+    return re.split(r'(?<=[。！？.!?])', text.strip(), maxsplit=1)[0]
+
+
+@dataclass(slots=True)
+class Turn:
+    """一条发言记录，token数在创建时估算一次"""
+    speaker: str
+    role: str  # "user": 用户发言; "assistant": 模型发言
+    text: str
+    tokens: int
+    timestamp: float
+
+    @classmethod
+    def create(cls, speaker, text):
+        role = "user" if speaker == USER_SPEAKER else "assistant"
+        return cls(speaker, role, text, estimate_tokens(text), time.time())
+
+    def __str__(self):
+        return f"{self.speaker}: {self.text}"
+
+    def to_list(self):
+        """紧凑的序列化形式"""
+        return [self.speaker, self.role, self.text, self.tokens, self.timestamp]
+
+    @classmethod
+    def from_list(cls, data):
+        return cls(*data)
+
+
+class MessageCache:
+    """单个会话的增量消息缓存
+
+    每条发言的token开销只累计一次（前缀和），每个发言者视角下的消息只转换一次；
+    发言记录只追加，因此每次构建请求只需处理新增的发言。
+    """
+    __slots__ = ('turns', 'prefix', 'views', 'lock')
+
+    def __init__(self):
+        self.turns = None
+        self.prefix = [0]  # prefix[i] 为 turns[:i] 的token开销之和
+        self.views = {}    # 发言者 -> 该视角下的消息列表
+        self.lock = threading.Lock()
+
+    def sync(self, turns, end, speaker):
+        """处理 turns[:end] 中的新发言，返回 (前缀和, speaker 视角的消息列表)"""
+        with self.lock:
+            if turns is not self.turns:
+                # 会话重新开始时发言记录是新的列表
+                self.turns = turns
+                self.prefix = [0]
+                self.views = {}
+
+            prefix = self.prefix
+            for turn in turns[len(prefix) - 1:end]:
+                prefix.append(prefix[-1] + turn.tokens + estimate_tokens(turn.speaker) + MESSAGE_OVERHEAD)
+
+            messages = self.views.setdefault(speaker, [])
+            for turn in turns[len(messages):end]:
+                messages.append(_to_message(turn, speaker))
+            return prefix, messages
+
+
+def _to_message(turn, speaker):
+    if turn.speaker == speaker:
+        return {"role": "assistant", "content": turn.text}
+    if turn.speaker == USER_SPEAKER:
+        return {"role": "user", "content": turn.text}
+    # 其他参与者的发言保留名称，方便模型区分发言者
+    return {"role": "user", "content": str(turn)}
+
+
+class ContextView:
+    """请求使用的历史视图：turns[:end]，其中 turns[0] 为话题，turns[1:start] 已折叠进 summary"""
+    __slots__ = ('turns', 'end', 'summary', 'start', 'cache')
+
+    def __init__(self, turns, end=None, summary="", start=1, cache=None):
+        self.turns = turns
+        self.end = len(turns) if end is None else end
+        self.summary = summary
+        self.start = start
+        self.cache = cache
+
+
+class ContextBuilder:
+    """按token预算构建发送给模型的消息列表
+
+    话题（第一条历史）始终保留，其余历史从最新往前填充直到用完预算；
+    讨论内容只通过消息列表发送一次，最后一条用户消息只包含发言指令。
+    被挤出窗口的旧发言可选地压缩成摘要。
+
+    layout 为 sliding 时窗口每次都从最新发言往前截取，超出预算后每条新发言都会移动窗口起点；
+    为 append_only 时窗口起点只落在每隔约半个预算的检查点上，两次跳跃之间新发言只追加在末尾，
+    消息前缀保持不变，服务商的前缀缓存（如 DeepSeek 的上下文硬盘缓存）可以命中。
+    """
+
+    def __init__(self, budget=2000, summarize=False, summary_budget=300, layout="sliding"):
+        if layout not in ("sliding", "append_only"):
+            raise ValueError(f"未知的上下文布局: {layout}")
+        self.budget = budget
+        self.summarize = summarize
+        self.summary_budget = summary_budget
+        self.layout = layout
+
+    def build(self, speaker, instruction, history):
+        """为 speaker 构建消息列表，history 为 ContextView 或 Turn 列表"""
+        view = history if isinstance(history, ContextView) else ContextView(history)
+        if view.end == 0:
+            return [{"role": "user", "content": instruction}]
+
+        prefix, messages = (view.cache or MessageCache()).sync(view.turns, view.end, speaker)
+        summary = view.summary
+
+        budget = self.budget - self._cost(instruction) - prefix[1]
+        if summary:
+            budget -= self._cost(SUMMARY_PREFIX + summary)
+
+        start = self._window_start(prefix, view.start, view.end, budget)
+        if start > view.start and not summary and self.summarize:
+            # 为摘要预留预算后重新计算窗口
+            start = self._window_start(prefix, view.start, view.end, budget - self.summary_budget)
+            summary = self._summarize(view.turns[view.start:start])
+
+        result = [messages[0]]
+        if summary:
+            self._append(result, {"role": "user", "content": SUMMARY_PREFIX + summary})
+        for message in messages[start:view.end]:
+            self._append(result, message)
+
+        self._append(result, {"role": "user", "content": instruction})
+        return result
+
+    def _cost(self, text):
+        return estimate_tokens(text) + MESSAGE_OVERHEAD
+
+    def _window_start(self, prefix, lo, end, budget):
+        """返回 [lo, end) 内从最新一条往前、预算内能保留的起始下标"""
+        start = bisect_left(prefix, prefix[end] - budget, lo, end)
+        if self.layout == "sliding" or start == lo:
+            return start
+
+        # 检查点按 lo 之后的累计token数等距划分，取不早于 start 的第一个检查点
+        step = max(1, budget // 2)
+        checkpoint = prefix[lo] + -(-(prefix[start] - prefix[lo]) // step) * step
+        stable = bisect_left(prefix, checkpoint, start, end)
+        # 最新一条发言本身超过检查点间距时退回到普通窗口
+        return stable if stable < end else start
+
+    def _summarize(self, turns):
+        """抽取式摘要：保留每条旧发言的首句，优先保留较新的内容"""
+        lines = []
+        budget = self.summary_budget
+        for turn in reversed(turns):
+            line = f"{turn.speaker}: {first_sentence(turn.text)}"
+            budget -= estimate_tokens(line) + 1
+            if budget < 0:
+                break
+            lines.append(line)
+        return "\n".join(reversed(lines))
+
+    @staticmethod
+    def _append(messages, message):
+        # 合并相邻的同角色消息，兼容要求角色交替的接口；缓存中的消息不会被修改
+        if messages and messages[-1]["role"] == message["role"]:
+            messages[-1] = {"role": message["role"],
+                            "content": messages[-1]["content"] + "\n" + message["content"]}
+        else:
+            messages.append(message)
+
+
+def create_context_builder(system_config, model_config):
+    """按系统配置和模型配置创建上下文构建器，模型配置优先"""
+    return ContextBuilder(
+        budget=model_config.get('context_tokens', system_config.get('context_tokens', 2000)),
+        summarize=system_config.get('context_summary', False),
+        summary_budget=system_config.get('summary_tokens', 300),
+        layout=model_config.get('context_layout', system_config.get('context_layout', 'sliding'))
+    )
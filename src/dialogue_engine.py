@@ -1,7 +1,17 @@
 import yaml
 import time
+import uuid
 import logging
-from model_adapters import DeepSeekAdapter, DoubaoAdapter, WenxinAdapter
+import threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from model_adapters import get_adapter_class, ErrorResponse
+from context_builder import create_context_builder, ContextView, MessageCache, Turn, USER_SPEAKER
+from summarizer import create_summarizer
+from speaking_order import create_speaking_policy
+from convergence import create_convergence_detector
+from transcript_store import create_transcript_store, start_record, turn_record, rebuild_state
 
 # 配置日志
 logging.basicConfig(
@@ -10,65 +20,235 @@ logging.basicConfig(
 )
 logger = logging.getLogger("DialogueEngine")
 
+# 发言指令；讨论内容由各适配器的上下文构建器按token预算放入消息列表
+DISCUSSION_PROMPT = "请基于以上讨论继续发言。"
+
+# 终端输出中各发言者的颜色，按参与者顺序循环使用
+SPEAKER_COLORS = ["\033[1;32m", "\033[1;35m", "\033[1;36m", "\033[1;33m", "\033[1;34m", "\033[1;31m"]
+
+
+def load_config(config_path="config.yaml"):
+    """读取配置文件"""
+    with open(config_path) as f:
+        return yaml.safe_load(f)
+
+
+class LazyModels(Mapping):
+    """发言者名称 -> 模型适配器，适配器在第一次被使用时才创建
+
+    名称和发言顺序在读取配置时确定，遍历名称不会创建适配器；
+    只用到部分模型（如重放记录、主持模型选择）时其余适配器不会被创建。
+    """
+
+    def __init__(self, factories):
+        self._factories = factories  # 名称 -> 创建适配器的函数
+        self._adapters = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        adapter = self._adapters.get(name)
+        if adapter is None:
+            factory = self._factories[name]
+            with self._lock:
+                adapter = self._adapters.get(name)
+                if adapter is None:
+                    adapter = self._adapters[name] = factory()
+        return adapter
+
+    def __iter__(self):
+        return iter(self._factories)
+
+    def __len__(self):
+        return len(self._factories)
+
+
+def build_models(config):
+    """根据配置登记参与讨论的模型适配器，按 model_configs 的顺序发言，适配器按需创建"""
+    system = config['system']
+    factories = {}
+    for key, model_config in config['model_configs'].items():
+        if not model_config.get('enabled', True):
+            continue
+        adapter_class = get_adapter_class(key, model_config)
+        name = model_config.get('name') or adapter_class.name or key
+        if name in factories:
+            raise ValueError(f"发言者名称重复: {name}")
+        model_config = dict(model_config, name=name)
+        factories[name] = partial(adapter_class, model_config, create_context_builder(system, model_config))
+    return LazyModels(factories)
+
 
 class DialogueEngine:
-    def __init__(self, config_path="config.yaml"):
+    def __init__(self, config_path="config.yaml", config=None, models=None, transcript=None):
         try:
-            with open(config_path) as f:
-                self.config = yaml.safe_load(f)
-
-            self.models = {
-                "DeepSeek": DeepSeekAdapter(self.config['model_configs']['deepseek']),
-                "Doubao": DoubaoAdapter(self.config['model_configs']['doubao']),
-                "Wenxin": WenxinAdapter(self.config['model_configs']['wenxin'])
-            }
+            # 批量运行时多个引擎复用同一份配置和适配器
+            self.config = config if config is not None else load_config(config_path)
+            system = self.config['system']
+            self.models = models if models is not None else build_models(self.config)
 
+            # 只追加的 Turn 列表，history[0] 为话题
             self.history = []
+            # 各模型视角下的消息缓存
+            self.message_cache = MessageCache()
             self.current_turn = 0
+            # 滚动摘要：history[1:summarized_upto] 已折叠进 summary
+            self.summarizer = create_summarizer(system, self.models)
+            self.summary = ""
+            self.summarized_upto = 1
+            self._summary_future = None
+            self._summary_lock = threading.Lock()
             self.max_turns = self.config['system']['max_turns']
-            self.context_window = self.config['system']['context_window']
-
-            logger.info("对话引擎初始化完成")
-            logger.info(f"最大对话轮次: {self.max_turns}")
-            logger.info(f"上下文窗口大小: {self.context_window}")
+            # 发言顺序：依次、分波并发或由主持模型选择
+            self.speaking_policy = create_speaking_policy(system, self.models)
+            # 收敛检测：最近的发言持续没有新内容时提前结束讨论，converged_at 为结束时的轮次
+            self.convergence = create_convergence_detector(system, self.models)
+            self.converged_at = None
+            # 本次讨论中调用失败的响应（错误说明），批量运行据此判断话题是否失败
+            self.failures = []
+            # 讨论记录：批量运行时由调用方传入共享的存储
+            if transcript is None and config is None:
+                transcript = create_transcript_store(system)
+            self.transcript = transcript
+            self.transcript_id = None
+
+            if config is None:
+                logger.info("对话引擎初始化完成")
+                logger.info(f"最大对话轮次: {self.max_turns}")
+                logger.info(f"上下文token预算: {self.config['system'].get('context_tokens', 2000)}")
+                logger.info(f"参与者: {list(self.models)}")
+                logger.info(f"发言顺序: {self.speaking_policy}")
+                logger.info(f"滚动摘要: {self.summarizer is not None}")
+                logger.info(f"收敛检测: {self.convergence or False}")
+                logger.info(f"讨论记录: {self.transcript.directory if self.transcript else False}")
 
         except Exception as e:
             logger.error(f"初始化失败: {str(e)}")
             raise
 
-    def _get_context(self):
-        """获取最近的上下文"""
-        return "\n".join(self.history[-self.context_window:])
+    def _run_wave(self, wave, prompt, history):
+        """调用一波发言的模型，按波内顺序返回 (模型名, 响应) 列表"""
+        if len(wave) == 1:
+            return [(wave[0], self.models[wave[0]].generate(prompt, history))]
+
+        with ThreadPoolExecutor(max_workers=len(wave)) as pool:
+            futures = [(name, pool.submit(self.models[name].generate, prompt, history))
+                       for name in wave]
+            return [(name, future.result()) for name, future in futures]
+
+    def context_history(self):
+        """请求使用的历史视图：话题 + 滚动摘要 + 尚未折叠的发言，不复制发言记录"""
+        with self._summary_lock:
+            return ContextView(self.history, len(self.history), self.summary,
+                               self.summarized_upto, self.message_cache)
+
+    def append_response(self, model_name, response):
+        """记录一条模型响应，并在后台折叠移出窗口的旧发言"""
+        turn = Turn.create(model_name, response)
+        self.history.append(turn)
+        self._record(turn_record(turn, self.current_turn))
+        self._schedule_summary()
+        return turn
+
+    def _schedule_summary(self):
+        if self.summarizer is None:
+            return
+
+        with self._summary_lock:
+            # 同一时间只有一个折叠任务
+            if self._summary_future is not None and not self._summary_future.done():
+                return
+            upto = len(self.history) - self.summarizer.keep_entries
+            if upto <= self.summarized_upto:
+                return
+            future = self.summarizer.submit(self.summary, self.history[self.summarized_upto:upto])
+            self._summary_future = future
+
+        future.add_done_callback(lambda f: self._apply_summary(f, upto))
+
+    def _apply_summary(self, future, upto):
+        try:
+            summary = future.result()
+        except Exception as e:
+            logger.error(f"滚动摘要失败: {str(e)}")
+            return
+
+        with self._summary_lock:
+            if future is not self._summary_future:
+                # 折叠期间已开始新的讨论或重放了记录，结果属于之前的发言记录
+                return
+            self.summary = summary
+            self.summarized_upto = upto
+        self._record({"type": "summary", "summary": summary, "upto": upto})
+
+    def _record(self, record):
+        if self.transcript is not None and self.transcript_id:
+            self.transcript.append(self.transcript_id, record)
+
+    def replay(self, transcript_id):
+        """从讨论记录重建引擎状态并返回历史记录，不调用任何模型；记录不存在时返回None"""
+        records = self.transcript.read(transcript_id) if self.transcript else None
+        if not records:
+            return None
+        state, _ = rebuild_state(records)
+        with self._summary_lock:
+            self.history = [Turn.from_list(item) for item in state['history']]
+            self.message_cache = MessageCache()
+            self.current_turn = state['current_turn']
+            self.max_turns = state['max_turns']
+            self.summary = state['summary']
+            self.summarized_upto = state['summarized_upto']
+            self._summary_future = None
+        self.transcript_id = transcript_id
+        return self.history
 
-    def start_discussion(self, user_prompt):
-        #logger.info(f"用户发起话题: {user_prompt}")
-        self.history.append(f"用户: {user_prompt}")
+    def start_discussion(self, user_prompt, echo=True, transcript_id=None):
+        """运行一次完整讨论并返回历史记录，echo 为False时不打印发言
 
+        启用讨论记录时每条发言写入 transcript_id（默认随机生成）对应的文件。
+        """
+        logger.debug("用户发起话题: %s", user_prompt)
+        # 每次讨论从新的发言记录开始，与 replay 一样重置全部讨论状态
+        with self._summary_lock:
+            self.history = []
+            self.message_cache = MessageCache()
+            self.summary = ""
+            self.summarized_upto = 1
+            self._summary_future = None
+        if self.transcript is not None:
+            self.transcript_id = transcript_id or uuid.uuid4().hex
+        self.history.append(Turn.create(USER_SPEAKER, user_prompt))
+        self._record(start_record(self.history[-1], self.max_turns, self.models, self.speaking_policy))
+
+        names = list(self.models)
         self.current_turn = 1
-        while self.current_turn <= self.max_turns:
-            #logger.info(f"开始第 {self.current_turn} 轮讨论")
-            turn_responses = []
-
-            for model_name, adapter in self.models.items():
-                context = self._get_context()
-                prompt = f"请基于以下讨论继续发言:\n{context}"
-
-                #logger.info(f"请求 {model_name} 模型...")
-                response = adapter.generate(prompt, self.history)
-                #logger.info(f"{model_name} 响应: {response[:100]}...")
-
-                # 彩色输出不同模型
-                if "DeepSeek" in model_name:
-                    formatted = f"\033[1;32m{model_name}:\033[0m {response}"
-                elif "Doubao" in model_name:
-                    formatted = f"\033[1;35m{model_name}:\033[0m {response}"
-                else:
-                    formatted = f"\033[1;36m{model_name}:\033[0m {response}"
-
-                print(formatted)
-                turn_responses.append(f"{model_name}: {response}")
-
-            self.history.extend(turn_responses)
+        self.converged_at = None
+        self.failures = []
+        while self.current_turn <= self.max_turns and self.converged_at is None:
+            logger.debug("开始第 %d 轮讨论", self.current_turn)
+
+            for wave in self.speaking_policy.waves(names, self.context_history):
+                # 同一波内所有模型使用相同的历史快照
+                history = self.context_history()
+
+                for model_name, response in self._run_wave(wave, DISCUSSION_PROMPT, history):
+                    logger.debug("%s 响应: %.100s...", model_name, response)
+
+                    # 彩色输出不同模型
+                    if echo:
+                        color = SPEAKER_COLORS[names.index(model_name) % len(SPEAKER_COLORS)]
+                        print(f"{color}{model_name}:\033[0m {response}")
+                    self.append_response(model_name, response)
+                    if isinstance(response, ErrorResponse):
+                        self.failures.append(response)
+
+            # 一轮结束后才检查收敛，讨论记录中的轮次都是完整的
+            if self.convergence is not None and self.convergence.converged(self.history):
+                logger.info(f"讨论已收敛，第 {self.current_turn} 轮提前结束")
+                self.converged_at = self.current_turn
             self.current_turn += 1
 
+        record = {"type": "end", "current_turn": self.current_turn, "timestamp": time.time()}
+        if self.converged_at is not None:
+            record["converged"] = True
+        self._record(record)
         return self.history
@@ -0,0 +1,60 @@
+import threading
+
+
+class ChatClient:
+    """单个端点的同步HTTP客户端
+
+    凭据、api_base 和连接池都属于该实例，不读写任何全局状态，
+    因此不同服务商的并发调用不会互相串用密钥或端点。
+    """
+
+    def __init__(self, endpoint):
+        # 创建第一个客户端时才导入 requests，重放、导出等不调用模型的命令不需要
+        import requests
+        from http import cookiejar
+        from requests.adapters import HTTPAdapter
+
+        self.api_base = endpoint['api_base'].rstrip('/')
+        self.timeout = endpoint.get('timeout', 30)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=endpoint.get('pool_per_host', 20))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {endpoint['api_key']}"
+        })
+        # 不保存cookie，使会话在多个线程间共享时没有可变的请求状态
+        self.session.cookies.set_policy(cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+    def post(self, path, payload, stream=False):
+        return self.session.post(f"{self.api_base}{path}", json=payload, stream=stream,
+                                 timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
+
+
+# 进程级客户端注册表，按 (限流分组, api_base, api_key) 区分
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(provider, endpoint):
+    """获取端点的共享客户端，首次使用时创建"""
+    key = (provider, endpoint['api_base'], endpoint['api_key'])
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = ChatClient(endpoint)
+        return client
+
+
+def close_clients():
+    """关闭所有客户端的连接池"""
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
@@ -1,6 +1,10 @@
 from dialogue_engine import DialogueEngine
+from batch_runner import BatchRunner
 from colorama import init, Fore
+from transcript_store import export_markdown
 import argparse
+import logging
+import json
 
 init(autoreset=True)
 
@@ -14,9 +18,29 @@ def main():
     parser = argparse.ArgumentParser(description='多模型对话系统')
     parser.add_argument('--debug', action='store_true', help='启用调试模式')
     parser.add_argument('--topic', type=str, help='直接指定讨论主题')
+    parser.add_argument('--batch', type=str, help='批量模式：话题文件（JSONL或CSV）')
+    parser.add_argument('--output', type=str, default='results.jsonl', help='批量模式的结果文件')
+    parser.add_argument('--checkpoint', type=str, help='批量模式的检查点文件（默认为结果文件名加.ckpt）')
+    parser.add_argument('--concurrency', type=int, default=8, help='批量模式同时运行的讨论数')
+    parser.add_argument('--max-turns', type=int, help='覆盖配置中的最大对话轮次')
+    parser.add_argument('--replay', type=str, help='从讨论记录重放指定ID的讨论，不调用模型')
+    parser.add_argument('--export', type=str, help='导出指定ID的讨论记录')
+    parser.add_argument('--format', choices=['markdown', 'jsonl'], default='markdown', help='导出格式')
     args = parser.parse_args()
 
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    if args.batch:
+        run_batch(args)
+        return
+
     engine = DialogueEngine()
+    if args.replay or args.export:
+        run_transcript(engine, args)
+        return
+    if args.max_turns:
+        engine.max_turns = args.max_turns
 
     try:
         while True:
@@ -39,6 +63,11 @@ def main():
             print(Fore.YELLOW + "完整讨论记录:")
             for i, entry in enumerate(history):
                 print(f"{i + 1}. {entry}")
+            print_cache_usage(engine)
+            if engine.converged_at is not None:
+                print(Fore.YELLOW + f"讨论已收敛，第 {engine.converged_at} 轮提前结束（共 {engine.max_turns} 轮）")
+            if engine.transcript_id:
+                print(Fore.YELLOW + f"讨论记录ID: {engine.transcript_id}（--replay 或 --export 查看）")
             print(Fore.CYAN + "=" * 60)
 
             if args.debug:  # 调试模式下只运行一次
@@ -48,6 +77,59 @@ def main():
         print(Fore.RED + "\n操作已中断")
     except Exception as e:
         print(Fore.RED + f"发生错误: {str(e)}")
+    finally:
+        if engine.transcript is not None:
+            engine.transcript.close()
+
+
+def print_cache_usage(engine):
+    """输出各模型累计的输入token数和命中服务商前缀缓存的比例"""
+    for name in engine.models:
+        usage = engine.models[name].usage
+        if usage["prompt_tokens"]:
+            print(Fore.YELLOW + f"{name} 输入token: {usage['prompt_tokens']}，前缀缓存命中: "
+                                f"{usage['cached_tokens']} ({usage['cached_tokens'] / usage['prompt_tokens']:.0%})")
+
+
+def run_transcript(engine, args):
+    """重放或导出已保存的讨论记录"""
+    if engine.transcript is None:
+        print(Fore.RED + "未启用讨论记录（system.transcripts.enabled）")
+        return
+
+    transcript_id = args.replay or args.export
+    records = engine.transcript.read(transcript_id)
+    if not records:
+        print(Fore.RED + f"讨论记录不存在: {transcript_id}")
+        return
+
+    if args.export:
+        if args.format == 'jsonl':
+            for record in records:
+                print(json.dumps(record, ensure_ascii=False))
+        else:
+            print(export_markdown(records))
+        return
+
+    history = engine.replay(transcript_id)
+    print(Fore.YELLOW + f"重放讨论记录: {transcript_id}")
+    for i, entry in enumerate(history):
+        print(f"{i + 1}. {entry}")
+
+
+def run_batch(args):
+    """批量运行话题文件中的所有讨论"""
+    runner = BatchRunner(concurrency=args.concurrency, max_turns=args.max_turns)
+    try:
+        succeeded, failed, skipped = runner.run(args.batch, args.output, args.checkpoint)
+    except KeyboardInterrupt:
+        print(Fore.RED + "\n操作已中断，重新运行相同命令即可从检查点继续")
+        return
+
+    print(Fore.CYAN + "=" * 60)
+    print(Fore.GREEN + f"批量运行完成：成功 {succeeded}，失败 {failed}，跳过 {skipped}")
+    print(Fore.YELLOW + f"结果文件: {args.output}")
+    print(Fore.CYAN + "=" * 60)
 
 
 if __name__ == "__main__":
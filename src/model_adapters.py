@@ -1,107 +1,158 @@
-import openai
-import requests
-import json
-import time
-from qianfan import ChatCompletion
+import logging
+import threading
+from context_builder import ContextBuilder, estimate_tokens
+from rate_limiter import get_scheduler
+from http_client import get_client
+
+logger = logging.getLogger("ModelAdapter")
+
+
+class ErrorResponse(str):
+    """调用失败时返回的错误说明，调用方可用 isinstance 识别；与降级响应一样不能当作模型输出使用"""
+    is_fallback = True
+
+
+def cached_prompt_tokens(usage):
+    """服务商用量中命中前缀缓存的输入token数
+
+    DeepSeek 返回 prompt_cache_hit_tokens，OpenAI 兼容接口（豆包、文心等）返回
+    prompt_tokens_details.cached_tokens，未返回时为0。
+    """
+    if not usage:
+        return 0
+    if usage.get('prompt_cache_hit_tokens') is not None:
+        return usage['prompt_cache_hit_tokens']
+    return (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
 
 
 class BaseModelAdapter:
-    def __init__(self, config):
-        self.config = config
-        self.last_call_time = 0
+    # 子类或配置覆盖：发言者名称、调用方式
+    name = None
+    client = "http"  # http: 每个端点独立的客户端和连接池; openai: 使用openai SDK
 
-    def _rate_limit(self):
+    def __init__(self, config, context_builder=None):
+        self.config = config
+        self.name = config.get('name') or self.name
+        self.client = config.get('client', self.client)
+        # 可选的角色设定，作为系统消息发送
+        self.persona = config.get('persona')
+        # 限流分组，默认每个发言者一组；provider 相同的参与者共享额度
+        self.provider = config.get('provider') or self.name
+        # 同一服务商的所有适配器实例共享限流调度器
+        self.scheduler = get_scheduler(self.provider, config)
+        # 按token预算构建上下文
+        self.context_builder = context_builder or ContextBuilder()
+        # 服务商返回的输入token用量，cached_tokens 为命中前缀缓存的部分
+        self.usage = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0}
+        self._usage_lock = threading.Lock()
+
+    def _api_key_missing(self):
+        """检查API密钥是否未配置"""
+        return not self.config.get('api_key')
+
+    def _build_messages(self, prompt, history):
+        """构建消息列表，prompt 为发言指令，历史按token预算裁剪"""
+        messages = self.context_builder.build(self.name, prompt, history)
+        if self.persona:
+            messages.insert(0, {"role": "system", "content": self.persona})
+        return messages
+
+    def _record_usage(self, usage):
+        if not usage:
+            return
+        with self._usage_lock:
+            self.usage["calls"] += 1
+            self.usage["prompt_tokens"] += usage.get('prompt_tokens') or 0
+            self.usage["cached_tokens"] += cached_prompt_tokens(usage)
+
+    def _rate_limit(self, messages):
         """API调用速率限制"""
-        current_time = time.time()
-        if current_time - self.last_call_time < 1.5:  # 1.5秒间隔
-            time.sleep(1.5 - (current_time - self.last_call_time))
-        self.last_call_time = time.time()
-
-    def generate(self, prompt, history):
-        raise NotImplementedError
+        self.scheduler.acquire(self._estimate_tokens(messages))
 
+    def _estimate_tokens(self, messages):
+        """估算一次调用消耗的token数（输入消息加上输出预留）"""
+        return sum(estimate_tokens(message['content']) for message in messages) + 200
 
-class DeepSeekAdapter(BaseModelAdapter):
     def generate(self, prompt, history):
-        self._rate_limit()
+        messages = self._build_messages(prompt, history)
+        self._rate_limit(messages)
         try:
-            openai.api_key = self.config['api_key']
-            openai.api_base = self.config['api_base']
-
-            messages = [{"role": "user", "content": msg} for msg in history]
-            messages.append({"role": "user", "content": prompt})
-
-            response = openai.ChatCompletion.create(
-                model=self.config['model'],
-                messages=messages,
-                temperature=self.config.get('temperature', 0.7)
-            )
-            return response['choices'][0]['message']['content'].strip()
+            if self.client == "openai":
+                return self._complete_openai(messages)
+            return self._complete_http(messages)
         except Exception as e:
-            return f"[DeepSeek Error] {str(e)}"
+            logger.error(f"{self.name} API调用失败: {str(e)}")
+            return ErrorResponse(f"[{self.name} Error] {str(e)}")
 
+    def _complete_openai(self, messages):
+        # SDK 导入较慢，只在 client: openai 的适配器首次调用时导入
+        import openai
 
-class DoubaoAdapter(BaseModelAdapter):
-    def generate(self, prompt, history):
-        self._rate_limit()
-        try:
-            # 更新为豆包官方API格式
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.config['api_key']}"
-            }
-
-            # 构建符合豆包API的消息格式
-            messages = []
-            for msg in history:
-                if ": " in msg:
-                    role, content = msg.split(": ", 1)
-                    messages.append({
-                        "role": "user" if role == "用户" else "assistant",
-                        "content": content
-                    })
-
-            messages.append({"role": "user", "content": prompt})
-
-            data = {
-                "model": self.config['model'],
-                "messages": messages,
-                "temperature": self.config.get('temperature', 0.7)
-            }
-
-            # 使用正确的豆包API端点
-            response = requests.post(
-                f"{self.config['api_base']}/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
-
-            # 调试输出
-            #print(f"豆包响应状态码: {response.status_code}")
-            #print(f"豆包响应内容: {response.text[:200]}...")
-
-            response_data = response.json()
-            return response_data['choices'][0]['message']['content'].strip()
-        except Exception as e:
-            return f"[Doubao Error] {str(e)}"
+        # 按请求传入凭据，避免并发调用时互相覆盖全局配置；SDK 的连接池按线程共享
+        response = openai.ChatCompletion.create(
+            api_key=self.config['api_key'],
+            api_base=self.config['api_base'],
+            model=self.config['model'],
+            messages=messages,
+            temperature=self.config.get('temperature', 0.7)
+        )
+        self._record_usage(response.get('usage'))
+        return response['choices'][0]['message']['content'].strip()
 
+    def _complete_http(self, messages):
+        data = {
+            "model": self.config['model'],
+            "messages": messages,
+            "temperature": self.config.get('temperature', 0.7)
+        }
 
-class WenxinAdapter(BaseModelAdapter):
-    def generate(self, prompt, history):
-        self._rate_limit()
-        try:
-            openai.api_key = self.config['api_key']
-            openai.api_base = self.config['api_base']
-
-            messages = [{"role": "user", "content": msg} for msg in history]
-            messages.append({"role": "user", "content": prompt})
-
-            response = openai.ChatCompletion.create(
-                model=self.config['model'],
-                messages=messages,
-                temperature=self.config.get('temperature', 0.7)
-            )
-            return response['choices'][0]['message']['content'].strip()
-        except Exception as e:
-            return f"[Wenxin Error] {str(e)}"
+        # 每个端点独立的客户端和连接池，凭据不经过任何全局状态
+        response = get_client(self.provider, self.config).post("/chat/completions", data)
+
+        logger.debug("%s 响应状态码: %d", self.name, response.status_code)
+        logger.debug("%s 响应内容: %.200s...", self.name, response.text)
+
+        response_data = response.json()
+        self._record_usage(response_data.get('usage'))
+        return response_data['choices'][0]['message']['content'].strip()
+
+
+# 适配器类型注册表：model_configs 中的 type -> 适配器类
+ADAPTER_TYPES = {}
+
+
+def register_adapter(type_name):
+    """注册适配器类型，接口不兼容OpenAI的服务商可以继承 BaseModelAdapter 后注册"""
+    def decorator(adapter_class):
+        ADAPTER_TYPES[type_name] = adapter_class
+        return adapter_class
+    return decorator
+
+
+def get_adapter_class(key, model_config):
+    """查找模型配置对应的适配器类：优先使用 type，其次按配置键匹配内置服务商，否则使用通用适配器"""
+    type_name = model_config.get('type') or (key if key in ADAPTER_TYPES else "openai")
+    try:
+        return ADAPTER_TYPES[type_name]
+    except KeyError:
+        raise ValueError(f"未知的适配器类型: {type_name}")
+
+
+@register_adapter("openai")
+class OpenAICompatibleAdapter(BaseModelAdapter):
+    """通用的OpenAI兼容适配器，名称、端点、调用方式和角色设定全部来自配置"""
+
+
+@register_adapter("deepseek")
+class DeepSeekAdapter(OpenAICompatibleAdapter):
+    name = "DeepSeek"
+
+
+@register_adapter("doubao")
+class DoubaoAdapter(OpenAICompatibleAdapter):
+    name = "Doubao"
+
+
+@register_adapter("wenxin")
+class WenxinAdapter(OpenAICompatibleAdapter):
+    name = "Wenxin"
@@ -0,0 +1,122 @@
+import threading
+import time
+
+
+class TokenBucketScheduler:
+    """单个服务商的令牌桶调度器，同时限制每秒请求数(RPS)和每分钟token数(TPM)
+
+    调用方先预约额度，桶允许透支：透支部分换算成等待时间返回给调用方，
+    后到的请求排在先到请求之后，因此整体按FIFO顺序放行。
+    """
+
+    def __init__(self, name, rps=5.0, burst=None, tpm=None):
+        self.name = name
+        self.rps = float(rps)
+        self.burst = float(burst or max(1.0, self.rps))
+        self.tpm = float(tpm) if tpm else None
+
+        self._lock = threading.Lock()
+        self._request_tokens = self.burst
+        self._tpm_tokens = self.tpm or 0.0
+        self._last_refill = time.monotonic()
+
+        # 统计信息
+        self._pending = 0
+        self._requests = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_tokens = min(self.burst, self._request_tokens + elapsed * self.rps)
+        if self.tpm:
+            self._tpm_tokens = min(self.tpm, self._tpm_tokens + elapsed * self.tpm / 60.0)
+
+    def reserve(self, tokens=0):
+        """预约一次调用，返回需要等待的秒数（不阻塞）"""
+        with self._lock:
+            self._refill(time.monotonic())
+
+            self._request_tokens -= 1
+            wait = max(0.0, -self._request_tokens / self.rps)
+
+            if self.tpm and tokens:
+                self._tpm_tokens -= tokens
+                wait = max(wait, -self._tpm_tokens / (self.tpm / 60.0))
+
+            self._requests += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+            return wait
+
+    def try_acquire(self, tokens=0):
+        """额度充足时立即占用并返回True，否则不占用额度直接返回False"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._request_tokens < 1:
+                return False
+            if self.tpm and tokens and self._tpm_tokens < tokens:
+                return False
+
+            self._request_tokens -= 1
+            if self.tpm and tokens:
+                self._tpm_tokens -= tokens
+            self._requests += 1
+            return True
+
+    def acquire(self, tokens=0):
+        """同步获取调用额度"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            self._track_pending(1)
+            try:
+                time.sleep(wait)
+            finally:
+                self._track_pending(-1)
+        return wait
+
+    def _track_pending(self, delta):
+        with self._lock:
+            self._pending += delta
+
+    def stats(self):
+        """返回排队深度和等待时间统计"""
+        with self._lock:
+            return {
+                "provider": self.name,
+                "rps": self.rps,
+                "tpm": self.tpm,
+                "queue_depth": self._pending,
+                "requests": self._requests,
+                "total_wait": round(self._total_wait, 3),
+                "avg_wait": round(self._total_wait / self._requests, 3) if self._requests else 0.0,
+                "max_wait": round(self._max_wait, 3)
+            }
+
+
+# 进程级调度器注册表，每个服务商一个
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(name, config):
+    """获取服务商的共享调度器，首次使用时按配置创建"""
+    with _schedulers_lock:
+        scheduler = _schedulers.get(name)
+        if scheduler is None:
+            scheduler = TokenBucketScheduler(
+                name,
+                rps=config.get('rps', 5.0),
+                burst=config.get('burst'),
+                tpm=config.get('tpm')
+            )
+            _schedulers[name] = scheduler
+        return scheduler
+
+
+def scheduler_stats():
+    """返回所有服务商调度器的统计信息"""
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return {scheduler.name: scheduler.stats() for scheduler in schedulers}
@@ -0,0 +1,123 @@
+class WavePolicy:
+    """按配置顺序分波发言：每波 wave_size 个模型并发调用，同一波使用相同的历史快照
+
+    wave_size 为1时即依次轮流发言（round_robin），为None时一轮只有一波（parallel）。
+    """
+
+    def __init__(self, wave_size=1):
+        self.wave_size = wave_size
+
+    def waves(self, names, context, start=0):
+        """一轮内从第 start 位开始的发言波次，context() 返回当前的历史视图；每次产出一波发言的模型名列表"""
+        size = self.wave_size or len(names)
+        for i in range(start, len(names), size):
+            yield names[i:i + size]
+
+    def next_speaker(self, names, index, context):
+        """逐条发言时（/next）本轮第 index 位发言的模型"""
+        return names[index % len(names)]
+
+    def __str__(self):
+        return "round_robin" if self.wave_size == 1 else f"parallel(wave_size={self.wave_size or 'all'})"
+
+
+class ModeratorPolicy(WavePolicy):
+    """由主持模型根据讨论进展选择下一位发言者
+
+    每轮仍有 len(names) 个发言位置，上一波的发言者不会被连续选中；
+    未配置主持模型、主持模型不可用或回复中没有参与者名称时，选择最久未发言的参与者。
+    """
+
+    def __init__(self, moderator=None, wave_size=1):
+        super().__init__(wave_size or 1)
+        self.moderator = moderator
+
+    def __str__(self):
+        return f"moderator({self.moderator.name if self.moderator else 'least_recent'})"
+
+    def waves(self, names, context, start=0):
+        remaining = len(names) - start
+        previous = ()
+        while remaining > 0:
+            count = min(self.wave_size, remaining)
+            candidates = [name for name in names if name not in previous]
+            if len(candidates) < count:
+                candidates = list(names)
+            wave = self.select(candidates, count, context())
+            remaining -= len(wave)
+            previous = wave
+            yield wave
+
+    def next_speaker(self, names, index, context):
+        history = context()
+        last = history.turns[history.end - 1].speaker if history.end > 1 else None
+        candidates = [name for name in names if name != last] or list(names)
+        return self.select(candidates, 1, history)[0]
+
+    def select(self, candidates, count, history):
+        """从 candidates 中选出 count 位发言者"""
+        chosen = []
+        if self.moderator is not None and not self.moderator._api_key_missing():
+            prompt = (
+                f"你是这场讨论的主持人。参与者: {'、'.join(candidates)}。"
+                f"请根据讨论进展选出接下来最应该发言的{count}位参与者，只输出名字。"
+            )
+            try:
+                result = self.moderator.generate(prompt, history)
+            except Exception:
+                result = None
+            # 主持模型降级时的模拟响应不能作为选择结果
+            if result and not getattr(result, 'is_fallback', False):
+                chosen = self._parse(result, candidates, count)
+
+        for name in self._least_recent(candidates, history):
+            if len(chosen) >= count:
+                break
+            if name not in chosen:
+                chosen.append(name)
+        return chosen
+
+    @staticmethod
+    def _parse(text, candidates, count):
+        """按出现位置提取回复中的参与者名称，同一位置优先匹配较长的名称"""
+        matches = sorted((text.find(name), -len(name), name) for name in candidates if name in text)
+        chosen = []
+        covered = -1
+        for position, negative_length, name in matches:
+            if position < covered:
+                continue
+            chosen.append(name)
+            covered = position - negative_length
+            if len(chosen) == count:
+                break
+        return chosen
+
+    @staticmethod
+    def _least_recent(candidates, history):
+        """按最近一次发言的先后排序，从未发言的参与者排在最前"""
+        last_spoken = {}
+        for index in range(history.end - 1, 0, -1):
+            speaker = history.turns[index].speaker
+            if speaker in candidates and speaker not in last_spoken:
+                last_spoken[speaker] = index
+                if len(last_spoken) == len(candidates):
+                    break
+        return sorted(candidates, key=lambda name: last_spoken.get(name, -1))
+
+
+def create_speaking_policy(system_config, models):
+    """根据 system.speaking_order 配置创建发言顺序策略
+
+    未配置时兼容旧的 parallel_turns 开关。
+    """
+    order_config = system_config.get('speaking_order') or {}
+    policy = order_config.get('policy') or ("parallel" if system_config.get('parallel_turns') else "round_robin")
+    wave_size = order_config.get('wave_size')
+
+    if policy == "round_robin":
+        return WavePolicy(wave_size or 1)
+    if policy == "parallel":
+        return WavePolicy(wave_size)
+    if policy == "moderator":
+        return ModeratorPolicy(models.get(order_config.get('moderator')), wave_size)
+    raise ValueError(f"未知的发言顺序策略: {policy}")
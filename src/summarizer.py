@@ -0,0 +1,65 @@
+from concurrent.futures import ThreadPoolExecutor
+from context_builder import estimate_tokens, first_sentence
+
+# 摘要折叠在后台线程中执行，不占用生成响应的关键路径
+_summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summarizer")
+
+
+class RollingSummarizer:
+    """增量滚动摘要：把移出窗口的旧发言折叠进一份固定大小的摘要
+
+    每次只处理新移出的发言，已有摘要作为输入的一部分，
+    因此单次折叠的开销与讨论总长度无关。
+    """
+
+    def __init__(self, keep_entries=6, summary_tokens=400, adapter=None):
+        self.keep_entries = keep_entries
+        self.summary_tokens = summary_tokens
+        # 可选：用指定模型生成摘要，未配置时使用本地抽取式摘要
+        self.adapter = adapter
+
+    def fold(self, summary, entries):
+        """把新移出的发言（Turn 列表）合并进已有摘要"""
+        if self.adapter is not None and not self.adapter._api_key_missing():
+            return self._fold_with_model(summary, entries)
+        return self._fold_extractive(summary, entries)
+
+    def submit(self, summary, entries):
+        """在后台线程中折叠，返回 Future"""
+        return _summary_executor.submit(self.fold, summary, entries)
+
+    def _fold_extractive(self, summary, entries):
+        lines = summary.split("\n") if summary else []
+        for turn in entries:
+            lines.append(f"{turn.speaker}: {first_sentence(turn.text)}")
+
+        # 超出预算时丢弃最早的摘要行
+        total = sum(estimate_tokens(line) + 1 for line in lines)
+        while lines and total > self.summary_tokens:
+            total -= estimate_tokens(lines.pop(0)) + 1
+        return "\n".join(lines)
+
+    def _fold_with_model(self, summary, entries):
+        prompt = (
+            f"请把已有摘要和新增发言合并成一份不超过{self.summary_tokens}字的讨论摘要，"
+            f"保留各方的主要观点和分歧，只输出摘要正文。\n"
+            f"已有摘要:\n{summary or '无'}\n"
+            f"新增发言:\n" + "\n".join(str(turn) for turn in entries)
+        )
+        result = self.adapter.generate(prompt, [])
+        if getattr(result, 'is_fallback', False):
+            # 模型不可用时不能把模拟响应当作摘要
+            return self._fold_extractive(summary, entries)
+        return result.strip()
+
+
+def create_summarizer(system_config, models):
+    """根据 system.rolling_summary 配置创建摘要器，未启用时返回None"""
+    summary_config = system_config.get('rolling_summary') or {}
+    if not summary_config.get('enabled'):
+        return None
+    return RollingSummarizer(
+        keep_entries=summary_config.get('keep_entries', 6),
+        summary_tokens=summary_config.get('summary_tokens', 400),
+        adapter=models.get(summary_config.get('model'))
+    )
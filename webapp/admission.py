@@ -0,0 +1,208 @@
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from rate_limiter import worker_count
+
+
+class Overloaded(Exception):
+    """超出准入上限，status 为 429（会话数）或 503（服务商排队已满或等待超时）"""
+
+    def __init__(self, message, status=503, retry_after=1):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class ProviderGate:
+    """单个服务商的在途调用上限和有界等待队列
+
+    同时进行的调用最多 max_in_flight 个，其余按到达顺序排队；排队人数达到 max_queue
+    或等待超过 queue_timeout 秒时立即抛出 Overloaded，而不是无限堆积在慢服务商上。
+    线程和异步任务共用同一个队列，释放的名额直接交给队首的等待者。
+    """
+
+    def __init__(self, name, max_in_flight=16, max_queue=32, queue_timeout=10.0):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiters = deque()  # 等待者被唤醒时已经获得名额
+        self._hold_time = None   # 每次占用时长的指数移动平均，用于估算 Retry-After
+
+        # 统计信息
+        self._admitted = 0
+        self._rejected = 0
+
+    def configure(self, max_in_flight=16, max_queue=32, queue_timeout=10.0):
+        """重新加载配置时更新上限；在途数超出新上限的调用照常完成，名额扩大时立即放行排队的请求"""
+        with self._lock:
+            self.max_in_flight = max_in_flight
+            self.max_queue = max_queue
+            self.queue_timeout = queue_timeout
+            while self._waiters and self._in_flight < self.max_in_flight:
+                self._in_flight += 1
+                self._admitted += 1
+                self._waiters.popleft()()
+
+    def _try_enter(self, wake):
+        """有空闲名额时占用并返回True；否则排队并返回False，队列已满时抛出 Overloaded"""
+        with self._lock:
+            if self._in_flight < self.max_in_flight and not self._waiters:
+                self._in_flight += 1
+                self._admitted += 1
+                return True
+            if len(self._waiters) >= self.max_queue:
+                self._rejected += 1
+                raise Overloaded(f"{self.name} 排队请求过多", 503, self._retry_after())
+            self._waiters.append(wake)
+            return False
+
+    def check(self):
+        """排队已满时立即抛出 Overloaded，不占用名额；流式响应在发送响应头之前用它快速失败"""
+        with self._lock:
+            if self._in_flight >= self.max_in_flight and len(self._waiters) >= self.max_queue:
+                self._rejected += 1
+                raise Overloaded(f"{self.name} 排队请求过多", 503, self._retry_after())
+
+    def _give_up(self, wake):
+        """等待超时或被取消：仍在队列中时移出并返回True；已被唤醒（已获得名额）时返回False"""
+        with self._lock:
+            try:
+                self._waiters.remove(wake)
+            except ValueError:
+                return False
+            self._rejected += 1
+            return True
+
+    def release(self, held):
+        with self._lock:
+            self._hold_time = held if self._hold_time is None else 0.8 * self._hold_time + 0.2 * held
+            if self._waiters:
+                # 名额直接交给队首，在途数不变
+                self._admitted += 1
+                self._waiters.popleft()()
+            else:
+                self._in_flight -= 1
+
+    def _retry_after(self):
+        # 调用方需持有 self._lock；按平均占用时长估算排在队尾的请求需要等待的秒数
+        hold = self._hold_time or 1.0
+        return max(1, math.ceil(hold * (len(self._waiters) + 1) / self.max_in_flight))
+
+    def _timeout_error(self):
+        with self._lock:
+            return Overloaded(f"{self.name} 排队等待超时", 503, self._retry_after())
+
+    @contextmanager
+    def slot(self):
+        """占用一个调用名额，排队已满或等待超时时抛出 Overloaded"""
+        event = threading.Event()
+        if not self._try_enter(event.set):
+            if not event.wait(self.queue_timeout) and self._give_up(event.set):
+                raise self._timeout_error()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    @asynccontextmanager
+    async def aslot(self):
+        """slot 的异步版本，排队期间不占用线程"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        if not self._try_enter(wake):
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if not self._give_up(wake):
+                    # 超时的同时已被唤醒，名额需要归还
+                    self.release(0.0)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                raise self._timeout_error()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "provider": self.name,
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self._in_flight,
+                "queued": len(self._waiters),
+                "admitted": self._admitted,
+                "rejected": self._rejected
+            }
+
+
+# 进程级准入闸门注册表，每个服务商（限流分组）一个
+_gates = {}
+_gates_lock = threading.Lock()
+
+
+def get_provider_gate(provider, system_config, model_config, reconfigure=False):
+    """获取服务商的共享准入闸门，未启用 system.admission 时返回None
+
+    模型配置中的 max_in_flight 优先于 system.admission 中的默认值，首次创建时生效；
+    reconfigure 为True时（重新加载配置）按新配置更新已有闸门。
+    多进程部署时在途数和排队数上限按进程数均分（向上取整），整体上限与单进程一致。
+    """
+    admission = system_config.get('admission') or {}
+    if not admission.get('enabled'):
+        return None
+    workers = worker_count()
+    max_in_flight = model_config.get('max_in_flight', admission.get('max_in_flight', 16))
+    limits = {
+        "max_in_flight": math.ceil(max_in_flight / workers),
+        "max_queue": math.ceil(admission.get('max_queue', 32) / workers),
+        "queue_timeout": admission.get('queue_timeout', 10.0)
+    }
+    with _gates_lock:
+        gate = _gates.get(provider)
+        if gate is None:
+            gate = _gates[provider] = ProviderGate(provider, **limits)
+        elif reconfigure:
+            gate.configure(**limits)
+        return gate
+
+
+def admission_stats():
+    """返回所有服务商闸门的在途和排队统计"""
+    with _gates_lock:
+        gates = list(_gates.values())
+    return {gate.name: gate.stats() for gate in gates}
+
+
+def session_limit(system_config):
+    """启用准入控制时的 system.admission.max_sessions，未限制时返回None"""
+    admission = system_config.get('admission') or {}
+    if admission.get('enabled') and admission.get('max_sessions'):
+        return admission['max_sessions']
+    return None
+
+
+def session_overloaded(system_config):
+    """会话数达到上限时返回的 429 错误"""
+    admission = system_config.get('admission') or {}
+    return Overloaded("当前讨论过多，请稍后再试", 429, admission.get('session_retry_after', 30))
+
+
+def check_session_limit(system_config, active_sessions):
+    """会话数达到 system.admission.max_sessions 时抛出 429"""
+    max_sessions = session_limit(system_config)
+    if max_sessions is not None and active_sessions >= max_sessions:
+        raise session_overloaded(system_config)
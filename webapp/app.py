@@ -1,15 +1,80 @@
-from flask import Flask, render_template, request, jsonify
-from dialogue_engine import DialogueEngine
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g
+from dialogue_engine import get_engine_registry
+from rate_limiter import scheduler_stats
+from resilience import FallbackResponse, resilience_stats
+from admission import Overloaded, admission_stats, check_session_limit, session_limit, session_overloaded
+from http_client import close_clients
+from session_store import create_session_store
+from turn_pipeline import TurnPipeline, create_pipeline_pool
+from transcript_store import rebuild_state, export_markdown
+from metrics import HTTP_DURATION, collect_calls, collect_stream, timing_breakdown, render_metrics
+from logging.handlers import QueueHandler, QueueListener
 import uuid
+import json
 import time
+import queue
+import atexit
+import logging
+import threading
+import contextvars
 from datetime import timedelta
 
 app = Flask(__name__, static_folder='static', template_folder='templates')
 app.secret_key = 'your_very_strong_secret_key_here'
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=1)
 
-# 会话存储
-sessions = {}
+# 配置和模型适配器在进程内只创建一次
+engine_registry = get_engine_registry()
+
+logger = logging.getLogger("WebApp")
+
+
+def _setup_logging(level):
+    """日志经队列交给后台线程输出，请求线程不会阻塞在终端或文件写入上"""
+    root = logging.getLogger()
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *root.handlers, respect_handler_level=True)
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+
+
+_setup_logging(engine_registry.config['system'].get('log_level', 'INFO'))
+atexit.register(close_clients)
+if engine_registry.transcript is not None:
+    atexit.register(engine_registry.transcript.close)
+
+# 会话存储：只保存可序列化的对话状态，引擎在每次请求时按状态重建
+session_store = create_session_store(engine_registry.config['system'])
+
+
+def _save_summary(state):
+    """后台滚动摘要完成时写回会话存储（请求通常已保存会话）；会话的讨论记录ID即会话ID"""
+    session_store.update_summary(state.transcript_id, state.summary, state.summarized_upto)
+
+
+engine_registry.on_summary = _save_summary
+
+# 可选：后台预先生成后续发言，/next 只取出已完成的结果
+pipeline_pool = create_pipeline_pool(engine_registry.config['system'])
+pipeline_lookahead = (engine_registry.config['system'].get('pipelining') or {}).get('lookahead', 1)
+# 推送通道等待服务商响应期间发送心跳注释的间隔（秒），防止代理断开长时间没有数据的连接
+events_heartbeat = engine_registry.config['system'].get('events_heartbeat', 15)
+
+
+@app.before_request
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def _record_duration(response):
+    start = g.get('request_start')
+    if start is not None:
+        HTTP_DURATION.observe(time.perf_counter() - start, request.endpoint or "unknown",
+                              response.status_code)
+    return response
 
 
 @app.route('/')
@@ -23,6 +88,55 @@ def health_check():
     return jsonify({"status": "ok", "timestamp": time.time()})
 
 
+@app.route('/rate_limits')
+def rate_limits():
+    """各服务商限流队列深度与等待时间"""
+    return jsonify(scheduler_stats())
+
+
+@app.route('/resilience')
+def resilience():
+    """熔断器状态、对冲次数和模拟响应降级次数"""
+    return jsonify(resilience_stats())
+
+
+@app.route('/admission')
+def admission():
+    """当前会话数和各服务商的在途调用、排队和拒绝次数"""
+    return jsonify(_admission_payload())
+
+
+def _admission_payload():
+    config = engine_registry.config['system'].get('admission') or {}
+    return {
+        "enabled": bool(config.get('enabled')),
+        "sessions": len(session_store),
+        "max_sessions": config.get('max_sessions'),
+        "providers": admission_stats()
+    }
+
+
+def _overloaded(e):
+    """过载时的快速失败响应，Retry-After 为建议的重试秒数"""
+    return (jsonify({"error": str(e), "retry_after": e.retry_after}), e.status,
+            {'Retry-After': str(e.retry_after)})
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus 格式的调用耗时、token用量和降级统计"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    """响应缓存命中统计"""
+    cache = engine_registry.cache
+    if cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(cache.stats(), enabled=True))
+
+
 @app.route('/keepalive', methods=['POST'])
 def keep_alive():
     """会话保活接口"""
@@ -30,8 +144,7 @@ def keep_alive():
         data = request.json
         session_id = data.get('session_id')
 
-        if session_id and session_id in sessions:
-            sessions[session_id]['last_active'] = time.time()
+        if session_id and session_store.touch(session_id):
             return jsonify({"status": "ok", "message": "会话已更新"})
         else:
             return jsonify({"error": "会话不存在"}), 404
@@ -42,152 +155,757 @@ def keep_alive():
 @app.route('/start', methods=['POST'])
 def start_discussion():
     try:
-        data = request.json
-        topic = data.get('topic', '').strip()
-        max_turns = data.get('max_turns', 5)
+        payload, status = _create_session(request.json)
+        return jsonify(payload), status
 
-        print(f"[DEBUG] 收到启动请求，主题: '{topic}'")
-        print(f"[DEBUG] 最大轮次: {max_turns}")
+    except Overloaded as e:
+        logger.warning(f"拒绝启动讨论: {str(e)}")
+        return _overloaded(e)
+    except Exception as e:
+        logger.error(f"启动讨论失败: {str(e)}")
+        return jsonify({"error": f"启动失败: {str(e)}"}), 500
 
-        if not topic:
-            return jsonify({"error": "主题不能为空"}), 400
 
-        if not isinstance(max_turns, int) or max_turns < 1 or max_turns > 10:
-            return jsonify({"error": "讨论轮数必须在1-10之间"}), 400
+def _create_session(data):
+    """校验启动参数并创建会话，返回 (响应内容, 状态码)"""
+    topic = data.get('topic', '').strip()
+    max_turns = data.get('max_turns', 5)
 
-        # 创建新会话
-        session_id = str(uuid.uuid4())
-        engine = DialogueEngine()
+    logger.debug("收到启动请求，主题: '%s'", topic)
+    logger.debug("最大轮次: %s", max_turns)
+
+    if not topic:
+        return {"error": "主题不能为空"}, 400
 
-        # 设置自定义轮次
-        engine.max_turns = max_turns
-        engine.start_session(topic)
+    max_turns_limit = engine_registry.config['system'].get('max_turns_limit', 10)
+    if not isinstance(max_turns, int) or max_turns < 1 or max_turns > max_turns_limit:
+        return {"error": f"讨论轮数必须在1-{max_turns_limit}之间"}, 400
+
+    # 顺带清理过期会话，存储按过期时间索引，只会访问已过期的记录
+    expired = session_store.expire()
+    if expired:
+        logger.debug("清理过期会话: %d 个", expired)
+    if pipeline_pool is not None:
+        pipeline_pool.expire()
+    # 先按当前会话数快速拒绝，避免为注定被拒绝的请求创建讨论记录；上限以下面的原子写入为准
+    system_config = engine_registry.config['system']
+    check_session_limit(system_config, len(session_store))
 
-        sessions[session_id] = {
-            'engine': engine,
-            'topic': topic,
-            'created_at': time.time(),
-            'last_active': time.time(),
-            'current_model_index': 0  # 当前模型索引
-        }
+    # 创建新会话
+    session_id = str(uuid.uuid4())
+    engine = engine_registry.create_engine()
 
-        print(f"[DEBUG] 会话创建成功，ID: {session_id}")
-        print(f"[DEBUG] 可用模型: {list(engine.models.keys())}")
-        print(f"[DEBUG] 最大轮次: {engine.max_turns}")
+    # 设置自定义轮次
+    engine.max_turns = max_turns
+    engine.start_session(topic, session_id)
 
-        return jsonify({
-            "session_id": session_id,
-            "models": list(engine.models.keys()),
-            "max_turns": engine.max_turns,
-            "topic": topic
-        })
+    added = session_store.add(session_id, {
+        'state': engine.state,
+        'topic': topic,
+        'created_at': time.time(),
+        'last_active': time.time(),
+        'current_model_index': 0  # 当前模型索引
+    }, session_limit(system_config))
+    if not added:
+        # 其他请求同时创建会话后达到了上限
+        engine.finish_session()
+        raise session_overloaded(system_config)
+
+    if pipeline_pool is not None:
+        _start_pipeline(session_id)
+
+    logger.debug("会话创建成功，ID: %s", session_id)
+    logger.debug("可用模型: %s", list(engine.models.keys()))
+    logger.debug("最大轮次: %d", engine.max_turns)
+
+    return {
+        "session_id": session_id,
+        "models": list(engine.models.keys()),
+        "max_turns": engine.max_turns,
+        "topic": topic
+    }, 200
+
+
+# 发言指令：讨论内容由适配器按token预算放入消息列表
+NEXT_PROMPT = "请基于以上讨论继续发言，保持简洁有意义的回复。"
+
+
+def _next_round(session_id, session_data, engine):
+    """当前轮所有模型都已发言时进入下一轮；讨论结束或已收敛时删除会话并返回False"""
+    if session_data['current_model_index'] < len(engine.models):
+        return True
+
+    # 一轮结束后才检查收敛，提前结束的讨论不会留下不完整的一轮
+    if engine.converged():
+        logger.info(f"讨论已收敛，第 {engine.current_turn or 1} 轮提前结束")
+        engine.finish_session()
+        session_store.delete(session_id)
+        return False
+
+    engine.current_turn += 1
+    session_data['current_model_index'] = 0
+
+    logger.debug("进入第 %d 轮", engine.current_turn)
+
+    # 检查是否达到最大轮次
+    if engine.current_turn > engine.max_turns:
+        logger.debug("讨论完成，共 %d 轮", engine.max_turns)
+        engine.finish_session()
+        session_store.delete(session_id)
+        return False
+    return True
+
+
+def _advance(session_id, session_data, engine):
+    """推进发言顺序，返回 (模型名, 显示轮次)；讨论结束时删除会话并返回None"""
+    if not _next_round(session_id, session_data, engine):
+        return None
+
+    # 按发言顺序策略选择当前模型
+    current_model_index = session_data['current_model_index']
+    model_name = engine.next_speaker(current_model_index)
+
+    logger.debug("当前模型: %s (索引: %d)", model_name, current_model_index)
+    logger.debug("当前轮次: %d/%d", engine.current_turn, engine.max_turns)
+
+    # 更新会话状态
+    session_data['current_model_index'] = current_model_index + 1
+
+    # 确保轮次从1开始显示
+    display_turn = engine.current_turn if engine.current_turn > 0 else 1
+    return model_name, display_turn
+
+
+def _done_payload(engine):
+    """讨论结束时 /next 的响应内容，因收敛提前结束时带 converged 标记"""
+    if engine.converged():
+        return {"done": True, "converged": True, "message": "讨论已收敛，提前结束"}
+    return {"done": True, "message": "讨论完成"}
+
+
+def _retreat(session_data):
+    """服务商过载、发言未生成时撤回 _advance 的推进，下次请求从同一位置继续"""
+    session_data['current_model_index'] -= 1
+
+
+def _generate_next(session_id, session_data=None):
+    """生成会话的下一条发言并保存会话，返回 /next 的响应内容
+
+    round_complete 表示本轮所有模型都已发言，last_round 表示讨论随本轮结束（达到最大轮次或已收敛），
+    预生成的结果据此按轮返回。
+    """
+    start = time.perf_counter()
+    if session_data is None:
+        session_data = session_store.get(session_id)
+        if session_data is None:
+            return {"done": True, "message": "会话不存在或已过期"}
+
+    engine = engine_registry.create_engine(session_data['state'])
+    with collect_calls() as calls:
+        # 主持模型选择发言者的调用也计入耗时分解
+        step = _advance(session_id, session_data, engine)
+        if step is None:
+            return _done_payload(engine)
+        model_name, display_turn = step
+
+        logger.debug("调用 %s 生成响应...", model_name)
+        try:
+            response = engine.models[model_name].generate(NEXT_PROMPT, engine.context_history())
+        except Exception:
+            # 任何失败都不推进发言顺序，下次请求仍由该模型发言
+            _retreat(session_data)
+            raise
+
+    logger.debug("%s 响应: %.100s...", model_name, response)
 
-    except Exception as e:
-        print(f"[ERROR] 启动讨论失败: {str(e)}")
-        return jsonify({"error": f"启动失败: {str(e)}"}), 500
+    # 更新历史记录
+    engine.append_response(model_name, response)
+    session_store.put(session_id, session_data)
+
+    payload = _turn_payload(engine, model_name, response, display_turn,
+                            isinstance(response, FallbackResponse), calls, start)
+    payload['round_complete'] = session_data['current_model_index'] >= len(engine.models)
+    payload['last_round'] = payload['round_complete'] and (engine.current_turn >= engine.max_turns
+                                                           or engine.converged())
+    return payload
+
+
+def _turn_payload(engine, model_name, response, display_turn, fallback, calls, start):
+    """一条发言的 /next 响应内容（流式请求的 end 事件使用相同的格式）"""
+    return {
+        "model": model_name,
+        "response": response,
+        "turn": display_turn,
+        "total_turns": engine.max_turns,
+        "done": False,
+        "fallback": fallback,
+        "timing": timing_breakdown(calls, start),
+        "timestamp": time.time()
+    }
 
 
 @app.route('/next', methods=['POST'])
 def next_response():
+    session_id = None
     try:
         data = request.json
         session_id = data.get('session_id')
 
-        print(f"[DEBUG] 收到响应请求，会话ID: {session_id}")
+        logger.debug("收到响应请求，会话ID: %s", session_id)
 
-        if not session_id or session_id not in sessions:
-            print(f"[ERROR] 无效的会话ID: {session_id}")
+        if pipeline_pool is not None:
+            return _next_from_pipeline(session_id, data.get('stream'))
+
+        session_data = session_store.get(session_id) if session_id else None
+        if session_data is None:
+            logger.warning(f"无效的会话ID: {session_id}")
             return jsonify({"error": "会话不存在或已过期"}), 404
 
-        session_data = sessions[session_id]
         # 更新会话活跃时间
         session_data['last_active'] = time.time()
 
-        engine = session_data['engine']
-        model_names = list(engine.models.keys())
-
-        # 获取当前模型索引
-        current_model_index = session_data['current_model_index']
+        if not data.get('stream'):
+            return jsonify(_generate_next(session_id, session_data))
 
-        # 检查是否完成所有模型的当前轮次
-        if current_model_index >= len(model_names):
-            engine.current_turn += 1
-            current_model_index = 0
-            session_data['current_model_index'] = 0
+        engine = engine_registry.create_engine(session_data['state'])
+        step = _advance(session_id, session_data, engine)
+        if step is None:
+            return jsonify(_done_payload(engine))
+        model_name, display_turn = step
 
-            print(f"[DEBUG] 进入第 {engine.current_turn} 轮")
+        adapter = engine.models[model_name]
+        if adapter.gate is not None:
+            # 发送响应头之前检查排队，排队已满时直接返回 503
+            try:
+                adapter.gate.check()
+            except Overloaded:
+                _retreat(session_data)
+                raise
+
+        logger.debug("流式调用 %s 生成响应...", model_name)
+        return Response(
+            stream_with_context(_stream_response(session_id, session_data, engine, model_name,
+                                                 adapter, NEXT_PROMPT, display_turn)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+    except Overloaded as e:
+        if pipeline_pool is not None and session_id:
+            pipeline_pool.discard(session_id)
+        logger.warning(f"服务商过载，拒绝生成响应: {str(e)}")
+        return _overloaded(e)
+    except Exception as e:
+        if pipeline_pool is not None and session_id:
+            # 丢弃出错的执行器，下次请求从已保存的会话状态重新开始
+            pipeline_pool.discard(session_id)
+        logger.error(f"生成响应失败: {str(e)}")
+        return jsonify({"error": f"生成响应失败: {str(e)}"}), 500
 
-            # 检查是否达到最大轮次
-            if engine.current_turn > engine.max_turns:
-                print(f"[DEBUG] 讨论完成，共 {engine.max_turns} 轮")
-                sessions.pop(session_id, None)
-                return jsonify({"done": True, "message": "讨论完成"})
 
-        # 获取当前模型
-        model_name = model_names[current_model_index]
-        adapter = engine.models[model_name]
+@app.route('/turn', methods=['POST'])
+def turn_responses():
+    """一次返回当前轮剩余的全部发言（或之后的 count 轮），适合不需要逐条展示的客户端"""
+    session_id = None
+    try:
+        data = request.json
+        session_id = data.get('session_id')
+        count = data.get('count', 1)
 
-        print(f"[DEBUG] 当前模型: {model_name} (索引: {current_model_index})")
-        print(f"[DEBUG] 当前轮次: {engine.current_turn}/{engine.max_turns}")
+        max_turns_limit = engine_registry.config['system'].get('max_turns_limit', 10)
+        if not isinstance(count, int) or count < 1 or count > max_turns_limit:
+            return jsonify({"error": f"count 必须在1-{max_turns_limit}之间"}), 400
 
-        # 生成响应
-        context = engine._get_context()
-        prompt = f"请基于以下讨论继续发言，保持简洁有意义的回复:\n{context}"
+        if pipeline_pool is not None:
+            pipeline = _find_pipeline(session_id)
+            if pipeline is None:
+                return jsonify({"error": "会话不存在或已过期"}), 404
+            return jsonify(_turns_from_pipeline(session_id, pipeline, count))
 
-        print(f"[DEBUG] 调用 {model_name} 生成响应...")
+        session_data = session_store.get(session_id) if session_id else None
+        if session_data is None:
+            logger.warning(f"无效的会话ID: {session_id}")
+            return jsonify({"error": "会话不存在或已过期"}), 404
 
-        response = adapter.generate(prompt, engine.history)
+        session_data['last_active'] = time.time()
+        return jsonify(_generate_turns(session_id, session_data, count, data.get('parallel', False)))
 
-        print(f"[DEBUG] {model_name} 响应: {response[:100]}...")
+    except Overloaded as e:
+        if pipeline_pool is not None and session_id:
+            pipeline_pool.discard(session_id)
+        logger.warning(f"服务商过载，拒绝生成响应: {str(e)}")
+        return _overloaded(e)
+    except Exception as e:
+        if pipeline_pool is not None and session_id:
+            pipeline_pool.discard(session_id)
+        logger.error(f"生成响应失败: {str(e)}")
+        return jsonify({"error": f"生成响应失败: {str(e)}"}), 500
 
-        # 更新历史记录
-        response_entry = f"{model_name}: {response}"
-        engine.history.append(response_entry)
 
-        # 更新会话状态
-        session_data['current_model_index'] = current_model_index + 1
+def _turn_waves(session_data, engine, parallel):
+    """当前轮剩余发言的波次；parallel 为True时剩余模型作为一波并发调用"""
+    names = list(engine.models)
+    index = session_data['current_model_index']
+    if parallel:
+        return iter([names[index:]])
+    return engine.speaking_policy.waves(names, engine.context_history, index)
 
-        # 确保轮次从1开始显示
-        display_turn = engine.current_turn if engine.current_turn > 0 else 1
 
-        return jsonify({
+def _record_wave(session_data, engine, results, display_turn, responses):
+    """把一波发言写入历史记录，并按 /turn 的格式加入 responses"""
+    for model_name, response in results:
+        engine.append_response(model_name, response)
+        responses.append({
             "model": model_name,
             "response": response,
             "turn": display_turn,
-            "total_turns": engine.max_turns,
-            "done": False,
+            "fallback": isinstance(response, FallbackResponse),
             "timestamp": time.time()
         })
+    session_data['current_model_index'] += len(results)
+
+
+def _turns_payload(session_id, session_data, engine, responses, done, calls, start):
+    """保存会话并生成 /turn 的响应内容；最后一轮已全部发言或讨论已收敛时直接结束会话"""
+    converged = session_data['current_model_index'] >= len(engine.models) and engine.converged()
+    if not done:
+        if converged or (session_data['current_model_index'] >= len(engine.models)
+                         and engine.current_turn >= engine.max_turns):
+            engine.finish_session()
+            session_store.delete(session_id)
+            done = True
+        else:
+            session_store.put(session_id, session_data)
+
+    return {
+        "responses": responses,
+        "turn": responses[-1]['turn'] if responses else engine.current_turn,
+        "total_turns": engine.max_turns,
+        "done": done,
+        "converged": converged,
+        "timing": timing_breakdown(calls, start)
+    }
+
+
+def _generate_turns(session_id, session_data, count, parallel=False):
+    """生成当前轮剩余的发言及之后的 count-1 轮，同一波内的模型并发调用"""
+    start = time.perf_counter()
+    engine = engine_registry.create_engine(session_data['state'])
+    responses = []
+    done = False
+
+    with collect_calls() as calls:
+        try:
+            for _ in range(count):
+                if not _next_round(session_id, session_data, engine):
+                    done = True
+                    break
+                display_turn = engine.current_turn if engine.current_turn > 0 else 1
+                for wave in _turn_waves(session_data, engine, parallel):
+                    results = engine.run_wave(wave, NEXT_PROMPT, engine.context_history())
+                    _record_wave(session_data, engine, results, display_turn, responses)
+        except Overloaded:
+            # 已生成的发言照常返回，剩余的留给下次请求
+            if not responses:
+                raise
+
+    return _turns_payload(session_id, session_data, engine, responses, done, calls, start)
+
+
+def _turns_from_pipeline(session_id, pipeline, count):
+    """从后台执行器依次取出当前轮剩余的发言（或之后的 count 轮），与 _generate_turns 一样在轮次边界停止"""
+    start = time.perf_counter()
+    responses = []
+    calls = []
+    server_ms = 0.0
+    payload = {"done": False}
+    rounds = 0
+    # 最后一轮已全部发言时再取出结束结果，与 _generate_turns 一样在同一次请求中结束会话
+    while rounds < count or payload.get('last_round'):
+        try:
+            payload = pipeline.next()
+        except Overloaded:
+            if not responses:
+                raise
+            pipeline_pool.discard(session_id)
+            payload = {"done": False}
+            break
+        if payload['done']:
+            pipeline_pool.discard(session_id)
+            break
+        server_ms += payload['timing']['server_ms']
+        calls.extend(payload['timing']['calls'])
+        responses.append({key: payload[key] for key in ('model', 'response', 'turn', 'fallback', 'timestamp')})
+        if payload.get('round_complete'):
+            rounds += 1
+
+    return {
+        "responses": responses,
+        "turn": responses[-1]['turn'] if responses else None,
+        "total_turns": payload.get('total_turns'),
+        "done": payload['done'],
+        "converged": payload.get('converged', False),
+        "timing": {
+            # 生成这些发言的总耗时，以及客户端实际等待的时间
+            "server_ms": round(server_ms, 1),
+            "pipeline_wait_ms": round((time.perf_counter() - start) * 1000, 1),
+            "calls": calls
+        }
+    }
 
+
+@app.route('/transcripts')
+def list_transcripts():
+    """已保存的讨论记录，按时间从新到旧排列"""
+    if engine_registry.transcript is None:
+        return jsonify({"enabled": False, "sessions": []})
+    return jsonify({"enabled": True, "sessions": engine_registry.transcript.sessions()})
+
+
+@app.route('/transcripts/<session_id>')
+def export_transcript(session_id):
+    """导出讨论记录，format 为 json（默认）、jsonl 或 markdown"""
+    try:
+        body, mimetype, status = _export_transcript(session_id, request.args.get('format', 'json'))
+        return Response(body, status=status, mimetype=mimetype)
     except Exception as e:
-        print(f"[ERROR] 生成响应失败: {str(e)}")
-        return jsonify({"error": f"生成响应失败: {str(e)}"}), 500
+        logger.error(f"导出讨论记录失败: {str(e)}")
+        return jsonify({"error": f"导出失败: {str(e)}"}), 500
 
 
-# 清理过期会话
-def cleanup_sessions():
-    now = time.time()
-    expired_sessions = [
-        sid for sid, data in sessions.items()
-        if now - data['last_active'] > 7200  # 2小时过期
+@app.route('/transcripts/<session_id>/replay', methods=['POST'])
+def replay_transcript(session_id):
+    """从讨论记录恢复会话，不调用任何模型；未结束的讨论恢复后可以继续 /next"""
+    try:
+        payload, status = _replay_session(session_id)
+        return jsonify(payload), status
+    except Exception as e:
+        logger.error(f"重放讨论记录失败: {str(e)}")
+        return jsonify({"error": f"重放失败: {str(e)}"}), 500
+
+
+def _export_transcript(session_id, fmt):
+    """返回 (响应内容, 类型, 状态码)"""
+    records = engine_registry.transcript.read(session_id) if engine_registry.transcript else None
+    if not records:
+        return json.dumps({"error": "讨论记录不存在"}, ensure_ascii=False), 'application/json', 404
+
+    if fmt == 'jsonl':
+        return "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records), \
+            'application/x-ndjson', 200
+    if fmt == 'markdown':
+        return export_markdown(records), 'text/markdown; charset=utf-8', 200
+
+    _, meta = rebuild_state(records)
+    return json.dumps({
+        "session_id": session_id,
+        "topic": meta['topic'],
+        "models": meta['models'],
+        "max_turns": meta['max_turns'],
+        "finished": meta['finished'],
+        "records": records
+    }, ensure_ascii=False), 'application/json', 200
+
+
+def _replay_session(session_id):
+    """重建会话状态；讨论未结束且会话已不在存储中时重新登记，返回 (响应内容, 状态码)"""
+    replayed = engine_registry.replay(session_id) if engine_registry.transcript else None
+    if replayed is None:
+        return {"error": "讨论记录不存在"}, 404
+    engine, meta = replayed
+
+    resumed = False
+    if not meta['finished'] and session_store.get(session_id) is None:
+        session_store.put(session_id, {
+            'state': engine.state,
+            'topic': meta['topic'],
+            'created_at': meta['timestamp'],
+            'last_active': time.time(),
+            'current_model_index': meta['round_index']
+        })
+        resumed = True
+
+    return {
+        "session_id": session_id,
+        "topic": meta['topic'],
+        "models": list(engine.models.keys()),
+        "max_turns": engine.max_turns,
+        "done": meta['finished'],
+        "resumed": resumed,
+        "responses": [
+            {"model": turn.speaker, "response": turn.text, "timestamp": turn.timestamp}
+            for turn in engine.history[1:]
+        ]
+    }, 200
+
+
+def _start_pipeline(session_id):
+    """为会话创建后台执行器并开始预生成"""
+    pipeline = TurnPipeline(lambda: _generate_next(session_id), pipeline_lookahead)
+    return pipeline_pool.add(session_id, pipeline)
+
+
+def _find_pipeline(session_id):
+    """查找会话的后台执行器，会话已过期时返回None"""
+    # 执行器生成到讨论结束时会删除会话，因此先查找执行器再查找会话
+    pipeline = pipeline_pool.get(session_id) if session_id else None
+    alive = session_id and session_store.touch(session_id)
+    if pipeline is None:
+        if not alive:
+            logger.warning(f"无效的会话ID: {session_id}")
+            return None
+        pipeline = _start_pipeline(session_id)
+    return pipeline
+
+
+def _pipeline_result(session_id, payload, start):
+    """补充客户端实际等待的时间，讨论结束时释放执行器"""
+    if 'timing' in payload:
+        # 结果已预先生成时接近0
+        payload['timing']['pipeline_wait_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    if payload['done']:
+        pipeline_pool.discard(session_id)
+    return payload
+
+
+def _replay_events(payload):
+    """流式请求：结果已经完整生成，按相同的事件格式一次性发送"""
+    return [
+        _sse_event('start', {key: payload[key] for key in ('model', 'turn', 'total_turns')}),
+        _sse_event('delta', {"content": payload['response']}),
+        _sse_event('end', payload)
     ]
-    for sid in expired_sessions:
-        sessions.pop(sid, None)
-        print(f"[DEBUG] 清理过期会话: {sid}")
 
 
-# 定时清理
-from threading import Timer
+def _next_from_pipeline(session_id, stream):
+    """从会话的后台执行器取出已预先生成的发言"""
+    pipeline = _find_pipeline(session_id)
+    if pipeline is None:
+        return jsonify({"error": "会话不存在或已过期"}), 404
+
+    start = time.perf_counter()
+    payload = _pipeline_result(session_id, pipeline.next(), start)
+    if not stream or payload['done']:
+        return jsonify(payload)
+    return Response(_replay_events(payload), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def _sse_event(event, payload):
+    """格式化一条SSE事件"""
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
 
+def _error_event(e):
+    """生成失败的SSE事件；服务商过载时带 retry_after，客户端稍后重试而不结束讨论"""
+    if isinstance(e, Overloaded):
+        return _sse_event('error', {"error": str(e), "status": e.status, "retry_after": e.retry_after})
+    return _sse_event('error', {"error": f"生成响应失败: {str(e)}"})
 
-def schedule_cleanup():
-    cleanup_sessions()
-    Timer(600, schedule_cleanup).start()  # 每10分钟清理一次
 
+def _stream_response(session_id, session_data, engine, model_name, adapter, prompt, display_turn,
+                     keepalive=None):
+    """逐段转发模型输出，结束后写入历史记录并保存会话；生成失败时返回异常
+
+    keepalive 不为空时，在连接的后台线程中迭代输出，等待下一段输出期间定期发送心跳注释。
+    """
+    yield _sse_event('start', {
+        "model": model_name,
+        "turn": display_turn,
+        "total_turns": engine.max_turns
+    })
+
+    start = time.perf_counter()
+    parts = []
+    calls = []
+    finished = failed = False
+    try:
+        chunks = collect_stream(adapter.generate_stream(prompt, engine.context_history()), calls)
+        if keepalive is not None:
+            chunks = keepalive.iterate(chunks)
+        for text in chunks:
+            if text is _PING:
+                yield HEARTBEAT
+                continue
+            parts.append(text)
+            yield _sse_event('delta', {"content": text})
+        finished = True
+    except Overloaded as e:
+        # 排队超时：本次没有发言，客户端按 retry_after 稍后重试
+        failed = True
+        _retreat(session_data)
+        logger.warning(f"服务商过载，拒绝生成响应: {str(e)}")
+        yield _error_event(e)
+        return e
+    except Exception as e:
+        # 生成失败：不写入空发言，下次请求仍由该模型发言
+        failed = True
+        _retreat(session_data)
+        logger.error(f"流式生成响应失败: {str(e)}")
+        yield _error_event(e)
+        return e
+    finally:
+        # 正常结束，或客户端在收到部分内容后断开时保留已生成的内容；未收到任何内容就断开时撤回推进
+        if not failed:
+            response = "".join(parts).strip()
+            if finished or parts:
+                engine.append_response(model_name, response)
+                session_store.put(session_id, session_data)
+                logger.debug("%s 响应: %.100s...", model_name, response)
+            else:
+                _retreat(session_data)
+
+    yield _sse_event('end', _turn_payload(engine, model_name, response, display_turn,
+                                          any(isinstance(text, FallbackResponse) for text in parts),
+                                          calls, start))
+
+
+# SSE注释行，客户端忽略；用于在等待期间保持连接活跃
+HEARTBEAT = ": ping\n\n"
+_PING = object()
+
+
+class _Keepalive:
+    """推送连接的后台线程：依次执行连接中的阻塞调用，调用方等待期间每隔 interval 秒产出心跳
+
+    每个连接只使用一个线程。调用方关闭生成器（客户端断开）后，线程完成当前调用后
+    关闭未迭代完的输出，close 之后退出。
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._tasks = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            context, fn, args, results = task
+            try:
+                results.put((True, context.run(fn, *args)))
+            except BaseException as e:
+                results.put((False, e))
+
+    def _submit(self, fn, args):
+        results = queue.Queue()
+        # 复制上下文，调用记录仍计入当前请求
+        self._tasks.put((contextvars.copy_context(), fn, args, results))
+        return results
+
+    def _result(self, results, ping):
+        while True:
+            try:
+                ok, value = results.get(timeout=self.interval)
+            except queue.Empty:
+                yield ping
+                continue
+            if not ok:
+                raise value
+            return value
+
+    def call(self, fn, *args):
+        """在后台线程中调用 fn，等待期间产出心跳注释；用 yield from 取得 fn 的返回值"""
+        return (yield from self._result(self._submit(fn, args), HEARTBEAT))
+
+    def iterate(self, iterable):
+        """在后台线程中逐个取出 iterable 的元素并转发，等待期间产出 _PING"""
+        end = object()
+        try:
+            while True:
+                item = yield from self._result(self._submit(next, (iterable, end)), _PING)
+                if item is end:
+                    return
+                yield item
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                self._submit(close, ())
+
+    def close(self):
+        self._tasks.put(None)
+
+
+@app.route('/events/<session_id>')
+def session_events(session_id):
+    """会话的推送通道：服务端依次生成并推送全部发言，讨论结束时发送 done 事件
+
+    一个长连接代替逐条 /next 请求和 /keepalive 保活，每条发言开始前刷新会话活跃时间；
+    每条发言的事件与流式 /next 相同。连接断开后重新连接即可从已保存的会话状态继续。
+    """
+    if pipeline_pool is not None:
+        if _find_pipeline(session_id) is None:
+            return jsonify({"error": "会话不存在或已过期"}), 404
+    elif session_store.get(session_id) is None:
+        logger.warning(f"无效的会话ID: {session_id}")
+        return jsonify({"error": "会话不存在或已过期"}), 404
+
+    return Response(stream_with_context(_session_events(session_id)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def _session_events(session_id):
+    """逐条生成会话的发言并产出SSE事件，直到讨论结束或生成失败"""
+    keepalive = _Keepalive(events_heartbeat)
+    try:
+        yield from _push_events(session_id, keepalive)
+    finally:
+        keepalive.close()
+
+
+def _push_events(session_id, keepalive):
+    while True:
+        try:
+            if pipeline_pool is not None:
+                pipeline = _find_pipeline(session_id)
+                if pipeline is None:
+                    yield _sse_event('done', {"done": True, "message": "会话不存在或已过期"})
+                    return
+                events, done = yield from keepalive.call(_pipeline_events, session_id, pipeline)
+                yield from events
+                if done:
+                    return
+                continue
+
+            session_data = session_store.get(session_id)
+            if session_data is None:
+                yield _sse_event('done', {"done": True, "message": "会话不存在或已过期"})
+                return
+            session_data['last_active'] = time.time()
+
+            engine = engine_registry.create_engine(session_data['state'])
+            # 主持模型选择发言者时会调用模型
+            step = yield from keepalive.call(_advance, session_id, session_data, engine)
+            if step is None:
+                yield _sse_event('done', _done_payload(engine))
+                return
+            model_name, display_turn = step
+        except Exception as e:
+            if pipeline_pool is not None:
+                pipeline_pool.discard(session_id)
+            logger.error(f"生成响应失败: {str(e)}")
+            yield _error_event(e)
+            return
+
+        logger.debug("推送 %s 的发言...", model_name)
+        error = yield from _stream_response(session_id, session_data, engine, model_name,
+                                            engine.models[model_name], NEXT_PROMPT, display_turn,
+                                            keepalive)
+        if error is not None:
+            return
+
+
+def _pipeline_events(session_id, pipeline):
+    """推送通道从后台执行器取出一条发言，返回 (SSE事件列表, 讨论是否结束)"""
+    payload = _pipeline_result(session_id, pipeline.next(), time.perf_counter())
+    if payload['done']:
+        return [_sse_event('done', payload)], True
+    return _replay_events(payload), False
 
-schedule_cleanup()
 
 if __name__ == '__main__':
     print("[INFO] 启动多模型对话系统...")
     print("[INFO] 访问地址: http://localhost:5000")
-    app.run(debug=True, port=5000, host='0.0.0.0')
\ No newline at end of file
+    print("[INFO] 多进程或异步模式请使用: python server.py --help")
+    app.run(port=5000, host='0.0.0.0', threaded=True)
\ No newline at end of file
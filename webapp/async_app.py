@@ -0,0 +1,477 @@
+import os
+import time
+import asyncio
+import logging
+from aiohttp import web
+from flask import render_template
+import app as wsgi
+from app import (engine_registry, session_store, pipeline_pool, NEXT_PROMPT, _advance, _create_session,
+                 _turn_payload, _find_pipeline, _pipeline_result, _replay_events, _sse_event, _next_round,
+                 _turn_waves, _record_wave, _turns_payload, _turns_from_pipeline, _export_transcript,
+                 _replay_session, _retreat, _admission_payload, _done_payload, _error_event,
+                 _pipeline_events, events_heartbeat, HEARTBEAT)
+from admission import Overloaded
+from rate_limiter import scheduler_stats
+from resilience import FallbackResponse, resilience_stats
+from model_adapters import close_async_pools
+from metrics import HTTP_DURATION, collect_calls, render_metrics
+
+# 异步服务模式：接口和JSON格式与 app.py 相同，/next 等待异步模型调用，
+# 等待服务商响应和限流排队期间不占用线程，单个进程可以同时挂起大量讨论
+logger = logging.getLogger("AsyncWebApp")
+
+SSE_HEADERS = {
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'
+}
+
+
+@web.middleware
+async def _record_duration(request, handler):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_DURATION.observe(time.perf_counter() - start,
+                              request.match_info.route.name or "unknown", status)
+
+
+async def index(request):
+    return web.Response(text=request.app['index_html'], content_type='text/html')
+
+
+async def health_check(request):
+    """健康检查接口"""
+    return web.json_response({"status": "ok", "timestamp": time.time()})
+
+
+async def rate_limits(request):
+    """各服务商限流队列深度与等待时间"""
+    return web.json_response(scheduler_stats())
+
+
+async def resilience(request):
+    """熔断器状态、对冲次数和模拟响应降级次数"""
+    return web.json_response(resilience_stats())
+
+
+async def metrics(request):
+    """Prometheus 格式的调用耗时、token用量和降级统计"""
+    return web.Response(body=render_metrics().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def admission(request):
+    """当前会话数和各服务商的在途调用、排队和拒绝次数"""
+    return web.json_response(_admission_payload())
+
+
+def _overloaded(e):
+    """过载时的快速失败响应，Retry-After 为建议的重试秒数"""
+    return web.json_response({"error": str(e), "retry_after": e.retry_after}, status=e.status,
+                             headers={'Retry-After': str(e.retry_after)})
+
+
+async def cache_stats(request):
+    """响应缓存命中统计"""
+    cache = engine_registry.cache
+    if cache is None:
+        return web.json_response({"enabled": False})
+    return web.json_response(dict(cache.stats(), enabled=True))
+
+
+async def list_transcripts(request):
+    """已保存的讨论记录，按时间从新到旧排列"""
+    if engine_registry.transcript is None:
+        return web.json_response({"enabled": False, "sessions": []})
+    return web.json_response({"enabled": True,
+                              "sessions": await asyncio.to_thread(engine_registry.transcript.sessions)})
+
+
+async def export_transcript(request):
+    """导出讨论记录，format 为 json（默认）、jsonl 或 markdown"""
+    try:
+        body, content_type, status = await asyncio.to_thread(
+            _export_transcript, request.match_info['session_id'], request.query.get('format', 'json'))
+        return web.Response(text=body, status=status, headers={'Content-Type': content_type})
+    except Exception as e:
+        logger.error(f"导出讨论记录失败: {str(e)}")
+        return web.json_response({"error": f"导出失败: {str(e)}"}, status=500)
+
+
+async def replay_transcript(request):
+    """从讨论记录恢复会话，不调用任何模型；未结束的讨论恢复后可以继续 /next"""
+    try:
+        payload, status = await asyncio.to_thread(_replay_session, request.match_info['session_id'])
+        return web.json_response(payload, status=status)
+    except Exception as e:
+        logger.error(f"重放讨论记录失败: {str(e)}")
+        return web.json_response({"error": f"重放失败: {str(e)}"}, status=500)
+
+
+async def keep_alive(request):
+    """会话保活接口"""
+    try:
+        data = await request.json()
+        session_id = data.get('session_id')
+
+        if session_id and await asyncio.to_thread(session_store.touch, session_id):
+            return web.json_response({"status": "ok", "message": "会话已更新"})
+        else:
+            return web.json_response({"error": "会话不存在"}, status=404)
+    except Exception as e:
+        return web.json_response({"error": str(e)}, status=500)
+
+
+async def start_discussion(request):
+    try:
+        payload, status = await asyncio.to_thread(_create_session, await request.json())
+        return web.json_response(payload, status=status)
+
+    except Overloaded as e:
+        logger.warning(f"拒绝启动讨论: {str(e)}")
+        return _overloaded(e)
+    except Exception as e:
+        logger.error(f"启动讨论失败: {str(e)}")
+        return web.json_response({"error": f"启动失败: {str(e)}"}, status=500)
+
+
+async def next_response(request):
+    session_id = None
+    try:
+        data = await request.json()
+        session_id = data.get('session_id')
+
+        logger.debug("收到响应请求，会话ID: %s", session_id)
+
+        if pipeline_pool is not None:
+            return await _next_from_pipeline(request, session_id, data.get('stream'))
+
+        session_data = await asyncio.to_thread(session_store.get, session_id) if session_id else None
+        if session_data is None:
+            logger.warning(f"无效的会话ID: {session_id}")
+            return web.json_response({"error": "会话不存在或已过期"}, status=404)
+
+        # 更新会话活跃时间
+        session_data['last_active'] = time.time()
+
+        # 会话存储和配置热加载可能读写磁盘，均放到线程中执行，不阻塞事件循环
+        engine = await asyncio.to_thread(engine_registry.create_engine, session_data['state'])
+        start = time.perf_counter()
+        with collect_calls() as calls:
+            # 主持模型选择发言者时会同步调用模型，放到线程中执行
+            step = await asyncio.to_thread(_advance, session_id, session_data, engine)
+            if step is None:
+                return web.json_response(_done_payload(engine))
+            model_name, display_turn = step
+
+            try:
+                gate = engine.models[model_name].gate
+                if data.get('stream'):
+                    if gate is not None:
+                        # 发送响应头之前检查排队，排队已满时直接返回 503
+                        gate.check()
+                    logger.debug("流式调用 %s 生成响应...", model_name)
+                    return await _stream_response(request, session_id, session_data, engine, model_name,
+                                                  display_turn, calls, start)
+
+                logger.debug("调用 %s 生成响应...", model_name)
+                response = await engine.models[model_name].agenerate(NEXT_PROMPT, engine.context_history())
+            except Exception:
+                # 任何失败都不推进发言顺序，下次请求仍由该模型发言
+                _retreat(session_data)
+                raise
+
+        logger.debug("%s 响应: %.100s...", model_name, response)
+
+        # 更新历史记录
+        engine.append_response(model_name, response)
+        await asyncio.to_thread(session_store.put, session_id, session_data)
+
+        return web.json_response(_turn_payload(engine, model_name, response, display_turn,
+                                               isinstance(response, FallbackResponse), calls, start))
+
+    except Overloaded as e:
+        if pipeline_pool is not None and session_id:
+            pipeline_pool.discard(session_id)
+        logger.warning(f"服务商过载，拒绝生成响应: {str(e)}")
+        return _overloaded(e)
+    except Exception as e:
+        if pipeline_pool is not None and session_id:
+            # 丢弃出错的执行器，下次请求从已保存的会话状态重新开始
+            pipeline_pool.discard(session_id)
+        logger.error(f"生成响应失败: {str(e)}")
+        return web.json_response({"error": f"生成响应失败: {str(e)}"}, status=500)
+
+
+async def turn_responses(request):
+    """一次返回当前轮剩余的全部发言（或之后的 count 轮），同一波内的模型并发调用"""
+    session_id = None
+    try:
+        data = await request.json()
+        session_id = data.get('session_id')
+        count = data.get('count', 1)
+
+        max_turns_limit = engine_registry.config['system'].get('max_turns_limit', 10)
+        if not isinstance(count, int) or count < 1 or count > max_turns_limit:
+            return web.json_response({"error": f"count 必须在1-{max_turns_limit}之间"}, status=400)
+
+        if pipeline_pool is not None:
+            pipeline = await asyncio.to_thread(_find_pipeline, session_id)
+            if pipeline is None:
+                return web.json_response({"error": "会话不存在或已过期"}, status=404)
+            return web.json_response(await asyncio.to_thread(_turns_from_pipeline, session_id, pipeline, count))
+
+        session_data = await asyncio.to_thread(session_store.get, session_id) if session_id else None
+        if session_data is None:
+            logger.warning(f"无效的会话ID: {session_id}")
+            return web.json_response({"error": "会话不存在或已过期"}, status=404)
+
+        session_data['last_active'] = time.time()
+        engine = await asyncio.to_thread(engine_registry.create_engine, session_data['state'])
+        start = time.perf_counter()
+        responses = []
+        done = False
+
+        with collect_calls() as calls:
+            try:
+                for _ in range(count):
+                    if not await asyncio.to_thread(_next_round, session_id, session_data, engine):
+                        done = True
+                        break
+                    display_turn = engine.current_turn if engine.current_turn > 0 else 1
+                    waves = _turn_waves(session_data, engine, data.get('parallel', False))
+                    # 主持模型选择发言者时会同步调用模型，放到线程中执行
+                    while (wave := await asyncio.to_thread(next, waves, None)) is not None:
+                        results = await engine.arun_wave(wave, NEXT_PROMPT, engine.context_history())
+                        _record_wave(session_data, engine, results, display_turn, responses)
+            except Overloaded:
+                # 已生成的发言照常返回，剩余的留给下次请求
+                if not responses:
+                    raise
+
+        payload = await asyncio.to_thread(_turns_payload, session_id, session_data, engine, responses, done,
+                                          calls, start)
+        return web.json_response(payload)
+
+    except Overloaded as e:
+        if pipeline_pool is not None and session_id:
+            pipeline_pool.discard(session_id)
+        logger.warning(f"服务商过载，拒绝生成响应: {str(e)}")
+        return _overloaded(e)
+    except Exception as e:
+        if pipeline_pool is not None and session_id:
+            pipeline_pool.discard(session_id)
+        logger.error(f"生成响应失败: {str(e)}")
+        return web.json_response({"error": f"生成响应失败: {str(e)}"}, status=500)
+
+
+async def _next_from_pipeline(request, session_id, stream):
+    """从会话的后台执行器取出已预先生成的发言
+
+    执行器仍在线程池中生成，这里只在线程中等待结果，不阻塞事件循环。
+    """
+    pipeline = await asyncio.to_thread(_find_pipeline, session_id)
+    if pipeline is None:
+        return web.json_response({"error": "会话不存在或已过期"}, status=404)
+
+    start = time.perf_counter()
+    payload = _pipeline_result(session_id, await asyncio.to_thread(pipeline.next), start)
+    if not stream or payload['done']:
+        return web.json_response(payload)
+
+    response = web.StreamResponse(headers=SSE_HEADERS)
+    await response.prepare(request)
+    for event in _replay_events(payload):
+        await response.write(event.encode('utf-8'))
+    return response
+
+
+async def _stream_response(request, session_id, session_data, engine, model_name, display_turn,
+                           calls, start):
+    """逐段转发模型输出，结束后写入历史记录并保存会话"""
+    response = web.StreamResponse(headers=SSE_HEADERS)
+    await response.prepare(request)
+    await _write_turn(response, session_id, session_data, engine, model_name, display_turn, calls, start)
+    return response
+
+
+async def _keepalive(response, awaitable, interval):
+    """等待 awaitable 完成并返回其结果，期间每隔 interval 秒向SSE响应写入一次心跳注释"""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=interval)
+            if done:
+                return task.result()
+            await response.write(HEARTBEAT.encode('utf-8'))
+    finally:
+        # 客户端断开或写入失败时取消等待中的调用
+        task.cancel()
+
+
+async def _write_turn(response, session_id, session_data, engine, model_name, display_turn, calls, start,
+                      heartbeat=None):
+    """向已开始的SSE响应写入一条发言的事件；生成失败时返回异常
+
+    heartbeat 不为空时，等待下一段输出超过 heartbeat 秒就发送一次心跳注释。
+    """
+    await response.write(_sse_event('start', {
+        "model": model_name,
+        "turn": display_turn,
+        "total_turns": engine.max_turns
+    }).encode('utf-8'))
+
+    parts = []
+    error = None
+    finished = False
+    try:
+        chunks = engine.models[model_name].agenerate_stream(NEXT_PROMPT, engine.context_history())
+        while True:
+            try:
+                if heartbeat:
+                    text = await _keepalive(response, anext(chunks), heartbeat)
+                else:
+                    text = await anext(chunks)
+            except StopAsyncIteration:
+                break
+            parts.append(text)
+            await response.write(_sse_event('delta', {"content": text}).encode('utf-8'))
+        finished = True
+    except Overloaded as e:
+        # 排队超时：本次没有发言，客户端按 retry_after 稍后重试
+        error = e
+        logger.warning(f"服务商过载，拒绝生成响应: {str(e)}")
+    except Exception as e:
+        # 生成失败：不写入空发言，下次请求仍由该模型发言
+        error = e
+        logger.error(f"流式生成响应失败: {str(e)}")
+    finally:
+        # 正常结束，或客户端在收到部分内容后断开（任务被取消）时保留已生成的内容；其余情况撤回推进
+        if error is None and (finished or parts):
+            content = "".join(parts).strip()
+            engine.append_response(model_name, content)
+            # 客户端断开时任务已被取消，保存不能再被打断
+            await asyncio.shield(asyncio.to_thread(session_store.put, session_id, session_data))
+            logger.debug("%s 响应: %.100s...", model_name, content)
+        else:
+            _retreat(session_data)
+
+    if error is not None:
+        await response.write(_error_event(error).encode('utf-8'))
+        return error
+
+    await response.write(_sse_event('end', _turn_payload(
+        engine, model_name, content, display_turn,
+        any(isinstance(text, FallbackResponse) for text in parts), calls, start
+    )).encode('utf-8'))
+    return None
+
+
+# 会话已结束或过期时推送通道发送的事件
+SESSION_GONE = _sse_event('done', {"done": True, "message": "会话不存在或已过期"}).encode('utf-8')
+
+
+async def session_events(request):
+    """会话的推送通道：服务端依次生成并推送全部发言，讨论结束时发送 done 事件
+
+    等待服务商响应期间不占用线程，适合大量浏览器标签页同时保持连接。
+    """
+    session_id = request.match_info['session_id']
+    if pipeline_pool is not None:
+        if await asyncio.to_thread(_find_pipeline, session_id) is None:
+            return web.json_response({"error": "会话不存在或已过期"}, status=404)
+    elif await asyncio.to_thread(session_store.get, session_id) is None:
+        logger.warning(f"无效的会话ID: {session_id}")
+        return web.json_response({"error": "会话不存在或已过期"}, status=404)
+
+    response = web.StreamResponse(headers=SSE_HEADERS)
+    await response.prepare(request)
+    while True:
+        try:
+            if pipeline_pool is not None:
+                pipeline = await asyncio.to_thread(_find_pipeline, session_id)
+                if pipeline is None:
+                    await response.write(SESSION_GONE)
+                    break
+                events, done = await _keepalive(
+                    response, asyncio.to_thread(_pipeline_events, session_id, pipeline), events_heartbeat)
+                for event in events:
+                    await response.write(event.encode('utf-8'))
+                if done:
+                    break
+                continue
+
+            session_data = await asyncio.to_thread(session_store.get, session_id)
+            if session_data is None:
+                await response.write(SESSION_GONE)
+                break
+            session_data['last_active'] = time.time()
+
+            engine = await asyncio.to_thread(engine_registry.create_engine, session_data['state'])
+            start = time.perf_counter()
+            with collect_calls() as calls:
+                # 主持模型选择发言者时会同步调用模型，放到线程中执行
+                step = await _keepalive(response, asyncio.to_thread(_advance, session_id, session_data, engine),
+                                        events_heartbeat)
+                if step is None:
+                    await response.write(_sse_event('done', _done_payload(engine)).encode('utf-8'))
+                    break
+                model_name, display_turn = step
+
+                logger.debug("推送 %s 的发言...", model_name)
+                if await _write_turn(response, session_id, session_data, engine, model_name, display_turn,
+                                     calls, start, events_heartbeat) is not None:
+                    break
+        except ConnectionResetError:
+            # 客户端已断开，已生成的内容已保存
+            raise
+        except Exception as e:
+            if pipeline_pool is not None:
+                pipeline_pool.discard(session_id)
+            logger.error(f"生成响应失败: {str(e)}")
+            await response.write(_error_event(e).encode('utf-8'))
+            break
+    return response
+
+
+async def _close_pools(application):
+    await close_async_pools()
+
+
+def create_app():
+    """创建异步服务应用"""
+    application = web.Application(middlewares=[_record_duration])
+
+    # 首页模板只渲染一次，与 Flask 版本使用相同的模板和静态文件
+    with wsgi.app.test_request_context():
+        application['index_html'] = render_template('index.html')
+
+    application.router.add_get('/', index, name='index')
+    application.router.add_get('/health', health_check, name='health_check')
+    application.router.add_get('/rate_limits', rate_limits, name='rate_limits')
+    application.router.add_get('/resilience', resilience, name='resilience')
+    application.router.add_get('/metrics', metrics, name='metrics')
+    application.router.add_get('/admission', admission, name='admission')
+    application.router.add_get('/cache_stats', cache_stats, name='cache_stats')
+    application.router.add_post('/keepalive', keep_alive, name='keep_alive')
+    application.router.add_post('/start', start_discussion, name='start_discussion')
+    application.router.add_post('/next', next_response, name='next_response')
+    application.router.add_post('/turn', turn_responses, name='turn_responses')
+    application.router.add_get('/events/{session_id}', session_events, name='session_events')
+    application.router.add_get('/transcripts', list_transcripts, name='list_transcripts')
+    application.router.add_get('/transcripts/{session_id}', export_transcript, name='export_transcript')
+    application.router.add_post('/transcripts/{session_id}/replay', replay_transcript,
+                                name='replay_transcript')
+    application.router.add_static('/static', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static'),
+                                  name='static')
+
+    application.on_cleanup.append(_close_pools)
+    return application
@@ -0,0 +1,65 @@
+import functools
+
+
+@functools.lru_cache(maxsize=4096)
+def shingles(text, size=3):
+    """文本的字符 n-gram 集合，忽略大小写、空白和标点；中英文都不需要分词"""
+    normalized = "".join(ch.lower() for ch in text if ch.isalnum())
+    if len(normalized) <= size:
+        return frozenset([normalized]) if normalized else frozenset()
+    return frozenset(normalized[i:i + size] for i in range(len(normalized) - size + 1))
+
+
+class ConvergenceDetector:
+    """讨论收敛检测：最近的发言持续没有新内容时提前结束讨论
+
+    一条发言的新颖度为其 n-gram 中没有出现在之前 window 条发言（含话题）里的比例；
+    至少完成 min_turns 轮后，最近 patience 条发言的新颖度都低于 min_novelty 时认为
+    各方已在重复彼此或达成一致，继续讨论只会消耗调用次数。只依赖发言记录，
+    因此每次请求重建的引擎和重放的讨论得到相同的结果。
+    """
+
+    def __init__(self, speakers, min_novelty=0.5, window=None, patience=None, min_turns=2, ngram=3):
+        self.min_novelty = min_novelty
+        # 默认与最近一整轮比较，并要求连续一整轮都没有新内容
+        self.window = window or speakers
+        self.patience = patience or speakers
+        self.min_responses = min_turns * speakers
+        self.ngram = ngram
+
+    def novelty(self, texts, index):
+        """texts[index] 的新颖度，取值 0-1，空发言为0"""
+        current = shingles(texts[index], self.ngram)
+        if not current:
+            return 0.0
+        seen = frozenset().union(*(shingles(text, self.ngram)
+                                   for text in texts[max(0, index - self.window):index]))
+        return len(current - seen) / len(current)
+
+    def converged(self, history):
+        """history 为发言记录（history[0] 为话题），最近的发言持续低于新颖度阈值时返回True"""
+        responses = len(history) - 1
+        if responses < max(self.min_responses, self.patience):
+            return False
+        # 只需要最近 patience 条发言及其之前的 window 条
+        texts = [turn.text for turn in history[max(0, len(history) - self.patience - self.window):]]
+        return all(self.novelty(texts, index) < self.min_novelty
+                   for index in range(len(texts) - self.patience, len(texts)))
+
+    def __str__(self):
+        return f"min_novelty={self.min_novelty}, window={self.window}, patience={self.patience}"
+
+
+def create_convergence_detector(system_config, models):
+    """按 system.convergence 配置创建收敛检测器，未启用时返回None"""
+    config = system_config.get('convergence') or {}
+    if not config.get('enabled'):
+        return None
+    return ConvergenceDetector(
+        len(models),
+        min_novelty=config.get('min_novelty', 0.5),
+        window=config.get('window'),
+        patience=config.get('patience'),
+        min_turns=config.get('min_turns', 2),
+        ngram=config.get('ngram', 3)
+    )
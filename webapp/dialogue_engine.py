@@ -1,7 +1,21 @@
+import os
 import yaml
 import time
+import threading
+import asyncio
 import logging
-from model_adapters import DeepSeekAdapter, DoubaoAdapter, WenxinAdapter
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from model_adapters import get_adapter_class
+from response_cache import create_response_cache
+from context_builder import create_context_builder, ContextView, MessageCache, Turn, USER_SPEAKER
+from summarizer import create_summarizer
+from resilience import create_resilience_policy
+from admission import get_provider_gate
+from rate_limiter import get_scheduler
+from speaking_order import create_speaking_policy
+from convergence import create_convergence_detector
+from transcript_store import create_transcript_store, start_record, turn_record, rebuild_state
 
 # 配置日志
 logging.basicConfig(
@@ -10,68 +24,404 @@ logging.basicConfig(
 )
 logger = logging.getLogger("DialogueEngine")
 
+# 发言指令；讨论内容由各适配器的上下文构建器按token预算放入消息列表
+DISCUSSION_PROMPT = "请基于以上讨论继续发言。"
+
+
+def load_config(config_path="config.yaml"):
+    """读取配置文件"""
+    with open(config_path) as f:
+        return yaml.safe_load(f)
+
+
+def build_models(config, cache=None):
+    """根据配置创建参与讨论的模型适配器，按 model_configs 的顺序发言，cache 为共享的响应缓存"""
+    system = config['system']
+    models = {}
+    for key, model_config in config['model_configs'].items():
+        if not model_config.get('enabled', True):
+            continue
+        adapter_class = get_adapter_class(key, model_config)
+        name = model_config.get('name') or adapter_class.name or key
+        if name in models:
+            raise ValueError(f"发言者名称重复: {name}")
+        model_config = dict(model_config, name=name)
+
+        builder = create_context_builder(system, model_config)
+        resilience = create_resilience_policy(name, system, model_config)
+        gate = get_provider_gate(model_config.get('provider') or name, system, model_config)
+        models[name] = adapter_class(model_config, cache, builder, resilience, gate)
+    return models
+
+
+class ConversationState:
+    """单个会话的对话状态，只保存发言记录、轮次计数和滚动摘要"""
+    __slots__ = ('history', 'current_turn', 'max_turns', 'summary', 'summarized_upto', 'transcript_id',
+                 'message_cache')
+
+    def __init__(self, max_turns, history=None, current_turn=0, summary="", summarized_upto=1,
+                 transcript_id=None):
+        # 只追加的 Turn 列表，history[0] 为话题
+        self.history = history if history is not None else []
+        self.current_turn = current_turn
+        self.max_turns = max_turns
+        # history[1:summarized_upto] 已折叠进 summary
+        self.summary = summary
+        self.summarized_upto = summarized_upto
+        # 讨论记录文件的ID，未启用讨论记录时为None
+        self.transcript_id = transcript_id
+        # 各模型视角下的消息缓存，不参与序列化
+        self.message_cache = MessageCache()
+
+    def to_dict(self):
+        """导出为可JSON序列化的字典，供会话存储使用"""
+        return {
+            "history": [turn.to_list() for turn in self.history],
+            "current_turn": self.current_turn,
+            "max_turns": self.max_turns,
+            "summary": self.summary,
+            "summarized_upto": self.summarized_upto,
+            "transcript_id": self.transcript_id
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data, history=[Turn.from_list(item) for item in data['history']])
+        return cls(**data)
+
+    def copy(self):
+        """独立修改的副本：发言记录为新列表（Turn 创建后不再修改，直接共享），消息缓存共享"""
+        state = ConversationState(self.max_turns, list(self.history), self.current_turn, self.summary,
+                                  self.summarized_upto, self.transcript_id)
+        state.message_cache = self.message_cache
+        return state
+
 
 class DialogueEngine:
-    def __init__(self, config_path="config.yaml"):
+    def __init__(self, config_path="config.yaml", config=None, models=None, state=None,
+                 summarizer=None, speaking_policy=None, transcript=None, convergence=None, on_summary=None):
         try:
-            with open(config_path) as f:
-                self.config = yaml.safe_load(f)
+            # 由 EngineRegistry 创建时直接复用共享的配置和适配器
+            shared = config is not None
+            self.config = config if shared else load_config(config_path)
+            if models is None:
+                models = build_models(self.config, create_response_cache(self.config['system']))
+            self.models = models
+            if summarizer is None and not shared:
+                summarizer = create_summarizer(self.config['system'], self.models)
+            self.summarizer = summarizer
+            if speaking_policy is None:
+                speaking_policy = create_speaking_policy(self.config['system'], self.models)
+            self.speaking_policy = speaking_policy
+            if convergence is None and not shared:
+                convergence = create_convergence_detector(self.config['system'], self.models)
+            # 收敛检测：最近的发言持续没有新内容时提前结束讨论
+            self.convergence = convergence
+            self.transcript = transcript
+            # 后台摘要完成时的回调，参数为更新后的状态；请求可能已保存会话，由回调写回会话存储
+            self.on_summary = on_summary
+            self._summary_future = None
+            self._summary_lock = threading.Lock()
 
-            self.models = {
-                "DeepSeek": DeepSeekAdapter(self.config['model_configs']['deepseek']),
-                "Doubao": DoubaoAdapter(self.config['model_configs']['doubao']),
-                "Wenxin": WenxinAdapter(self.config['model_configs']['wenxin'])
-            }
+            self.state = state or ConversationState(self.config['system']['max_turns'])
 
-            self.history = []
-            self.current_turn = 0
-            self.max_turns = self.config['system']['max_turns']
-            self.context_window = self.config['system']['context_window']
-
-            logger.info("对话引擎初始化完成")
-            logger.info(f"最大对话轮次: {self.max_turns}")
-            logger.info(f"上下文窗口大小: {self.context_window}")
+            if not shared:
+                logger.info("对话引擎初始化完成")
+                logger.info(f"最大对话轮次: {self.max_turns}")
+                logger.info(f"上下文token预算: {self.config['system'].get('context_tokens', 2000)}")
+                logger.info(f"参与者: {list(self.models)}")
+                logger.info(f"发言顺序: {self.speaking_policy}")
+                logger.info(f"滚动摘要: {self.summarizer is not None}")
+                logger.info(f"收敛检测: {self.convergence or False}")
 
         except Exception as e:
             logger.error(f"初始化失败: {str(e)}")
             raise
 
-    def _get_context(self):
-        """获取最近的上下文"""
-        return "\n".join(self.history[-self.context_window:])
+    @property
+    def history(self):
+        return self.state.history
+
+    @history.setter
+    def history(self, value):
+        self.state.history = value
 
-    def start_session(self, topic):
-        """开始新会话"""
-        self.history = []
-        self.current_turn = 0
-        self.history.append(f"用户: {topic}")
+    @property
+    def current_turn(self):
+        return self.state.current_turn
+
+    @current_turn.setter
+    def current_turn(self, value):
+        self.state.current_turn = value
+
+    @property
+    def max_turns(self):
+        return self.state.max_turns
+
+    @max_turns.setter
+    def max_turns(self, value):
+        self.state.max_turns = value
+
+    def run_wave(self, wave, prompt, history):
+        """调用一波发言的模型，按波内顺序返回 (模型名, 响应) 列表"""
+        if len(wave) == 1:
+            return [(wave[0], self.models[wave[0]].generate(prompt, history))]
+
+        # 每个线程运行调用方上下文的副本，调用记录仍计入当前请求
+        with ThreadPoolExecutor(max_workers=len(wave)) as pool:
+            futures = [(name, pool.submit(contextvars.copy_context().run,
+                                          self.models[name].generate, prompt, history))
+                       for name in wave]
+            return [(name, future.result()) for name, future in futures]
+
+    async def arun_wave(self, wave, prompt, history):
+        """run_wave 的异步版本，同一波内的模型并发调用"""
+        results = await asyncio.gather(*(self.models[name].agenerate(prompt, history) for name in wave))
+        return list(zip(wave, results))
+
+    def next_speaker(self, index):
+        """逐条发言时本轮第 index 位发言的模型"""
+        return self.speaking_policy.next_speaker(list(self.models), index, self.context_history)
+
+    def start_session(self, topic, transcript_id=None):
+        """开始新会话，transcript_id 为讨论记录文件的ID"""
+        with self._summary_lock:
+            self.history = []
+            self.current_turn = 0
+            self.state.summary = ""
+            self.state.summarized_upto = 1
+            self._summary_future = None
+        self.state.transcript_id = transcript_id
+        self.history.append(Turn.create(USER_SPEAKER, topic))
+        self._record(start_record(self.history[0], self.max_turns, self.models, self.speaking_policy))
         return self.history
 
+    def converged(self):
+        """讨论已收敛（最近的发言持续没有新内容）时返回True，未启用收敛检测时总是False"""
+        return self.convergence is not None and self.convergence.converged(self.history)
+
+    def finish_session(self):
+        """讨论结束，写入 end 记录；因收敛提前结束时记录 converged"""
+        record = {"type": "end", "current_turn": self.current_turn, "timestamp": time.time()}
+        if self.converged():
+            record["converged"] = True
+        self._record(record)
+
+    def _record(self, record):
+        if self.transcript is not None and self.state.transcript_id:
+            self.transcript.append(self.state.transcript_id, record)
+
+    def context_history(self):
+        """请求使用的历史视图：话题 + 滚动摘要 + 尚未折叠的发言，不复制发言记录"""
+        with self._summary_lock:
+            state = self.state
+            return ContextView(state.history, len(state.history), state.summary,
+                               state.summarized_upto, state.message_cache)
+
+    def append_response(self, model_name, response):
+        """记录一条模型响应，并在后台折叠移出窗口的旧发言"""
+        turn = Turn.create(model_name, response)
+        self.history.append(turn)
+        self._record(turn_record(turn, self.current_turn))
+        self._schedule_summary()
+        return turn
+
+    def _schedule_summary(self):
+        if self.summarizer is None:
+            return
+
+        with self._summary_lock:
+            # 同一会话同一时间只有一个折叠任务
+            if self._summary_future is not None and not self._summary_future.done():
+                return
+            upto = len(self.state.history) - self.summarizer.keep_entries
+            if upto <= self.state.summarized_upto:
+                return
+            entries = self.state.history[self.state.summarized_upto:upto]
+            future = self.summarizer.submit(self.state.summary, entries)
+            self._summary_future = future
+
+        future.add_done_callback(lambda f: self._apply_summary(f, upto))
+
+    def _apply_summary(self, future, upto):
+        try:
+            summary = future.result()
+        except Exception as e:
+            logger.error(f"滚动摘要失败: {str(e)}")
+            return
+
+        with self._summary_lock:
+            # 会话已重新开始时丢弃过期结果
+            if future is not self._summary_future:
+                return
+            self.state.summary = summary
+            self.state.summarized_upto = upto
+        self._record({"type": "summary", "summary": summary, "upto": upto})
+        if self.on_summary is not None:
+            try:
+                self.on_summary(self.state)
+            except Exception as e:
+                logger.error(f"保存滚动摘要失败: {str(e)}")
+
     def generate_responses(self):
-        """生成一轮模型响应"""
-        if self.current_turn >= self.max_turns:
+        """生成一轮模型响应，按发言顺序策略分波调用；讨论收敛时提前结束"""
+        if self.current_turn >= self.max_turns or self.converged():
             return [], True
 
         responses = []
         self.current_turn += 1
 
-        for model_name, adapter in self.models.items():
-            context = self._get_context()
-            prompt = f"请基于以下讨论继续发言:\n{context}"
+        for wave in self.speaking_policy.waves(list(self.models), self.context_history):
+            # 同一波内所有模型使用相同的历史快照
+            history = self.context_history()
+            for model_name, response in self.run_wave(wave, DISCUSSION_PROMPT, history):
+                responses.append({
+                    "model": model_name,
+                    "response": response,
+                    "entry": str(self.append_response(model_name, response))
+                })
 
-            response = adapter.generate(prompt, self.history)
-            response_entry = f"{model_name}: {response}"
-            responses.append({
-                "model": model_name,
-                "response": response,
-                "entry": response_entry
-            })
+        # 检查是否结束
+        done = self.current_turn >= self.max_turns or self.converged()
+        if done:
+            self.finish_session()
 
-        # 更新历史记录
-        for resp in responses:
-            self.history.append(resp['entry'])
+        return responses, done
+
+    async def agenerate_responses(self):
+        """异步生成一轮模型响应，同一波内的模型并发调用"""
+        if self.current_turn >= self.max_turns or self.converged():
+            return [], True
+
+        self.current_turn += 1
+
+        responses = []
+        waves = self.speaking_policy.waves(list(self.models), self.context_history)
+        # 主持模型选择发言者时会同步调用模型，放到线程中执行
+        while (wave := await asyncio.to_thread(next, waves, None)) is not None:
+            for model_name, response in await self.arun_wave(wave, DISCUSSION_PROMPT, self.context_history()):
+                responses.append({
+                    "model": model_name,
+                    "response": response,
+                    "entry": str(self.append_response(model_name, response))
+                })
+
+        done = self.current_turn >= self.max_turns or self.converged()
+        if done:
+            self.finish_session()
+
+        return responses, done
+
+
+def _reconfigure_limits(system_config, models):
+    """限流调度器和准入闸门按服务商缓存，重新加载配置时按新配置更新；同一服务商以第一个模型的配置为准"""
+    configured = set()
+    for adapter in models.values():
+        if adapter.provider in configured:
+            continue
+        configured.add(adapter.provider)
+        get_scheduler(adapter.provider, adapter.config, reconfigure=True)
+        get_provider_gate(adapter.provider, system_config, adapter.config, reconfigure=True)
+
+
+class EngineRegistry:
+    """进程级引擎工厂：配置只加载一次，适配器及其连接池在会话间共享"""
+
+    def __init__(self, config_path="config.yaml", auto_reload=None):
+        self.config_path = config_path
+        # _lock 保护下面一组共享对象的整体替换，_reload_lock 保证同一时间只有一个线程重新加载
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self.transcript = None
+        # 后台摘要完成时的回调，由使用方（如 Web 应用写回会话存储）设置
+        self.on_summary = None
+        self._load()
+        # 未显式指定时读取配置中的 system.config_reload
+        if auto_reload is None:
+            auto_reload = self.config['system'].get('config_reload', False)
+        self.auto_reload = auto_reload
+
+    def _load(self, reconfigure=False):
+        """读取配置并创建全部共享对象，全部创建成功后才整体替换，创建引擎时不会看到新旧混合的状态"""
+        mtime = os.path.getmtime(self.config_path)
+        config = load_config(self.config_path)
+        system = config['system']
+        cache = create_response_cache(system)
+        models = build_models(config, cache)
+        summarizer = create_summarizer(system, models)
+        speaking_policy = create_speaking_policy(system, models)
+        convergence = create_convergence_detector(system, models)
+        # 讨论记录存储持有打开的文件，重新加载配置时沿用已有的实例
+        transcript = self.transcript if self.transcript is not None else create_transcript_store(system)
+
+        if reconfigure:
+            _reconfigure_limits(system, models)
+
+        with self._lock:
+            self.config = config
+            self.cache = cache
+            self.models = models
+            self.summarizer = summarizer
+            self.speaking_policy = speaking_policy
+            self.convergence = convergence
+            self.transcript = transcript
+            self._mtime = mtime
+
+        logger.info("对话引擎注册表初始化完成")
+        logger.info(f"最大对话轮次: {self.config['system']['max_turns']}")
+        logger.info(f"上下文token预算: {self.config['system'].get('context_tokens', 2000)}")
+        logger.info(f"参与者: {list(self.models)}")
+        logger.info(f"发言顺序: {self.speaking_policy}")
+        logger.info(f"滚动摘要: {self.summarizer is not None}")
+        logger.info(f"讨论记录: {self.transcript.directory if self.transcript else False}")
+
+    def _maybe_reload(self):
+        """配置文件有变化时重新加载，已有会话继续使用旧的适配器"""
+        try:
+            mtime = os.path.getmtime(self.config_path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+
+        with self._reload_lock:
+            if mtime == self._mtime:
+                return
+            try:
+                self._load(reconfigure=True)
+                logger.info("检测到配置文件变化，已重新加载")
+            except Exception as e:
+                # 保留旧配置，下次检查时再尝试
+                self._mtime = mtime
+                logger.error(f"重新加载配置失败: {str(e)}")
+
+    def create_engine(self, state=None):
+        """创建绑定到共享配置和适配器的会话引擎"""
+        if self.auto_reload:
+            self._maybe_reload()
+        with self._lock:
+            return DialogueEngine(config=self.config, models=self.models, state=state,
+                                  summarizer=self.summarizer, speaking_policy=self.speaking_policy,
+                                  transcript=self.transcript, convergence=self.convergence,
+                                  on_summary=self.on_summary)
+
+    def replay(self, transcript_id):
+        """从讨论记录重建会话引擎，不调用任何模型；返回 (引擎, 元数据)，记录不存在时返回None"""
+        records = self.transcript.read(transcript_id) if self.transcript else None
+        if not records:
+            return None
+        state, meta = rebuild_state(records)
+        return self.create_engine(ConversationState.from_dict(dict(state, transcript_id=transcript_id))), meta
+
+
+_registry = None
+_registry_lock = threading.Lock()
 
-        # 检查是否结束
-        done = self.current_turn >= self.max_turns
 
-        return responses, done
\ No newline at end of file
+def get_engine_registry(config_path="config.yaml"):
+    """获取进程级引擎注册表"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = EngineRegistry(config_path)
+        return _registry
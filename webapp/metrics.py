@@ -0,0 +1,210 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# 默认的耗时分桶（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """按标签计数的累加器"""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for values, total in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, values)} {total}")
+        return lines
+
+
+class Histogram:
+    """按标签统计的直方图，输出格式与 Prometheus 一致"""
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}  # 标签值 -> [各分桶计数..., 总和, 次数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_items = sorted((values, list(series)) for values, series in self._series.items())
+        for values, series in series_items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = _format_labels(self.labels + ("le",), values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels + ("le",), values + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, values)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, values)} {series[-1]}")
+        return lines
+
+
+CALL_DURATION = Histogram("llm_call_duration_seconds", "模型调用总耗时", ("provider",))
+RATE_LIMIT_WAIT = Histogram("llm_rate_limit_wait_seconds", "限流排队等待时间", ("provider",))
+CONNECT_TIME = Histogram("llm_connect_seconds", "发出请求到收到响应头的时间", ("provider",))
+TIME_TO_FIRST_TOKEN = Histogram("llm_time_to_first_token_seconds", "流式调用的首个token时间", ("provider",))
+CALLS = Counter("llm_calls_total", "模型调用次数，outcome 为 ok/cache_hit/fallback/error/rejected", ("provider", "outcome"))
+PROMPT_TOKENS = Counter("llm_prompt_tokens_total", "输入token数", ("provider",))
+CACHED_PROMPT_TOKENS = Counter("llm_cached_prompt_tokens_total", "命中服务商前缀缓存的输入token数", ("provider",))
+COMPLETION_TOKENS = Counter("llm_completion_tokens_total", "输出token数", ("provider",))
+HTTP_DURATION = Histogram("http_request_duration_seconds", "接口处理耗时", ("endpoint", "status"))
+
+_metrics = [CALL_DURATION, RATE_LIMIT_WAIT, CONNECT_TIME, TIME_TO_FIRST_TOKEN,
+            CALLS, PROMPT_TOKENS, CACHED_PROMPT_TOKENS, COMPLETION_TOKENS, HTTP_DURATION]
+
+
+class CallRecord:
+    """一次模型调用的计时和token统计，时间单位为秒，未测得的项为None"""
+    __slots__ = ('provider', 'outcome', 'rate_limit_wait', 'connect', 'ttft', 'total',
+                 'prompt_tokens', 'cached_tokens', 'completion_tokens', '_start')
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.outcome = None
+        self.rate_limit_wait = 0.0
+        self.connect = None
+        self.ttft = None
+        self.total = None
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self._start = time.perf_counter()
+
+    def finish(self, outcome):
+        """结束计时并通知所有监控钩子"""
+        self.outcome = outcome
+        self.total = time.perf_counter() - self._start
+        for hook in _hooks:
+            hook(self)
+
+    def to_dict(self):
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+        return {
+            "provider": self.provider,
+            "outcome": self.outcome,
+            "rate_limit_wait_ms": ms(self.rate_limit_wait),
+            "connect_ms": ms(self.connect),
+            "ttft_ms": ms(self.ttft),
+            "total_ms": ms(self.total),
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "completion_tokens": self.completion_tokens
+        }
+
+
+def _observe(record):
+    """默认钩子：写入进程级指标"""
+    provider = record.provider
+    CALLS.inc(provider, record.outcome)
+    CALL_DURATION.observe(record.total, provider)
+    RATE_LIMIT_WAIT.observe(record.rate_limit_wait, provider)
+    if record.connect is not None:
+        CONNECT_TIME.observe(record.connect, provider)
+    if record.ttft is not None:
+        TIME_TO_FIRST_TOKEN.observe(record.ttft, provider)
+    if record.prompt_tokens:
+        PROMPT_TOKENS.inc(provider, amount=record.prompt_tokens)
+    if record.cached_tokens:
+        CACHED_PROMPT_TOKENS.inc(provider, amount=record.cached_tokens)
+    if record.completion_tokens:
+        COMPLETION_TOKENS.inc(provider, amount=record.completion_tokens)
+
+
+# 按线程和异步任务隔离的收集列表
+_collector = ContextVar("metrics_collector", default=None)
+
+
+def _collect(record):
+    """把调用记录交给当前正在收集的请求"""
+    calls = _collector.get()
+    if calls is not None:
+        calls.append(record)
+
+
+_hooks = [_observe, _collect]
+
+
+def add_call_hook(hook):
+    """注册监控钩子，每次模型调用结束时以 CallRecord 调用"""
+    _hooks.append(hook)
+
+
+@contextmanager
+def collect_calls():
+    """收集当前线程（或异步任务）内发生的模型调用记录，用于单次请求的耗时分解"""
+    calls = []
+    token = _collector.set(calls)
+    try:
+        yield calls
+    finally:
+        _collector.reset(token)
+
+
+def collect_stream(chunks, calls):
+    """迭代流式输出，把迭代过程中结束的模型调用记录加入 calls
+
+    只在推进生成器时设置收集列表，避免跨越 yield 持有上下文。
+    """
+    while True:
+        token = _collector.set(calls)
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        finally:
+            _collector.reset(token)
+        yield chunk
+
+
+def timing_breakdown(calls, start):
+    """单次请求的耗时分解：总耗时和各次模型调用的明细"""
+    return {
+        "server_ms": round((time.perf_counter() - start) * 1000, 1),
+        "calls": [record.to_dict() for record in calls]
+    }
+
+
+def render_metrics():
+    """以 Prometheus 文本格式输出所有指标"""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
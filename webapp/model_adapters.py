@@ -1,24 +1,462 @@
 import openai
-import requests
 import json
-import time
 import random
+import time
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from admission import Overloaded
+from rate_limiter import get_scheduler
+from http_client import get_client
+from metrics import CallRecord
+from response_cache import ResponseCache
+from context_builder import ContextBuilder, estimate_tokens
+from resilience import FallbackResponse, ProviderUnavailableError, ResiliencePolicy
+
+try:
+    import aiohttp  # 可选依赖：异步适配器连接池
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger("ModelAdapter")
+
+
+class Completion(str):
+    """服务商返回的响应文本，附带用量和响应头耗时，用于监控统计"""
+
+    def __new__(cls, content, usage=None, connect_time=None):
+        completion = super().__new__(cls, content)
+        completion.usage = usage or {}
+        completion.connect_time = connect_time
+        return completion
+
+
+def cached_prompt_tokens(usage):
+    """服务商用量中命中前缀缓存的输入token数
+
+    DeepSeek 返回 prompt_cache_hit_tokens，OpenAI 兼容接口（豆包、文心等）返回
+    prompt_tokens_details.cached_tokens，未返回时为0。
+    """
+    if not usage:
+        return 0
+    if usage.get('prompt_cache_hit_tokens') is not None:
+        return usage['prompt_cache_hit_tokens']
+    return (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0
 
 
 class BaseModelAdapter:
-    def __init__(self, config):
+    # 子类或配置覆盖：发言者名称、日志中的显示名称、示例配置中的占位密钥、调用方式
+    name = None
+    display_name = None
+    placeholder_key = None
+    client = "http"  # http: 每个端点独立的客户端和连接池; openai: 使用openai SDK
+
+    # 每个端点一个长连接池，按 (限流分组, api_base) 区分，绑定创建时的事件循环
+    _async_pools = {}
+    _async_pools_lock = threading.Lock()
+
+    def __init__(self, config, cache=None, context_builder=None, resilience=None, gate=None):
         self.config = config
-        self.last_call_time = 0
+        self.name = config.get('name') or self.name
+        self.display_name = config.get('display_name') or self.display_name or self.name
+        self.client = config.get('client', self.client)
+        # 可选的角色设定，作为系统消息发送
+        self.persona = config.get('persona')
+        # 限流分组，默认每个发言者一组；provider 相同的参与者共享额度和连接池
+        self.provider = config.get('provider') or self.name
+        # 按token预算构建上下文，由 build_models 按配置注入
+        self.context_builder = context_builder or ContextBuilder()
+        # 同一服务商在进程内共享一个令牌桶调度器
+        self.scheduler = get_scheduler(self.provider, config)
+        # 可选的响应缓存，由 build_models 按 system.response_cache 配置注入
+        self.cache = cache
+        # 熔断、对冲和故障转移策略，默认只使用主端点
+        self.resilience = resilience or ResiliencePolicy(self.name, [config])
+        # 服务商的在途调用上限和等待队列，由 build_models 按 system.admission 配置注入
+        self.gate = gate
+
+    @contextmanager
+    def _admit(self, record):
+        """占用服务商的调用名额，被拒绝时记录为 rejected 并继续抛出 Overloaded"""
+        if self.gate is None:
+            yield
+            return
+        try:
+            with self.gate.slot():
+                yield
+        except Overloaded:
+            record.finish("rejected")
+            raise
+
+    @asynccontextmanager
+    async def _aadmit(self, record):
+        if self.gate is None:
+            yield
+            return
+        try:
+            async with self.gate.aslot():
+                yield
+        except Overloaded:
+            record.finish("rejected")
+            raise
+
+    def _cache_get(self, messages):
+        """查询响应缓存，返回 (缓存键, 缓存的响应)"""
+        if self.cache is None:
+            return None, None
+        key = ResponseCache.make_key(dict(self._build_payload(self.config, messages), provider=self.name))
+        return key, self.cache.get(key)
+
+    def _cache_set(self, key, response):
+        """缓存真实的API响应"""
+        if self.cache is not None and key is not None and response:
+            self.cache.set(key, response)
+
+    def _rate_limit(self, messages):
+        """API调用速率限制，返回等待的秒数"""
+        return self.scheduler.acquire(self._estimate_tokens(messages))
+
+    async def _arate_limit(self, messages):
+        """异步速率限制，等待期间不占用线程"""
+        return await self.scheduler.aacquire(self._estimate_tokens(messages))
+
+    def _try_acquire_hedge(self, messages):
+        """对冲请求只在限流额度充足时发出"""
+        return lambda: self.scheduler.try_acquire(self._estimate_tokens(messages))
+
+    def _estimate_tokens(self, messages):
+        """估算一次调用消耗的token数（输入消息加上输出上限）"""
+        return sum(estimate_tokens(message['content']) for message in messages) + 200
+
+    def _api_key_missing(self):
+        """检查API密钥是否未配置"""
+        api_key = self.config.get('api_key')
+        return not api_key or api_key == self.placeholder_key
+
+    def _build_messages(self, prompt, history):
+        """构建消息列表，prompt 为发言指令，历史按token预算裁剪"""
+        messages = self.context_builder.build(self.name, prompt, history)
+        if self.persona:
+            messages.insert(0, {"role": "system", "content": self.persona})
+        return messages
+
+    def _build_payload(self, endpoint, messages, stream=False):
+        """构建OpenAI兼容的请求体"""
+        payload = {
+            "model": endpoint['model'],
+            "messages": messages,
+            "temperature": endpoint.get('temperature', 0.7),
+            "max_tokens": 200
+        }
+        if stream:
+            payload["stream"] = True
+            # 最后一个分片附带用量，用于统计缓存命中的token数
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    def _headers(self, endpoint):
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {endpoint['api_key']}"
+        }
 
-    def _rate_limit(self):
-        """API调用速率限制"""
-        current_time = time.time()
-        if current_time - self.last_call_time < 1.0:  # 1秒间隔
-            time.sleep(1.0 - (current_time - self.last_call_time))
-        self.last_call_time = time.time()
+    def _fallback(self, reason, record):
+        """所有端点都失败时降级为模拟响应，降级会被计数"""
+        self.resilience.record_fallback()
+        if not self.resilience.mock_fallback:
+            record.finish("error")
+            raise ProviderUnavailableError(f"{self.display_name} 不可用: {reason}")
+        logger.warning(f"{self.display_name} 降级为模拟响应: {reason}")
+        record.finish("fallback")
+        return FallbackResponse(self._get_mock_response(self.name))
+
+    def _finish(self, record, messages, content):
+        """记录一次成功调用的token用量并结束计时"""
+        usage = getattr(content, 'usage', None) or {}
+        record.prompt_tokens = (usage.get('prompt_tokens')
+                                or sum(estimate_tokens(message['content']) for message in messages))
+        record.cached_tokens = cached_prompt_tokens(usage)
+        record.completion_tokens = usage.get('completion_tokens') or estimate_tokens(content)
+        if record.connect is None:
+            record.connect = getattr(content, 'connect_time', None)
+        record.finish("ok")
+        return content
 
     def generate(self, prompt, history):
-        raise NotImplementedError
+        """生成响应：缓存 → 准入 → 限流 → 熔断/对冲/故障转移 → 降级"""
+        record = CallRecord(self.name)
+        messages = self._build_messages(prompt, history)
+        cache_key, cached = self._cache_get(messages)
+        if cached is not None:
+            record.finish("cache_hit")
+            return cached
+
+        with self._admit(record):
+            record.rate_limit_wait = self._rate_limit(messages)
+
+            # 检查API密钥配置
+            if self._api_key_missing():
+                return self._fallback("API密钥未配置", record)
+
+            try:
+                content = self.resilience.call(self._complete, messages, self._try_acquire_hedge(messages))
+            except Exception as e:
+                logger.error(f"{self.display_name} API调用失败: {str(e)}")
+                return self._fallback(str(e), record)
+
+        self._cache_set(cache_key, content)
+        return self._finish(record, messages, content)
+
+    def _complete(self, endpoint, messages):
+        """向单个端点发起一次调用，按 client 选择调用方式"""
+        if self.client == "openai":
+            return self._complete_openai(endpoint, messages)
+        return self._complete_http(endpoint, messages)
+
+    def _complete_http(self, endpoint, messages):
+        """通过端点的共享客户端调用OpenAI兼容HTTP接口"""
+        response = get_client(self.provider, endpoint).post(
+            "/chat/completions", self._build_payload(endpoint, messages))
+
+        if response.status_code != 200:
+            raise Exception(f"API返回错误: {response.status_code}")
+        response_data = response.json()
+        return Completion(response_data['choices'][0]['message']['content'].strip(),
+                          response_data.get('usage'), response.elapsed.total_seconds())
+
+    def generate_stream(self, prompt, history):
+        """流式生成响应，逐段产出文本"""
+        record = CallRecord(self.name)
+        messages = self._build_messages(prompt, history)
+        cache_key, cached = self._cache_get(messages)
+        if cached is not None:
+            record.finish("cache_hit")
+            yield cached
+            return
+
+        with self._admit(record):
+            record.rate_limit_wait = self._rate_limit(messages)
+
+            if self._api_key_missing():
+                yield self._fallback("API密钥未配置", record)
+                return
+
+            parts = []
+            usage = None
+            start = time.perf_counter()
+            try:
+                for text in self.resilience.stream(self._stream_chunks, messages):
+                    if isinstance(text, Completion):
+                        usage = text.usage
+                    elif text:
+                        if not parts:
+                            record.ttft = time.perf_counter() - start
+                        parts.append(text)
+                        yield text
+            except Exception as e:
+                logger.error(f"{self.display_name} API流式调用失败: {str(e)}")
+                # 已输出部分内容时直接结束，否则降级
+                if not parts:
+                    yield self._fallback(str(e), record)
+                else:
+                    record.finish("error")
+                return
+
+        content = "".join(parts).strip()
+        self._cache_set(cache_key, content)
+        self._finish(record, messages, Completion(content, usage))
+
+    def _stream_chunks(self, endpoint, messages):
+        """读取单个端点的增量输出，按 client 选择调用方式"""
+        if self.client == "openai":
+            return self._stream_openai_chunks(endpoint, messages)
+        return self._stream_http_chunks(endpoint, messages)
+
+    def _stream_http_chunks(self, endpoint, messages):
+        """通过SSE读取OpenAI兼容接口的增量输出"""
+        with get_client(self.provider, endpoint).post(
+            "/chat/completions", self._build_payload(endpoint, messages, stream=True), stream=True
+        ) as response:
+            if response.status_code != 200:
+                raise Exception(f"API返回错误: {response.status_code}")
+
+            response.encoding = 'utf-8'
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                yield from self._read_chunk(json.loads(payload))
+
+    def _complete_openai(self, endpoint, messages):
+        """通过openai SDK调用，按请求传入凭据，避免并发调用时互相覆盖全局配置
+
+        SDK 的连接池按线程共享、不区分服务商，需要独立连接池时使用默认的 http 方式。
+        """
+        response = openai.ChatCompletion.create(
+            api_key=endpoint['api_key'],
+            api_base=endpoint['api_base'],
+            request_timeout=endpoint.get('timeout', 30),
+            **self._build_payload(endpoint, messages)
+        )
+        return Completion(response['choices'][0]['message']['content'].strip(), response.get('usage'))
+
+    def _stream_openai_chunks(self, endpoint, messages):
+        """通过openai SDK读取增量输出"""
+        response = openai.ChatCompletion.create(
+            api_key=endpoint['api_key'],
+            api_base=endpoint['api_base'],
+            request_timeout=endpoint.get('timeout', 30),
+            **self._build_payload(endpoint, messages, stream=True)
+        )
+        for chunk in response:
+            yield from self._read_chunk(chunk)
+
+    @staticmethod
+    def _read_chunk(chunk):
+        """解析一个增量分片：产出文本；附带用量的分片（通常是最后一个）产出空的 Completion"""
+        choices = chunk.get('choices')
+        if choices:
+            yield choices[0].get('delta', {}).get('content') or ''
+        if chunk.get('usage'):
+            yield Completion('', chunk['usage'])
+
+    def _get_async_session(self, endpoint):
+        """获取当前事件循环上该端点的共享连接池"""
+        loop = asyncio.get_running_loop()
+        key = (self.provider, endpoint['api_base'])
+
+        with self._async_pools_lock:
+            pool = self._async_pools.get(key)
+            if pool and pool[0] is loop and not pool[1].closed:
+                return pool[1]
+
+            connector = aiohttp.TCPConnector(
+                limit=endpoint.get('pool_size', 100),
+                limit_per_host=endpoint.get('pool_per_host', 20),
+                keepalive_timeout=endpoint.get('keepalive_timeout', 30)
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=endpoint.get('timeout', 30))
+            )
+            self._async_pools[key] = (loop, session)
+            return session
+
+    async def agenerate(self, prompt, history):
+        """异步生成响应，复用端点的长连接池"""
+        if aiohttp is None:
+            # 未安装aiohttp时退回到线程中执行同步调用
+            return await asyncio.to_thread(self.generate, prompt, history)
+
+        record = CallRecord(self.name)
+        messages = self._build_messages(prompt, history)
+        cache_key, cached = self._cache_get(messages)
+        if cached is not None:
+            record.finish("cache_hit")
+            return cached
+
+        async with self._aadmit(record):
+            record.rate_limit_wait = await self._arate_limit(messages)
+
+            if self._api_key_missing():
+                return self._fallback("API密钥未配置", record)
+
+            try:
+                content = await self.resilience.acall(self._acomplete, messages, self._try_acquire_hedge(messages))
+            except Exception as e:
+                logger.error(f"{self.display_name} API调用失败: {str(e)}")
+                return self._fallback(str(e), record)
+
+        self._cache_set(cache_key, content)
+        return self._finish(record, messages, content)
+
+    async def _acomplete(self, endpoint, messages):
+        """通过共享连接池向单个端点发起一次异步调用"""
+        session = self._get_async_session(endpoint)
+        start = time.perf_counter()
+        async with session.post(
+            f"{endpoint['api_base']}/chat/completions",
+            headers=self._headers(endpoint),
+            json=self._build_payload(endpoint, messages)
+        ) as response:
+            connect_time = time.perf_counter() - start
+            if response.status != 200:
+                raise Exception(f"API返回错误: {response.status}")
+            response_data = await response.json()
+        return Completion(response_data['choices'][0]['message']['content'].strip(),
+                          response_data.get('usage'), connect_time)
+
+    async def agenerate_stream(self, prompt, history):
+        """异步流式生成响应，逐段产出文本"""
+        if aiohttp is None:
+            # 未安装aiohttp时在线程中推进同步生成器
+            chunks = self.generate_stream(prompt, history)
+            while (text := await asyncio.to_thread(next, chunks, None)) is not None:
+                yield text
+            return
+
+        record = CallRecord(self.name)
+        messages = self._build_messages(prompt, history)
+        cache_key, cached = self._cache_get(messages)
+        if cached is not None:
+            record.finish("cache_hit")
+            yield cached
+            return
+
+        async with self._aadmit(record):
+            record.rate_limit_wait = await self._arate_limit(messages)
+
+            if self._api_key_missing():
+                yield self._fallback("API密钥未配置", record)
+                return
+
+            parts = []
+            usage = None
+            start = time.perf_counter()
+            try:
+                async for text in self.resilience.astream(self._astream_chunks, messages):
+                    if isinstance(text, Completion):
+                        usage = text.usage
+                    elif text:
+                        if not parts:
+                            record.ttft = time.perf_counter() - start
+                        parts.append(text)
+                        yield text
+            except Exception as e:
+                logger.error(f"{self.display_name} API流式调用失败: {str(e)}")
+                if not parts:
+                    yield self._fallback(str(e), record)
+                else:
+                    record.finish("error")
+                return
+
+        content = "".join(parts).strip()
+        self._cache_set(cache_key, content)
+        self._finish(record, messages, Completion(content, usage))
+
+    async def _astream_chunks(self, endpoint, messages):
+        """通过共享连接池读取OpenAI兼容接口的SSE增量输出"""
+        session = self._get_async_session(endpoint)
+        async with session.post(
+            f"{endpoint['api_base']}/chat/completions",
+            headers=self._headers(endpoint),
+            json=self._build_payload(endpoint, messages, stream=True)
+        ) as response:
+            if response.status != 200:
+                raise Exception(f"API返回错误: {response.status}")
+
+            async for raw_line in response.content:
+                line = raw_line.decode('utf-8').strip()
+                if not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                for text in self._read_chunk(json.loads(payload)):
+                    yield text
 
     def _get_mock_response(self, model_name):
         """生成模拟响应，用于演示"""
@@ -50,129 +488,61 @@ class BaseModelAdapter:
         return random.choice(model_responses)
 
 
-class DeepSeekAdapter(BaseModelAdapter):
-    def generate(self, prompt, history):
-        self._rate_limit()
+# 适配器类型注册表：model_configs 中的 type -> 适配器类
+ADAPTER_TYPES = {}
 
-        # 检查API密钥配置
-        if not self.config.get('api_key') or self.config['api_key'] == 'your_deepseek_api_key_here':
-            print("[INFO] DeepSeek API密钥未配置，使用模拟响应")
-            return self._get_mock_response("DeepSeek")
 
-        try:
-            openai.api_key = self.config['api_key']
-            openai.api_base = self.config['api_base']
-
-            # 构建消息
-            messages = []
-            for msg in history[-5:]:  # 只取最近5条历史
-                if ": " in msg:
-                    role, content = msg.split(": ", 1)
-                    messages.append({
-                        "role": "assistant" if role in ["DeepSeek", "Doubao", "Wenxin"] else "user",
-                        "content": content
-                    })
-
-            messages.append({"role": "user", "content": prompt})
-
-            response = openai.ChatCompletion.create(
-                model=self.config['model'],
-                messages=messages,
-                temperature=self.config.get('temperature', 0.7),
-                max_tokens=200
-            )
-            return response['choices'][0]['message']['content'].strip()
+def register_adapter(type_name):
+    """注册适配器类型，接口不兼容OpenAI的服务商可以继承 BaseModelAdapter 后注册"""
+    def decorator(adapter_class):
+        ADAPTER_TYPES[type_name] = adapter_class
+        return adapter_class
+    return decorator
 
-        except Exception as e:
-            print(f"[ERROR] DeepSeek API调用失败: {str(e)}")
-            return self._get_mock_response("DeepSeek")
 
+def get_adapter_class(key, model_config):
+    """查找模型配置对应的适配器类：优先使用 type，其次按配置键匹配内置服务商，否则使用通用适配器"""
+    type_name = model_config.get('type') or (key if key in ADAPTER_TYPES else "openai")
+    try:
+        return ADAPTER_TYPES[type_name]
+    except KeyError:
+        raise ValueError(f"未知的适配器类型: {type_name}")
 
-class DoubaoAdapter(BaseModelAdapter):
-    def generate(self, prompt, history):
-        self._rate_limit()
 
-        # 检查API密钥配置
-        if not self.config.get('api_key') or self.config['api_key'] == 'your_doubao_api_key_here':
-            print("[INFO] 豆包API密钥未配置，使用模拟响应")
-            return self._get_mock_response("Doubao")
+@register_adapter("openai")
+class OpenAICompatibleAdapter(BaseModelAdapter):
+    """通用的OpenAI兼容适配器，名称、端点、调用方式和角色设定全部来自配置"""
 
-        try:
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.config['api_key']}"
-            }
-
-            # 构建消息
-            messages = []
-            for msg in history[-5:]:  # 只取最近5条历史
-                if ": " in msg:
-                    role, content = msg.split(": ", 1)
-                    messages.append({
-                        "role": "assistant" if role in ["DeepSeek", "Doubao", "Wenxin"] else "user",
-                        "content": content
-                    })
-
-            messages.append({"role": "user", "content": prompt})
-
-            data = {
-                "model": self.config['model'],
-                "messages": messages,
-                "temperature": self.config.get('temperature', 0.7),
-                "max_tokens": 200
-            }
-
-            response = requests.post(
-                f"{self.config['api_base']}/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
 
-            if response.status_code == 200:
-                response_data = response.json()
-                return response_data['choices'][0]['message']['content'].strip()
-            else:
-                raise Exception(f"API返回错误: {response.status_code}")
+@register_adapter("deepseek")
+class DeepSeekAdapter(OpenAICompatibleAdapter):
+    name = "DeepSeek"
+    display_name = "DeepSeek"
+    placeholder_key = "your_deepseek_api_key_here"
 
-        except Exception as e:
-            print(f"[ERROR] 豆包API调用失败: {str(e)}")
-            return self._get_mock_response("Doubao")
 
+@register_adapter("doubao")
+class DoubaoAdapter(OpenAICompatibleAdapter):
+    name = "Doubao"
+    display_name = "豆包"
+    placeholder_key = "your_doubao_api_key_here"
 
-class WenxinAdapter(BaseModelAdapter):
-    def generate(self, prompt, history):
-        self._rate_limit()
 
-        # 检查API密钥配置
-        if not self.config.get('api_key') or self.config['api_key'] == 'your_wenxin_api_key_here':
-            print("[INFO] 文心一言API密钥未配置，使用模拟响应")
-            return self._get_mock_response("Wenxin")
+@register_adapter("wenxin")
+class WenxinAdapter(OpenAICompatibleAdapter):
+    name = "Wenxin"
+    display_name = "文心一言"
+    placeholder_key = "your_wenxin_api_key_here"
 
-        try:
-            openai.api_key = self.config['api_key']
-            openai.api_base = self.config['api_base']
-
-            # 构建消息
-            messages = []
-            for msg in history[-5:]:  # 只取最近5条历史
-                if ": " in msg:
-                    role, content = msg.split(": ", 1)
-                    messages.append({
-                        "role": "assistant" if role in ["DeepSeek", "Doubao", "Wenxin"] else "user",
-                        "content": content
-                    })
-
-            messages.append({"role": "user", "content": prompt})
-
-            response = openai.ChatCompletion.create(
-                model=self.config['model'],
-                messages=messages,
-                temperature=self.config.get('temperature', 0.7),
-                max_tokens=200
-            )
-            return response['choices'][0]['message']['content'].strip()
 
-        except Exception as e:
-            print(f"[ERROR] 文心一言API调用失败: {str(e)}")
-            return self._get_mock_response("Wenxin")
\ No newline at end of file
+async def close_async_pools():
+    """关闭当前事件循环上的所有共享连接池"""
+    loop = asyncio.get_running_loop()
+    with BaseModelAdapter._async_pools_lock:
+        pools = [(key, session) for key, (pool_loop, session)
+                 in BaseModelAdapter._async_pools.items() if pool_loop is loop]
+        for key, _ in pools:
+            BaseModelAdapter._async_pools.pop(key, None)
+
+    for _, session in pools:
+        await session.close()
\ No newline at end of file
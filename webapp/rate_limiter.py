@@ -0,0 +1,162 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucketScheduler:
+    """单个服务商的令牌桶调度器，同时限制每秒请求数(RPS)和每分钟token数(TPM)
+
+    调用方先预约额度，桶允许透支：透支部分换算成等待时间返回给调用方，
+    后到的请求排在先到请求之后，因此整体按FIFO顺序放行。
+    """
+
+    def __init__(self, name, rps=5.0, burst=None, tpm=None):
+        self.name = name
+        self._lock = threading.Lock()
+        self._set_limits(rps, burst, tpm)
+        self._request_tokens = self.burst
+        self._tpm_tokens = self.tpm or 0.0
+        self._last_refill = time.monotonic()
+
+        # 统计信息
+        self._pending = 0
+        self._requests = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _set_limits(self, rps, burst, tpm):
+        self.rps = float(rps)
+        self.burst = float(burst or max(1.0, self.rps))
+        self.tpm = float(tpm) if tpm else None
+
+    def configure(self, rps=5.0, burst=None, tpm=None):
+        """重新加载配置时更新限额，已预约（透支）的额度保留，剩余额度不超过新的上限"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._set_limits(rps, burst, tpm)
+            self._request_tokens = min(self._request_tokens, self.burst)
+            self._tpm_tokens = min(self._tpm_tokens, self.tpm) if self.tpm else 0.0
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_tokens = min(self.burst, self._request_tokens + elapsed * self.rps)
+        if self.tpm:
+            self._tpm_tokens = min(self.tpm, self._tpm_tokens + elapsed * self.tpm / 60.0)
+
+    def reserve(self, tokens=0):
+        """预约一次调用，返回需要等待的秒数（不阻塞）"""
+        with self._lock:
+            self._refill(time.monotonic())
+
+            self._request_tokens -= 1
+            wait = max(0.0, -self._request_tokens / self.rps)
+
+            if self.tpm and tokens:
+                self._tpm_tokens -= tokens
+                wait = max(wait, -self._tpm_tokens / (self.tpm / 60.0))
+
+            self._requests += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+            return wait
+
+    def try_acquire(self, tokens=0):
+        """额度充足时立即占用并返回True，否则不占用额度直接返回False"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._request_tokens < 1:
+                return False
+            if self.tpm and tokens and self._tpm_tokens < tokens:
+                return False
+
+            self._request_tokens -= 1
+            if self.tpm and tokens:
+                self._tpm_tokens -= tokens
+            self._requests += 1
+            return True
+
+    def acquire(self, tokens=0):
+        """同步获取调用额度"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            self._track_pending(1)
+            try:
+                time.sleep(wait)
+            finally:
+                self._track_pending(-1)
+        return wait
+
+    async def aacquire(self, tokens=0):
+        """异步获取调用额度，等待期间不占用线程"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            self._track_pending(1)
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self._track_pending(-1)
+        return wait
+
+    def _track_pending(self, delta):
+        with self._lock:
+            self._pending += delta
+
+    def stats(self):
+        """返回排队深度和等待时间统计"""
+        with self._lock:
+            return {
+                "provider": self.name,
+                "rps": self.rps,
+                "tpm": self.tpm,
+                "queue_depth": self._pending,
+                "requests": self._requests,
+                "total_wait": round(self._total_wait, 3),
+                "avg_wait": round(self._total_wait / self._requests, 3) if self._requests else 0.0,
+                "max_wait": round(self._max_wait, 3)
+            }
+
+
+# 进程级调度器注册表，每个服务商一个
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+# 共享同一服务商额度的工作进程数，由 server.py 在导入应用之前设置
+_worker_count = 1
+
+
+def set_worker_count(workers):
+    """多个工作进程时每个进程的调度器和准入闸门只使用 1/workers 的额度"""
+    global _worker_count
+    _worker_count = max(1, int(workers))
+
+
+def worker_count():
+    return _worker_count
+
+
+def get_scheduler(name, config, reconfigure=False):
+    """获取服务商的共享调度器，首次使用时按配置创建；多进程部署时按进程数均分额度
+
+    reconfigure 为True时（重新加载配置）按 config 更新已有调度器的限额。
+    """
+    burst, tpm = config.get('burst'), config.get('tpm')
+    limits = {
+        "rps": config.get('rps', 5.0) / _worker_count,
+        "burst": max(1.0, burst / _worker_count) if burst else None,
+        "tpm": tpm / _worker_count if tpm else None
+    }
+    with _schedulers_lock:
+        scheduler = _schedulers.get(name)
+        if scheduler is None:
+            scheduler = _schedulers[name] = TokenBucketScheduler(name, **limits)
+        elif reconfigure:
+            scheduler.configure(**limits)
+        return scheduler
+
+
+def scheduler_stats():
+    """返回所有服务商调度器的统计信息"""
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    return {scheduler.name: scheduler.stats() for scheduler in schedulers}
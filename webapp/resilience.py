@@ -0,0 +1,350 @@
+import asyncio
+import contextvars
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError as FutureTimeout, wait
+
+
+class FallbackResponse(str):
+    """降级时返回的模拟响应，调用方可用 isinstance 识别"""
+    is_fallback = True
+
+
+class ProviderUnavailableError(Exception):
+    """所有端点都不可用且未启用模拟响应降级"""
+
+
+class LatencyTracker:
+    """记录最近的调用耗时，用于计算对冲延迟"""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p, min_samples=20):
+        """样本不足时返回None"""
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * p / 100))
+        return ordered[index]
+
+
+class CircuitBreaker:
+    """熔断器：连续失败达到阈值后打开，冷却后放行一次试探请求"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release(self):
+        """调用被取消等没有结果时释放试探名额，否则半开的熔断器不再放行任何请求"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+# 进程级状态：按端点共享熔断器和耗时统计，按服务商统计降级和对冲次数
+_breakers = {}
+_trackers = {}
+_fallback_counts = Counter()
+_hedge_counts = Counter()
+_state_lock = threading.Lock()
+
+
+def _endpoint_key(endpoint):
+    return f"{endpoint['api_base']}#{endpoint['model']}"
+
+
+class ResiliencePolicy:
+    """单个服务商的调用策略：熔断、按p95延迟对冲、按配置顺序故障转移"""
+
+    def __init__(self, name, endpoints, hedge=False, hedge_percentile=95, hedge_min_delay=1.0,
+                 failure_threshold=5, reset_timeout=30, mock_fallback=True, hedge_workers=32):
+        self.name = name
+        self.endpoints = endpoints
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.mock_fallback = mock_fallback
+
+        # 同步对冲调用使用的线程池：只在有空闲线程时提交，线程用尽时在调用方线程中直接调用，
+        # 因此调用不会在线程池中排队
+        self._hedge_executor = None
+        self._hedge_threads = threading.BoundedSemaphore(hedge_workers)
+        if hedge:
+            self._hedge_executor = ThreadPoolExecutor(max_workers=hedge_workers,
+                                                      thread_name_prefix=f"hedge-{name}")
+
+        with _state_lock:
+            for endpoint in endpoints:
+                key = _endpoint_key(endpoint)
+                _breakers.setdefault(key, CircuitBreaker(failure_threshold, reset_timeout))
+                _trackers.setdefault(key, LatencyTracker())
+
+    def _available_endpoints(self):
+        for endpoint in self.endpoints:
+            key = _endpoint_key(endpoint)
+            if _breakers[key].allow():
+                yield endpoint, _breakers[key], _trackers[key]
+
+    def call(self, complete, messages, try_acquire=None):
+        """按顺序尝试各端点，complete(endpoint, messages) 发起一次实际调用"""
+        errors = []
+        for endpoint, breaker, tracker in self._available_endpoints():
+            try:
+                result = self._call_endpoint(complete, endpoint, messages, tracker, try_acquire)
+            except Exception as e:
+                breaker.record_failure()
+                errors.append(f"{endpoint['api_base']}: {str(e)}")
+                continue
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.record_success()
+            return result
+        raise ProviderUnavailableError("; ".join(errors) or "所有端点均处于熔断状态")
+
+    def _start(self, complete, endpoint, messages, tracker):
+        """在对冲线程池中发起一次调用，调用方需已占用一个线程名额"""
+        def run():
+            try:
+                return self._timed(complete, endpoint, messages, tracker)
+            finally:
+                self._hedge_threads.release()
+        return self._hedge_executor.submit(contextvars.copy_context().run, run)
+
+    def _call_endpoint(self, complete, endpoint, messages, tracker, try_acquire):
+        delay = self._hedge_delay(tracker)
+        if delay is None or not self._hedge_threads.acquire(blocking=False):
+            return self._timed(complete, endpoint, messages, tracker)
+
+        primary = self._start(complete, endpoint, messages, tracker)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeout:
+            pass
+
+        # 没有空闲线程或限流额度不足时不发对冲请求，避免加重服务商负载
+        if not self._hedge_threads.acquire(blocking=False):
+            return primary.result()
+        if try_acquire is not None and not try_acquire():
+            self._hedge_threads.release()
+            return primary.result()
+
+        with _state_lock:
+            _hedge_counts[self.name] += 1
+        backup = self._start(complete, endpoint, messages, tracker)
+
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+        raise error
+
+    async def acall(self, acomplete, messages, try_acquire=None):
+        """call 的异步版本"""
+        errors = []
+        for endpoint, breaker, tracker in self._available_endpoints():
+            try:
+                result = await self._acall_endpoint(acomplete, endpoint, messages, tracker, try_acquire)
+            except Exception as e:
+                breaker.record_failure()
+                errors.append(f"{endpoint['api_base']}: {str(e)}")
+                continue
+            except BaseException:
+                breaker.release()
+                raise
+            breaker.record_success()
+            return result
+        raise ProviderUnavailableError("; ".join(errors) or "所有端点均处于熔断状态")
+
+    async def _acall_endpoint(self, acomplete, endpoint, messages, tracker, try_acquire):
+        delay = self._hedge_delay(tracker)
+        primary = asyncio.ensure_future(self._atimed(acomplete, endpoint, messages, tracker))
+        if delay is None:
+            return await primary
+
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or (try_acquire is not None and not try_acquire()):
+            return await primary
+
+        with _state_lock:
+            _hedge_counts[self.name] += 1
+        backup = asyncio.ensure_future(self._atimed(acomplete, endpoint, messages, tracker))
+
+        pending = {primary, backup}
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    return task.result()
+                error = task.exception()
+        raise error
+
+    def stream(self, open_stream, messages):
+        """流式调用：在收到首个分片之前失败时切换到下一个端点"""
+        errors = []
+        for endpoint, breaker, tracker in self._available_endpoints():
+            start = time.monotonic()
+            try:
+                chunks = open_stream(endpoint, messages)
+                first = next(chunks, None)
+            except Exception as e:
+                breaker.record_failure()
+                errors.append(f"{endpoint['api_base']}: {str(e)}")
+                continue
+            except BaseException:
+                breaker.release()
+                raise
+
+            breaker.record_success()
+            tracker.record(time.monotonic() - start)
+            if first is not None:
+                yield first
+            yield from chunks
+            return
+        raise ProviderUnavailableError("; ".join(errors) or "所有端点均处于熔断状态")
+
+    async def astream(self, open_stream, messages):
+        """stream 的异步版本，open_stream 返回异步迭代器"""
+        errors = []
+        for endpoint, breaker, tracker in self._available_endpoints():
+            start = time.monotonic()
+            try:
+                chunks = open_stream(endpoint, messages)
+                first = await anext(chunks, None)
+            except Exception as e:
+                breaker.record_failure()
+                errors.append(f"{endpoint['api_base']}: {str(e)}")
+                continue
+            except BaseException:
+                breaker.release()
+                raise
+
+            breaker.record_success()
+            tracker.record(time.monotonic() - start)
+            if first is not None:
+                yield first
+            async for chunk in chunks:
+                yield chunk
+            return
+        raise ProviderUnavailableError("; ".join(errors) or "所有端点均处于熔断状态")
+
+    def _hedge_delay(self, tracker):
+        if not self.hedge:
+            return None
+        p = tracker.percentile(self.hedge_percentile)
+        if p is None:
+            return None
+        return max(self.hedge_min_delay, p)
+
+    @staticmethod
+    def _timed(complete, endpoint, messages, tracker):
+        start = time.monotonic()
+        result = complete(endpoint, messages)
+        tracker.record(time.monotonic() - start)
+        return result
+
+    @staticmethod
+    async def _atimed(acomplete, endpoint, messages, tracker):
+        start = time.monotonic()
+        result = await acomplete(endpoint, messages)
+        tracker.record(time.monotonic() - start)
+        return result
+
+    def record_fallback(self):
+        """记录一次降级为模拟响应"""
+        with _state_lock:
+            _fallback_counts[self.name] += 1
+
+
+def create_resilience_policy(name, system_config, model_config):
+    """按系统配置和模型配置创建调用策略
+
+    模型配置中的 failover 列表依次作为备用端点，未填写的字段继承主端点配置。
+    """
+    primary = {key: value for key, value in model_config.items() if key != 'failover'}
+    endpoints = [primary] + [dict(primary, **backup) for backup in model_config.get('failover') or []]
+
+    breaker_config = system_config.get('circuit_breaker') or {}
+    # 每个在途调用最多占用主请求和对冲请求两个线程，默认按准入的在途上限确定线程数
+    max_in_flight = model_config.get('max_in_flight',
+                                     (system_config.get('admission') or {}).get('max_in_flight', 16))
+    return ResiliencePolicy(
+        name,
+        endpoints,
+        hedge=model_config.get('hedge', system_config.get('hedge', False)),
+        hedge_percentile=system_config.get('hedge_percentile', 95),
+        hedge_min_delay=system_config.get('hedge_min_delay', 1.0),
+        failure_threshold=breaker_config.get('failure_threshold', 5),
+        reset_timeout=breaker_config.get('reset_timeout', 30),
+        mock_fallback=system_config.get('mock_fallback', True),
+        hedge_workers=system_config.get('hedge_workers', 2 * max_in_flight)
+    )
+
+
+def resilience_stats():
+    """返回熔断器状态、p95耗时、对冲和降级次数"""
+    with _state_lock:
+        breakers = dict(_breakers)
+        trackers = dict(_trackers)
+        fallbacks = dict(_fallback_counts)
+        hedges = dict(_hedge_counts)
+
+    endpoints = {}
+    for key, breaker in breakers.items():
+        p95 = trackers[key].percentile(95, min_samples=1)
+        endpoints[key] = {
+            "state": breaker.state,
+            "p95_latency": round(p95, 3) if p95 is not None else None
+        }
+    return {"endpoints": endpoints, "fallbacks": fallbacks, "hedges": hedges}
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """模型响应缓存：内存LRU + TTL，可选SQLite磁盘层
+
+    以请求体 (model, messages, temperature, max_tokens) 的规范化哈希为键，
+    只缓存真实的API响应，模拟响应和错误不会写入缓存。
+    """
+
+    def __init__(self, max_entries=1000, ttl=3600, disk_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (过期时间, 响应文本)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        # 磁盘层读写不持有 _lock，_lock 只保护内存LRU和计数
+        self.disk_path = disk_path
+        self._local = threading.local()
+        if disk_path:
+            db = self._db()
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            db.commit()
+
+    def _db(self):
+        # sqlite3 连接不能跨线程共享，每个线程各自持有一个
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.disk_path, timeout=10)
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def make_key(payload):
+        """计算请求体的规范化哈希"""
+        canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """查询缓存，未命中或已过期时返回None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+        value = self._disk_get(key, now)
+        with self._lock:
+            if value is not None:
+                self._remember(key, value[1], value[0])
+                self.hits += 1
+                self.disk_hits += 1
+                return value[1]
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        """写入缓存"""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, value, expires_at)
+        if self.disk_path:
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at)
+            )
+            db.commit()
+
+    def _remember(self, key, value, expires_at):
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_get(self, key, now):
+        if not self.disk_path:
+            return None
+        db = self._db()
+        row = db.execute(
+            "SELECT expires_at, value FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[0] <= now:
+            db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            db.commit()
+            return None
+        return row
+
+    def stats(self):
+        """返回命中统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0
+            }
+
+
+def create_response_cache(config):
+    """根据 system.response_cache 配置创建缓存，未启用时返回None"""
+    cache_config = config.get('response_cache') or {}
+    if not cache_config.get('enabled'):
+        return None
+    return ResponseCache(
+        max_entries=cache_config.get('max_entries', 1000),
+        ttl=cache_config.get('ttl', 3600),
+        disk_path=cache_config.get('disk_path')
+    )
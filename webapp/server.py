@@ -0,0 +1,114 @@
+import argparse
+import logging
+import multiprocessing
+import signal
+import socket
+from multiprocessing.connection import wait
+
+import yaml
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("Server")
+
+
+def load_server_config(config_path="config.yaml"):
+    """读取 system.server 以及检查部署方式所需的配置"""
+    with open(config_path) as f:
+        system = yaml.safe_load(f)['system']
+    return system.get('server') or {}, system
+
+
+def _bind(host, port):
+    """在主进程中创建监听套接字，所有工作进程共享同一个套接字接受连接"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    return sock
+
+
+def _serve(mode, sock, workers=1):
+    """工作进程入口：启动后才导入应用，每个进程有独立的线程、连接池和事件循环"""
+    # 恢复从主进程继承的信号处理，收到 SIGTERM 时直接退出
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    # 限流调度器和准入闸门在每个进程内独立计数，按进程数均分额度，避免总额度随进程数成倍增加
+    from rate_limiter import set_worker_count
+    set_worker_count(workers)
+    if mode == "async":
+        from aiohttp import web
+        from async_app import create_app
+        web.run_app(create_app(), sock=sock, print=None)
+    else:
+        from werkzeug.serving import make_server
+        from app import app
+        host, port = sock.getsockname()[:2]
+        make_server(host, port, app, threaded=True, fd=sock.fileno()).serve_forever()
+
+
+def _supervise(mode, sock, workers):
+    """启动工作进程，异常退出的进程会被重新拉起"""
+    processes = []
+    stopping = False
+
+    def spawn():
+        process = multiprocessing.Process(target=_serve, args=(mode, sock, workers))
+        process.start()
+        processes.append(process)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in processes:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        spawn()
+
+    while processes:
+        wait([process.sentinel for process in processes], timeout=1)
+        for process in [p for p in processes if not p.is_alive()]:
+            processes.remove(process)
+            if not stopping:
+                logger.warning(f"工作进程 {process.pid} 退出（退出码 {process.exitcode}），重新启动")
+                spawn()
+
+
+def main():
+    server_config, system = load_server_config()
+
+    parser = argparse.ArgumentParser(description="多模型对话系统服务启动器")
+    parser.add_argument("--mode", choices=["thread", "async"], default=server_config.get('mode', 'thread'),
+                        help="thread: Flask多线程服务; async: aiohttp异步服务，等待模型响应时不占用线程")
+    parser.add_argument("--workers", type=int, default=server_config.get('workers', 1),
+                        help="工作进程数")
+    parser.add_argument("--host", default=server_config.get('host', '0.0.0.0'))
+    parser.add_argument("--port", type=int, default=server_config.get('port', 5000))
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        # 每个工作进程有自己的内存，会话需要放在共享存储中
+        if (system.get('session_store') or {}).get('backend', 'memory') == 'memory':
+            logger.warning("多个工作进程时请使用 session_store.backend: sqlite，内存存储的会话只在单个进程内可见")
+        if (system.get('pipelining') or {}).get('enabled'):
+            logger.warning("预生成执行器保存在单个进程内，多个工作进程共享端口时无法保证会话粘滞")
+        logger.info(f"各服务商的 rps/tpm/burst 和准入 max_in_flight/max_queue 按 {args.workers} 个工作进程均分")
+
+    sock = _bind(args.host, args.port)
+    print(f"[INFO] 启动多模型对话系统（{args.mode} 模式，{args.workers} 个工作进程）...")
+    print(f"[INFO] 访问地址: http://localhost:{args.port}")
+
+    if args.workers <= 1:
+        _serve(args.mode, sock)
+    else:
+        _supervise(args.mode, sock, args.workers)
+
+
+if __name__ == '__main__':
+    main()
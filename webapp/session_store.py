@@ -0,0 +1,258 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dialogue_engine import ConversationState
+
+
+class SessionStore:
+    """会话存储接口
+
+    会话记录是一个字典，其中 'state' 为 ConversationState，其余字段为可JSON序列化的元数据。
+    所有会话的有效期相同，过期时间随 put/touch 刷新，过期清理按过期时间索引进行。
+    """
+
+    def __init__(self, ttl=7200):
+        self.ttl = ttl
+
+    def get(self, session_id):
+        """读取会话的副本，不存在或已过期时返回None；修改副本后需要 put 才会保存"""
+        raise NotImplementedError
+
+    def put(self, session_id, record):
+        """保存会话并刷新过期时间；已保存的滚动摘要比 record 中的更新时保留已保存的摘要"""
+        raise NotImplementedError
+
+    def add(self, session_id, record, max_sessions=None):
+        """保存新会话；会话数已达到 max_sessions 时不保存并返回False，计数和写入是原子的"""
+        raise NotImplementedError
+
+    def update_summary(self, session_id, summary, summarized_upto):
+        """写回后台完成的滚动摘要，只在比已保存的摘要更新时生效"""
+        raise NotImplementedError
+
+    def touch(self, session_id):
+        """刷新会话过期时间，会话不存在时返回False"""
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    def expire(self):
+        """清理过期会话，返回清理的数量"""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+def _newer_summary(state, summary, summarized_upto):
+    """已保存的摘要覆盖的发言更多、且仍在 state 的发言记录范围内时返回True"""
+    return state.summarized_upto < summarized_upto <= len(state.history)
+
+
+class MemorySessionStore(SessionStore):
+    """进程内存储，按最近活跃顺序排列，过期清理只检查最旧的一端
+
+    get 返回副本，与 SQLite 存储一致：请求失败时未保存的修改（如已推进的发言顺序）不会生效。
+    """
+
+    def __init__(self, ttl=7200):
+        super().__init__(ttl)
+        self._records = OrderedDict()  # session_id -> (过期时间, 记录)
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            item = self._records.get(session_id)
+            if item is None:
+                return None
+            if item[0] <= time.time():
+                del self._records[session_id]
+                return None
+            record = item[1]
+        return dict(record, state=record['state'].copy())
+
+    def put(self, session_id, record):
+        with self._lock:
+            item = self._records.get(session_id)
+            if item is not None:
+                saved = item[1]['state']
+                if _newer_summary(record['state'], saved.summary, saved.summarized_upto):
+                    record['state'].summary = saved.summary
+                    record['state'].summarized_upto = saved.summarized_upto
+            self._records[session_id] = (time.time() + self.ttl, record)
+            self._records.move_to_end(session_id)
+
+    def add(self, session_id, record, max_sessions=None):
+        with self._lock:
+            if max_sessions is not None and len(self._records) >= max_sessions:
+                return False
+            self._records[session_id] = (time.time() + self.ttl, record)
+            return True
+
+    def update_summary(self, session_id, summary, summarized_upto):
+        with self._lock:
+            item = self._records.get(session_id)
+            if item is not None and _newer_summary(item[1]['state'], summary, summarized_upto):
+                item[1]['state'].summary = summary
+                item[1]['state'].summarized_upto = summarized_upto
+
+    def touch(self, session_id):
+        with self._lock:
+            item = self._records.get(session_id)
+            if item is None:
+                return False
+            item[1]['last_active'] = time.time()
+            self._records[session_id] = (time.time() + self.ttl, item[1])
+            self._records.move_to_end(session_id)
+            return True
+
+    def delete(self, session_id):
+        with self._lock:
+            self._records.pop(session_id, None)
+
+    def expire(self):
+        now = time.time()
+        expired = 0
+        with self._lock:
+            while self._records:
+                session_id, (expires_at, _) = next(iter(self._records.items()))
+                if expires_at > now:
+                    break
+                self._records.popitem(last=False)
+                expired += 1
+        return expired
+
+    def __len__(self):
+        return len(self._records)
+
+
+class SQLiteSessionStore(SessionStore):
+    """SQLite存储，可在多个工作进程间共享，重启后会话仍然有效"""
+
+    def __init__(self, path="sessions.db", ttl=7200):
+        super().__init__(ttl)
+        self.path = path
+        self._local = threading.local()
+
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions "
+            "(id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)")
+        db.commit()
+
+    def _db(self):
+        # sqlite3 连接不能跨线程共享，每个线程各自持有一个
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            self._local.db = db
+        return db
+
+    @staticmethod
+    def _dumps(record):
+        data = dict(record)
+        data['state'] = record['state'].to_dict()
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+    @staticmethod
+    def _loads(text):
+        record = json.loads(text)
+        record['state'] = ConversationState.from_dict(record['state'])
+        return record
+
+    def get(self, session_id):
+        row = self._db().execute(
+            "SELECT data FROM sessions WHERE id = ? AND expires_at > ?",
+            (session_id, time.time())
+        ).fetchone()
+        return self._loads(row[0]) if row else None
+
+    def put(self, session_id, record):
+        db = self._db()
+        # 读取已保存的摘要和写入放在同一个事务中，后台摘要的写回不会被较旧的状态覆盖
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT json_extract(data, '$.state.summary'), json_extract(data, '$.state.summarized_upto') "
+                "FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+            if row is not None and _newer_summary(record['state'], row[0], row[1]):
+                record['state'].summary, record['state'].summarized_upto = row
+            db.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                (session_id, self._dumps(record), time.time() + self.ttl)
+            )
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+
+    def add(self, session_id, record, max_sessions=None):
+        db = self._db()
+        # 计数和插入放在同一个写事务中，多个工作进程同时创建会话也不会超过上限
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if max_sessions is not None:
+                count = db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+                if count >= max_sessions:
+                    db.rollback()
+                    return False
+            db.execute(
+                "INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                (session_id, self._dumps(record), time.time() + self.ttl)
+            )
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+        return True
+
+    def update_summary(self, session_id, summary, summarized_upto):
+        db = self._db()
+        db.execute(
+            "UPDATE sessions SET data = json_set(data, '$.state.summary', ?, '$.state.summarized_upto', ?) "
+            "WHERE id = ? AND json_extract(data, '$.state.summarized_upto') < ? "
+            "AND json_array_length(data, '$.state.history') >= ?",
+            (summary, summarized_upto, session_id, summarized_upto, summarized_upto)
+        )
+        db.commit()
+
+    def touch(self, session_id):
+        now = time.time()
+        db = self._db()
+        cursor = db.execute(
+            "UPDATE sessions SET expires_at = ?, "
+            "data = json_set(data, '$.last_active', ?) WHERE id = ? AND expires_at > ?",
+            (now + self.ttl, now, session_id, now)
+        )
+        db.commit()
+        return cursor.rowcount > 0
+
+    def delete(self, session_id):
+        db = self._db()
+        db.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        db.commit()
+
+    def expire(self):
+        db = self._db()
+        cursor = db.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+        db.commit()
+        return cursor.rowcount
+
+    def __len__(self):
+        return self._db().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+def create_session_store(system_config):
+    """根据 system.session_store 配置创建会话存储"""
+    store_config = system_config.get('session_store') or {}
+    ttl = store_config.get('ttl', 7200)
+    if store_config.get('backend', 'memory') == 'sqlite':
+        return SQLiteSessionStore(store_config.get('path', 'sessions.db'), ttl)
+    return MemorySessionStore(ttl)
@@ -8,6 +8,7 @@ let discussionState = {
     responses: [],
     isConnected: false,
     sessionId: null,
+    models: [], // 参与讨论的模型，按发言顺序
     messageStyle: 'card', // 'card' 或 'bubble'
     lastProcessedResponseIndex: 0, // 防止重复处理响应
     renderedResponsesCount: 0 // 记录已渲染的响应数量
@@ -55,6 +56,9 @@ let currentThinkingIndicator = null;
 let typingTimeouts = [];
 let isProcessingResponse = false; // 防止并发处理
 let responseQueue = []; // 响应队列
+// 获取方式：默认通过推送通道接收全部发言（/events）；?fetch=next 时逐条流式获取（/next），
+// ?fetch=turn 时按整轮批量获取（/turn）
+const fetchMode = new URLSearchParams(window.location.search).get('fetch') || localStorage.getItem('fetchMode') || 'push';
 
 // 自定义音效管理
 const audioManager = {
@@ -193,6 +197,13 @@ async function keepSessionAlive() {
 
 // 启动保活定时器
 function startKeepAlive() {
+    // 推送模式下由推送通道保活并反映连接状态，不再定时轮询，只在网络状态变化时重新检查
+    if (fetchMode === 'push') {
+        window.addEventListener('online', checkServerConnection);
+        window.addEventListener('offline', () => updateConnectionStatus(false));
+        return;
+    }
+
     // 每30秒检查连接状态
     setInterval(checkServerConnection, 30000);
 
@@ -311,6 +322,10 @@ async function startDiscussion() {
         const data = await response.json();
 
         if (!response.ok) {
+            const delay = retryDelay(response);
+            if (delay !== null) {
+                throw new Error(`${data.error || '服务繁忙'}（约 ${delay / 1000} 秒后可重试）`);
+            }
             throw new Error(data.error || '启动失败');
         }
 
@@ -318,6 +333,7 @@ async function startDiscussion() {
         discussionState.isActive = true;
         discussionState.topic = data.topic;
         discussionState.totalTurns = data.max_turns;
+        discussionState.models = data.models || [];
         discussionState.currentTurn = 1; // 从1开始
 
         // 从localStorage恢复用户偏好
@@ -332,7 +348,13 @@ async function startDiscussion() {
         hideError();
 
         // 开始获取响应
-        fetchNextResponse();
+        if (fetchMode === 'push') {
+            openSessionChannel();
+        } else if (fetchMode === 'turn') {
+            fetchNextTurn();
+        } else {
+            fetchNextResponse();
+        }
     } catch (error) {
         showError(error.message || '启动讨论失败');
     }
@@ -458,8 +480,8 @@ async function fetchNextResponse() {
         return;
     }
 
-    // 获取当前应该响应的模型
-    const modelNames = ['DeepSeek', 'Doubao', 'Wenxin'];
+    // 获取当前应该响应的模型（按 /start 返回的发言顺序估计）
+    const modelNames = discussionState.models.length ? discussionState.models : ['DeepSeek', 'Doubao', 'Wenxin'];
     const currentModelIndex = discussionState.responses.length % modelNames.length;
     const currentModel = modelNames[currentModelIndex];
 
@@ -468,6 +490,66 @@ async function fetchNextResponse() {
 
     try {
         const response = await fetch('/next', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                session_id: discussionState.sessionId,
+                stream: true
+            })
+        });
+
+        const delay = retryDelay(response);
+        if (delay !== null) {
+            // 服务商过载：本次没有发言，按 Retry-After 稍后重试
+            hideThinkingIndicator();
+            setTimeout(fetchNextResponse, delay);
+            return;
+        }
+
+        const contentType = response.headers.get('Content-Type') || '';
+        let data;
+
+        if (response.ok && contentType.includes('text/event-stream')) {
+            // 流式响应：逐段渲染模型输出
+            data = await readResponseStream(response);
+        } else {
+            data = await response.json();
+
+            if (!response.ok) {
+                throw new Error(data.error || '获取响应失败');
+            }
+
+            // 添加到队列而不是直接处理
+            responseQueue.push(data);
+            processResponseQueue();
+        }
+
+        // 如果没有完成，继续获取下一个响应
+        if (!data.done) {
+            setTimeout(fetchNextResponse, data.retryAfter ? data.retryAfter * 1000 : 1500); // 增加间隔避免卡顿
+        }
+    } catch (error) {
+        hideThinkingIndicator();
+        showError(error.message || '获取响应失败');
+        discussionState.isActive = false;
+        discussionState.sessionId = null;
+        updateUI();
+    }
+}
+
+// 按整轮获取响应：一次请求返回当前轮剩余的全部发言
+async function fetchNextTurn() {
+    if (!discussionState.sessionId || !discussionState.isActive) {
+        return;
+    }
+
+    const modelNames = discussionState.models.length ? discussionState.models : ['DeepSeek', 'Doubao', 'Wenxin'];
+    showThinkingIndicator(modelNames[discussionState.responses.length % modelNames.length]);
+
+    try {
+        const response = await fetch('/turn', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -477,19 +559,28 @@ async function fetchNextResponse() {
             })
         });
 
+        const delay = retryDelay(response);
+        if (delay !== null) {
+            hideThinkingIndicator();
+            setTimeout(fetchNextTurn, delay);
+            return;
+        }
+
         const data = await response.json();
 
         if (!response.ok) {
             throw new Error(data.error || '获取响应失败');
         }
 
-        // 添加到队列而不是直接处理
-        responseQueue.push(data);
+        // 本轮发言依次进入队列，保持逐条展示的效果
+        data.responses.forEach(item => responseQueue.push(item));
+        if (data.done) {
+            responseQueue.push({ done: true });
+        }
         processResponseQueue();
 
-        // 如果没有完成，继续获取下一个响应
         if (!data.done) {
-            setTimeout(fetchNextResponse, 1500); // 增加间隔避免卡顿
+            setTimeout(fetchNextTurn, 1500);
         }
     } catch (error) {
         hideThinkingIndicator();
@@ -500,6 +591,166 @@ async function fetchNextResponse() {
     }
 }
 
+// 推送模式：一个长连接接收服务端依次生成的全部发言，连接本身即为会话保活
+async function openSessionChannel(retries = 0) {
+    if (!discussionState.sessionId || !discussionState.isActive) {
+        return;
+    }
+
+    const modelNames = discussionState.models.length ? discussionState.models : ['DeepSeek', 'Doubao', 'Wenxin'];
+    showThinkingIndicator(modelNames[discussionState.responses.length % modelNames.length]);
+
+    let data;
+    try {
+        const response = await fetch(`/events/${encodeURIComponent(discussionState.sessionId)}`);
+
+        if (!response.ok) {
+            const body = await response.json();
+            throw new Error(body.error || '获取响应失败');
+        }
+
+        updateConnectionStatus(true);
+        data = await readResponseStream(response);
+    } catch (error) {
+        hideThinkingIndicator();
+        if (error instanceof TypeError && retries < 5) {
+            // 网络中断：稍后重新连接，从已保存的会话状态继续
+            updateConnectionStatus(false);
+            setTimeout(() => openSessionChannel(retries + 1), 1000 * 2 ** retries);
+            return;
+        }
+        showError(error.message || '获取响应失败');
+        discussionState.isActive = false;
+        discussionState.sessionId = null;
+        updateUI();
+        return;
+    }
+
+    if (data.done) {
+        responseQueue.push(data);
+        processResponseQueue();
+    } else {
+        // 服务商过载或连接被服务端关闭：稍后重新连接
+        setTimeout(openSessionChannel, data.retryAfter ? data.retryAfter * 1000 : 1000);
+    }
+}
+
+// 服务端过载（429/503）时返回建议的重试间隔（毫秒），否则返回null
+function retryDelay(response) {
+    if (response.status !== 429 && response.status !== 503) {
+        return null;
+    }
+    const seconds = parseInt(response.headers.get('Retry-After'), 10);
+    return (isNaN(seconds) ? 1 : seconds) * 1000;
+}
+
+// 读取SSE流，返回最终响应数据
+async function readResponseStream(response) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+    let current = null;
+    let result = { done: false };
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) {
+            break;
+        }
+
+        buffer += decoder.decode(value, { stream: true });
+
+        // SSE事件以空行分隔
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+
+            const { event, payload } = parseSseEvent(rawEvent);
+            if (!payload) {
+                continue;
+            }
+
+            if (event === 'start') {
+                hideThinkingIndicator();
+                audioManager.playNotification();
+
+                current = {
+                    model: payload.model,
+                    response: '',
+                    turn: payload.turn,
+                    timestamp: Date.now() / 1000
+                };
+                discussionState.responses.push(current);
+                discussionState.currentTurn = payload.turn;
+                updateUI();
+            } else if (event === 'delta' && current) {
+                current.response += payload.content;
+                updateLatestResponseContent(current.response);
+            } else if (event === 'error' && payload.retry_after) {
+                // 服务商过载，本次没有发言：移除占位的空响应，稍后重试
+                if (current) {
+                    discussionState.responses.pop();
+                    discussionState.renderedResponsesCount = 0;
+                    updateUI();
+                }
+                return { done: false, retryAfter: payload.retry_after };
+            } else if (event === 'error') {
+                throw new Error(payload.error || '获取响应失败');
+            } else if (event === 'end' && current) {
+                current.response = payload.response;
+                current.timestamp = payload.timestamp || current.timestamp;
+                updateLatestResponseContent(current.response);
+                result = payload;
+
+                // 推送通道在同一连接上继续生成下一条发言
+                if (fetchMode === 'push') {
+                    const modelNames = discussionState.models.length ? discussionState.models : ['DeepSeek', 'Doubao', 'Wenxin'];
+                    showThinkingIndicator(modelNames[discussionState.responses.length % modelNames.length]);
+                }
+            } else if (event === 'done') {
+                result = payload;
+            }
+        }
+    }
+
+    return result;
+}
+
+// 解析单个SSE事件
+function parseSseEvent(rawEvent) {
+    let event = 'message';
+    let data = '';
+
+    rawEvent.split('\n').forEach(line => {
+        if (line.startsWith('event:')) {
+            event = line.slice(6).trim();
+        } else if (line.startsWith('data:')) {
+            data += line.slice(5).trim();
+        }
+    });
+
+    try {
+        return { event, payload: data ? JSON.parse(data) : null };
+    } catch (e) {
+        console.warn('无法解析流式数据:', e);
+        return { event, payload: null };
+    }
+}
+
+// 更新最新一条响应的文本内容
+function updateLatestResponseContent(text) {
+    const selector = discussionState.messageStyle === 'card'
+        ? '.response-card .response-content'
+        : '.message-bubble .message-bubble-content';
+    const nodes = elements.discussionResults.querySelectorAll(selector);
+
+    if (nodes.length > 0) {
+        nodes[nodes.length - 1].textContent = text;
+        elements.discussionResults.scrollTop = elements.discussionResults.scrollHeight;
+    }
+}
+
 // 为最新卡片添加打字机效果
 async function addTypingEffectToLatestCard() {
     const lastCard = elements.discussionResults.querySelector('.response-card:last-child .response-content');
@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from context_builder import USER_SPEAKER
+
+logger = logging.getLogger("TranscriptStore")
+
+_SESSION_ID = re.compile(r'^[\w.-]+$')
+
+
+class TranscriptStore:
+    """只追加的讨论记录：每个会话一个JSONL文件，每行一条记录
+
+    记录类型为 start（话题和参与者）、turn（一条发言）、summary（滚动摘要）和 end（讨论结束）。
+    每条记录以 O_APPEND 单次写入，多个工作进程写同一文件也不会交错；
+    fsync 由后台线程每隔 fsync_interval 秒批量执行，请求线程不会等待磁盘。
+    """
+
+    def __init__(self, directory="transcripts", fsync_interval=1.0, max_open=64):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.max_open = max_open
+        os.makedirs(directory, exist_ok=True)
+
+        self._files = OrderedDict()  # session_id -> 文件描述符，按最近写入顺序排列
+        self._dirty = set()
+        self._closing = set()        # 已写入 end 记录，下次落盘后关闭
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+
+        self._flusher = threading.Thread(target=self._flush_loop, name="transcript-fsync", daemon=True)
+        self._flusher.start()
+
+    def path(self, session_id):
+        if not _SESSION_ID.match(session_id or ''):
+            raise ValueError(f"无效的会话ID: {session_id}")
+        return os.path.join(self.directory, f"{session_id}.jsonl")
+
+    def append(self, session_id, record):
+        """追加一条记录，不等待落盘"""
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n"
+        with self._lock:
+            fd = self._files.get(session_id)
+            if fd is None:
+                fd = os.open(self.path(session_id), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                self._files[session_id] = fd
+                self._evict()
+            self._files.move_to_end(session_id)
+            os.write(fd, line.encode('utf-8'))
+            self._dirty.add(session_id)
+            if record.get('type') == 'end':
+                self._closing.add(session_id)
+                self._wake.set()
+
+    def _evict(self):
+        # 调用方需持有 self._lock；关闭最久未写入的文件，关闭前先落盘
+        while len(self._files) > self.max_open:
+            session_id, fd = self._files.popitem(last=False)
+            if session_id in self._dirty:
+                os.fsync(fd)
+                self._dirty.discard(session_id)
+            self._closing.discard(session_id)
+            os.close(fd)
+
+    def flush(self):
+        """把所有已写入的记录落盘"""
+        with self._lock:
+            # 复制文件描述符后在锁外 fsync，落盘期间其他线程仍可继续追加
+            pending = [os.dup(self._files[session_id]) for session_id in self._dirty]
+            closing = [self._files.pop(session_id) for session_id in self._closing]
+            self._dirty.clear()
+            self._closing.clear()
+        for fd in pending:
+            os.fsync(fd)
+            os.close(fd)
+        for fd in closing:
+            os.close(fd)
+
+    def _flush_loop(self):
+        while not self._stopped:
+            self._wake.wait(self.fsync_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error(f"讨论记录落盘失败: {str(e)}")
+
+    def close(self):
+        """落盘并关闭所有文件"""
+        self._stopped = True
+        self._wake.set()
+        self.flush()
+        with self._lock:
+            for fd in self._files.values():
+                os.close(fd)
+            self._files.clear()
+
+    def read(self, session_id):
+        """读取会话的全部记录，不存在时返回None；进程中断留下的不完整末行会被忽略"""
+        try:
+            with open(self.path(session_id), encoding='utf-8') as f:
+                lines = f.read().split("\n")
+        except FileNotFoundError:
+            return None
+
+        records = []
+        for line in lines:
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                logger.warning(f"忽略不完整的记录: {session_id}")
+        return records
+
+    def sessions(self):
+        """按修改时间从新到旧列出已保存的会话ID"""
+        entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.jsonl')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        return [entry.name[:-len('.jsonl')] for entry in entries]
+
+
+def start_record(topic_turn, max_turns, models, policy):
+    return {"type": "start", "topic": topic_turn.text, "tokens": topic_turn.tokens,
+            "timestamp": topic_turn.timestamp, "max_turns": max_turns, "models": list(models),
+            "speaking_order": str(policy)}
+
+
+def turn_record(turn, current_turn):
+    return {"type": "turn", "turn": current_turn, "speaker": turn.speaker, "role": turn.role,
+            "text": turn.text, "tokens": turn.tokens, "timestamp": turn.timestamp}
+
+
+def rebuild_state(records):
+    """按记录重建会话状态，不调用任何模型
+
+    返回 (状态字典, 元数据)，状态字典与 ConversationState.to_dict 的格式相同；
+    元数据包含 start 记录的字段、本轮已发言人数 round_index 和讨论是否已结束 finished。
+    """
+    if not records or records[0].get('type') != 'start':
+        raise ValueError("讨论记录缺少 start 记录")
+    start = records[0]
+
+    history = []
+    state = {"history": history, "current_turn": 0, "max_turns": start['max_turns'],
+             "summary": "", "summarized_upto": 1}
+    meta = dict(start, round_index=0, finished=False)
+    for record in records:
+        kind = record.get('type')
+        if kind == 'start':
+            history.append([USER_SPEAKER, "user", record['topic'], record['tokens'], record['timestamp']])
+        elif kind == 'turn':
+            if record['turn'] != state['current_turn']:
+                state['current_turn'] = record['turn']
+                meta['round_index'] = 0
+            history.append([record['speaker'], record['role'], record['text'],
+                            record['tokens'], record['timestamp']])
+            meta['round_index'] += 1
+        elif kind == 'summary':
+            state['summary'] = record['summary']
+            state['summarized_upto'] = record['upto']
+        elif kind == 'end':
+            state['current_turn'] = record.get('current_turn', state['current_turn'])
+            meta['finished'] = True
+    return state, meta
+
+
+def export_markdown(records):
+    """导出为便于阅读的 Markdown"""
+    _, meta = rebuild_state(records)
+    lines = [f"# {meta['topic']}", "",
+             f"- 参与者: {'、'.join(meta['models'])}",
+             f"- 发言顺序: {meta['speaking_order']}",
+             f"- 开始时间: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(meta['timestamp']))}",
+             f"- 状态: {'已结束' if meta['finished'] else '未完成'}", ""]
+    for record in records:
+        if record.get('type') == 'turn':
+            lines.extend([f"**{record['speaker']}**（第 {max(record['turn'], 1)} 轮）", "", record['text'], ""])
+    return "\n".join(lines)
+
+
+def create_transcript_store(system_config):
+    """根据 system.transcripts 配置创建讨论记录存储，未启用时返回None"""
+    transcript_config = system_config.get('transcripts') or {}
+    if not transcript_config.get('enabled'):
+        return None
+    return TranscriptStore(transcript_config.get('directory', 'transcripts'),
+                           transcript_config.get('fsync_interval', 1.0),
+                           transcript_config.get('max_open', 64))
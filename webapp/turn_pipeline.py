@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+# 预生成任务使用的线程池，同一会话同一时间只占用一个线程
+_pipeline_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="pipeline")
+
+
+class TurnPipeline:
+    """单个会话的后台讨论执行器：在客户端请求之前预先生成后续发言
+
+    produce() 按发言顺序生成下一条结果，讨论结束时返回 {"done": True, ...}。
+    已生成但未取走的结果最多 lookahead 条，客户端取走一条后才继续生成。
+    """
+
+    def __init__(self, produce, lookahead=1):
+        self._produce = produce
+        self.lookahead = max(1, lookahead)
+        self._ready = deque()
+        self._running = False
+        self._finished = False
+        self._cond = threading.Condition()
+
+    def _fill(self):
+        # 调用方需持有 self._cond
+        if self._running or self._finished or len(self._ready) >= self.lookahead:
+            return
+        self._running = True
+        _pipeline_executor.submit(self._work)
+
+    def _work(self):
+        try:
+            result, error = self._produce(), None
+        except Exception as e:
+            result, error = None, e
+
+        with self._cond:
+            self._running = False
+            self._ready.append((result, error))
+            if error is not None or result.get('done'):
+                self._finished = True
+            self._cond.notify_all()
+            self._fill()
+
+    def start(self):
+        """开始预生成第一条发言"""
+        with self._cond:
+            self._fill()
+
+    def next(self):
+        """取出下一条结果，尚未生成完成时等待；生成失败时抛出原异常"""
+        with self._cond:
+            self._fill()
+            while not self._ready:
+                self._cond.wait()
+            result, error = self._ready.popleft()
+            self._fill()
+        if error is not None:
+            raise error
+        return result
+
+
+class PipelinePool:
+    """进程内的会话执行器表，按最近使用顺序排列，空闲超时的执行器从最旧的一端清理"""
+
+    def __init__(self, ttl=7200):
+        self.ttl = ttl
+        self._pipelines = OrderedDict()  # session_id -> (最近使用时间, 执行器)
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """获取会话的执行器并刷新使用时间，不存在时返回None"""
+        with self._lock:
+            item = self._pipelines.get(session_id)
+            if item is None:
+                return None
+            self._pipelines[session_id] = (time.time(), item[1])
+            self._pipelines.move_to_end(session_id)
+            return item[1]
+
+    def add(self, session_id, pipeline):
+        """登记执行器并开始预生成"""
+        with self._lock:
+            self._pipelines[session_id] = (time.time(), pipeline)
+            self._pipelines.move_to_end(session_id)
+        pipeline.start()
+        return pipeline
+
+    def discard(self, session_id):
+        with self._lock:
+            self._pipelines.pop(session_id, None)
+
+    def expire(self):
+        deadline = time.time() - self.ttl
+        with self._lock:
+            while self._pipelines:
+                used_at, _ = next(iter(self._pipelines.values()))
+                if used_at > deadline:
+                    break
+                self._pipelines.popitem(last=False)
+
+    def __len__(self):
+        return len(self._pipelines)
+
+
+def create_pipeline_pool(system_config):
+    """根据 system.pipelining 配置创建执行器表，未启用时返回None"""
+    pipeline_config = system_config.get('pipelining') or {}
+    if not pipeline_config.get('enabled'):
+        return None
+    ttl = (system_config.get('session_store') or {}).get('ttl', 7200)
+    return PipelinePool(ttl)